@@ -0,0 +1,640 @@
+#!/usr/bin/env python3
+# File: ace_daemon.py — ValgACE daemon owning the ACE serial link
+#
+# Runs the ACE link in its own process and shares it over a Unix-domain
+# socket. Klipper (ace.py with `daemon_socket`), Moonraker (ace_status.py)
+# and CLI tools connect to the socket, so restarting Klipper does not drop
+# the serial connection or interrupt drying.
+#
+# Socket protocol: every client may speak either
+#   - ACE frames (0xFF 0xAA ... 0xFE), exactly as sent to the device, or
+#   - newline-delimited JSON.
+# The mode is picked from the first byte the client sends. Requests carry
+# the client's own `id`, the daemon remaps it on the wire and restores it in
+# the reply. Methods with the `daemon.` prefix are handled locally:
+#   daemon.subscribe    push {"event": "status", "eventtime", "result"} on every status
+#   daemon.unsubscribe  stop pushes
+#   daemon.info         link state and counters
+#
+# Usage:
+#   python3 ace_daemon.py serve --serial /dev/ttyACM0 --socket /tmp/ace.sock
+#   python3 ace_daemon.py serve --emulate --socket /tmp/ace.sock
+#   python3 ace_daemon.py call get_status
+#   python3 ace_daemon.py watch
+#   python3 ace_daemon.py selftest
+
+import argparse
+import json
+import logging
+import os
+import selectors
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from ace_protocol import FrameParser, pack_frame
+
+try:
+    import serial
+    from serial import SerialException
+except ImportError:
+    serial = None
+    SerialException = OSError
+
+DEFAULT_SOCKET = '/tmp/ace.sock'
+ACE_VID_PID = (0x28e9, 0x018a)
+ACE_DESCRIPTIONS = ('ACE', 'BunnyAce', 'DuckAce')
+
+# Drop clients that stop reading instead of buffering without bound
+MAX_CLIENT_BUFFER = 1 << 20
+
+
+def find_ace_device() -> Optional[str]:
+    """Same VID/PID/description auto-detection as ValgAce._find_ace_device"""
+    if serial is None:
+        return None
+    import serial.tools.list_ports
+    for port in serial.tools.list_ports.comports():
+        if (getattr(port, 'vid', None), getattr(port, 'pid', None)) == ACE_VID_PID:
+            return port.device
+        if any(name in (port.description or '') for name in ACE_DESCRIPTIONS):
+            return port.device
+    return None
+
+
+class AceLink:
+    """
+    Serial side of the daemon: framing, request ids, pacing and timeouts.
+    One request is written per send_interval, matching ValgAce's writer loop.
+    """
+    def __init__(self, sel: selectors.BaseSelector, port: str, baud: int,
+                 response_timeout: float = 2.0, write_timeout: float = 0.5,
+                 send_interval: float = 0.05, max_queue_size: int = 20):
+        self._sel = sel
+        self.port = port
+        self.baud = baud
+        self._response_timeout = response_timeout
+        self._write_timeout = write_timeout
+        self._send_interval = send_interval
+        self._max_queue_size = max_queue_size
+        self._serial = None
+        self._parser = FrameParser()
+        self._queue: Deque[Tuple[Dict[str, Any], Callable]] = deque()
+        self._pending: Dict[int, Tuple[float, Callable]] = {}
+        self._request_id = 0
+        self._next_send = 0.0
+        self._next_connect = 0.0
+        self.connected = False
+        self.on_unsolicited: Optional[Callable[[Dict[str, Any]], None]] = None
+        self.stats = {'frames_sent': 0, 'frames_received': 0, 'timeouts': 0,
+                      'reconnects': 0, 'queue_overflows': 0}
+        self.logger = logging.getLogger('ace_daemon.link')
+
+    def connect(self, now: float) -> bool:
+        if self.connected:
+            return True
+        if now < self._next_connect:
+            return False
+        self._next_connect = now + 1.0
+        if serial is None:
+            self.logger.error("pyserial is required: pip install pyserial")
+            return False
+        try:
+            self._serial = serial.Serial(port=self.port, baudrate=self.baud,
+                                         timeout=0, write_timeout=self._write_timeout)
+        except SerialException as e:
+            self.logger.info(f"Connection to {self.port} failed: {e}")
+            return False
+        self._parser.reset()
+        self._sel.register(self._serial.fileno(), selectors.EVENT_READ, self._on_readable)
+        self.connected = True
+        self.logger.info(f"Connected to ACE at {self.port}")
+        return True
+
+    def disconnect(self, reason: str = ''):
+        if not self.connected:
+            return
+        self.connected = False
+        self.stats['reconnects'] += 1
+        self.logger.info(f"Disconnected from ACE {reason}")
+        try:
+            self._sel.unregister(self._serial.fileno())
+        except (KeyError, ValueError, OSError):
+            pass
+        try:
+            self._serial.close()
+        except Exception:
+            pass
+        self._serial = None
+        self._fail_all('ACE disconnected')
+
+    def _fail_all(self, msg: str):
+        callbacks = [cb for _, cb in self._pending.values()] + [cb for _, cb in self._queue]
+        self._pending.clear()
+        self._queue.clear()
+        for cb in callbacks:
+            self._call(cb, {'code': -1, 'msg': msg})
+
+    def _call(self, callback: Callable, response: Dict[str, Any]):
+        try:
+            callback(response)
+        except Exception:
+            self.logger.exception("Response callback error")
+
+    def request(self, message: Dict[str, Any], callback: Callable):
+        if not self.connected:
+            self._call(callback, {'code': -1, 'msg': 'ACE not connected'})
+            return
+        if len(self._queue) >= self._max_queue_size:
+            self.stats['queue_overflows'] += 1
+            self._call(callback, {'code': -1, 'msg': 'Queue overflow'})
+            return
+        self._queue.append((message, callback))
+
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    def _on_readable(self, mask):
+        try:
+            data = self._serial.read(4096)
+        except SerialException as e:
+            self.disconnect(f"(read error: {e})")
+            return
+        for message in self._parser.feed(data):
+            self.stats['frames_received'] += 1
+            entry = self._pending.pop(message.get('id'), None)
+            if entry is not None:
+                self._call(entry[1], message)
+            elif self.on_unsolicited is not None:
+                self.on_unsolicited(message)
+
+    def tick(self, now: float):
+        if not self.connected:
+            self.connect(now)
+            return
+        expired = [rid for rid, (sent, _) in self._pending.items()
+                   if now - sent > self._response_timeout]
+        for rid in expired:
+            _, callback = self._pending.pop(rid)
+            self.stats['timeouts'] += 1
+            self._call(callback, {'id': rid, 'code': -1, 'msg': 'Response timeout'})
+        if not self._queue or now < self._next_send:
+            return
+        message, callback = self._queue.popleft()
+        self._request_id = (self._request_id + 1) % 300000
+        wire = dict(message)
+        wire['id'] = self._request_id
+        try:
+            frame = pack_frame(wire)
+        except (TypeError, ValueError) as e:
+            self._call(callback, {'code': -1, 'msg': f'Bad request: {e}'})
+            return
+        try:
+            self._serial.write(frame)
+        except SerialException as e:
+            self._queue.appendleft((message, callback))
+            self.disconnect(f"(write error: {e})")
+            return
+        self.stats['frames_sent'] += 1
+        self._pending[self._request_id] = (now, callback)
+        self._next_send = now + self._send_interval
+
+    def parser_stats(self) -> Dict[str, int]:
+        return {'crc_errors': self._parser.crc_errors,
+                'decode_errors': self._parser.decode_errors,
+                'dropped_bytes': self._parser.dropped_bytes}
+
+
+class Client:
+    """One socket consumer (Klipper, Moonraker or a CLI tool)"""
+    def __init__(self, daemon: 'AceDaemon', sock: socket.socket):
+        self.daemon = daemon
+        self.sock = sock
+        self.mode: Optional[str] = None  # 'frame' or 'line'
+        self.subscribed = False
+        self.closed = False
+        self._parser = FrameParser()
+        self._line_buffer = bytearray()
+        self._out = bytearray()
+
+    def on_event(self, mask):
+        if mask & selectors.EVENT_READ:
+            self._on_readable()
+        if mask & selectors.EVENT_WRITE and not self.closed:
+            self._flush()
+
+    def _on_readable(self):
+        try:
+            data = self.sock.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.daemon.drop_client(self)
+            return
+        if self.mode is None:
+            self.mode = 'frame' if data[:1] == b'\xff' else 'line'
+        if self.mode == 'frame':
+            messages = self._parser.feed(data)
+        else:
+            messages = []
+            self._line_buffer.extend(data)
+            while True:
+                end = self._line_buffer.find(b'\n')
+                if end < 0:
+                    break
+                line = bytes(self._line_buffer[:end]).strip()
+                del self._line_buffer[:end + 1]
+                if not line:
+                    continue
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    self.send({'code': -1, 'msg': 'Invalid JSON'})
+                    continue
+                if isinstance(message, dict):
+                    messages.append(message)
+        for message in messages:
+            self.daemon.handle_request(self, message)
+
+    def send(self, message: Dict[str, Any]):
+        if self.closed:
+            return
+        if self.mode == 'frame':
+            try:
+                self._out.extend(pack_frame(message))
+            except ValueError:
+                logging.getLogger('ace_daemon').info("Reply too long for a frame, dropped")
+                return
+        else:
+            self._out.extend(json.dumps(message).encode('utf-8') + b'\n')
+        if len(self._out) > MAX_CLIENT_BUFFER:
+            self.daemon.drop_client(self)
+            return
+        self._flush()
+
+    def _flush(self):
+        try:
+            sent = self.sock.send(self._out)
+            del self._out[:sent]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            self.daemon.drop_client(self)
+            return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if self._out else 0)
+        self.daemon.sel.modify(self.sock, events, self.on_event)
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class AceDaemon:
+    def __init__(self, link_args: Dict[str, Any], socket_path: str, poll_interval: float = 1.0):
+        self.sel = selectors.DefaultSelector()
+        self.link = AceLink(self.sel, **link_args)
+        self.socket_path = socket_path
+        self.poll_interval = poll_interval
+        self.clients: List[Client] = []
+        self.status: Optional[Dict[str, Any]] = None
+        self.status_time = 0.0
+        self._status_waiters: Optional[List[Callable]] = None
+        self._running = False
+        self._server: Optional[socket.socket] = None
+        self._start_time = time.monotonic()
+        self.logger = logging.getLogger('ace_daemon')
+
+    def open(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o660)
+        self._server.listen(8)
+        self._server.setblocking(False)
+        self.sel.register(self._server, selectors.EVENT_READ, self._on_accept)
+        self.logger.info(f"Listening on {self.socket_path}")
+
+    def close(self):
+        for client in list(self.clients):
+            self.drop_client(client)
+        self.link.disconnect('(daemon stopped)')
+        if self._server is not None:
+            self.sel.unregister(self._server)
+            self._server.close()
+            self._server = None
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+
+    def _on_accept(self, mask):
+        try:
+            sock, _ = self._server.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        sock.setblocking(False)
+        client = Client(self, sock)
+        self.clients.append(client)
+        self.sel.register(sock, selectors.EVENT_READ, client.on_event)
+        self.logger.info(f"Client connected ({len(self.clients)} total)")
+
+    def drop_client(self, client: Client):
+        if client.closed:
+            return
+        try:
+            self.sel.unregister(client.sock)
+        except (KeyError, ValueError):
+            pass
+        client.close()
+        self.clients.remove(client)
+        self.logger.info(f"Client disconnected ({len(self.clients)} left)")
+
+    def handle_request(self, client: Client, message: Dict[str, Any]):
+        method = message.get('method')
+        cid = message.get('id')
+
+        def reply(response):
+            response = dict(response)
+            response['id'] = cid
+            client.send(response)
+
+        if not isinstance(method, str):
+            reply({'code': -1, 'msg': 'method is required'})
+        elif method == 'daemon.subscribe':
+            client.subscribed = True
+            reply({'code': 0, 'msg': 'success', 'result': {'subscribed': True}})
+            if self.status is not None:
+                client.send(self._status_event())
+        elif method == 'daemon.unsubscribe':
+            client.subscribed = False
+            reply({'code': 0, 'msg': 'success', 'result': {'subscribed': False}})
+        elif method == 'daemon.info':
+            reply({'code': 0, 'msg': 'success', 'result': self.info()})
+        elif method == 'get_status':
+            self.request_status(reply)
+        else:
+            request = {'method': method}
+            if message.get('params') is not None:
+                request['params'] = message['params']
+            self.link.request(request, reply)
+
+    def request_status(self, callback: Optional[Callable] = None):
+        """
+        Coalesce status polls: while a get_status is on the wire, further
+        callers wait for the same reply instead of sending their own.
+        """
+        if self._status_waiters is not None:
+            if callback is not None:
+                self._status_waiters.append(callback)
+            return
+        self._status_waiters = [callback] if callback is not None else []
+        self.link.request({'method': 'get_status'}, self._on_status)
+
+    def _on_status(self, response: Dict[str, Any]):
+        waiters, self._status_waiters = self._status_waiters or [], None
+        result = response.get('result')
+        if isinstance(result, dict):
+            self.status = result
+            self.status_time = time.monotonic()
+            event = self._status_event()
+            for client in list(self.clients):
+                if client.subscribed:
+                    client.send(event)
+        for waiter in waiters:
+            waiter(response)
+
+    def _status_event(self) -> Dict[str, Any]:
+        return {'event': 'status', 'eventtime': self.status_time, 'result': self.status}
+
+    def info(self) -> Dict[str, Any]:
+        info = {
+            'connected': self.link.connected,
+            'serial': self.link.port,
+            'uptime': time.monotonic() - self._start_time,
+            'clients': len(self.clients),
+            'subscribers': sum(1 for c in self.clients if c.subscribed),
+            'queue_depth': self.link.queue_depth(),
+            'status_age': (time.monotonic() - self.status_time) if self.status is not None else None,
+        }
+        info.update(self.link.stats)
+        info.update(self.link.parser_stats())
+        return info
+
+    def run_once(self, timeout: float = 0.05):
+        for key, mask in self.sel.select(timeout):
+            key.data(mask)
+        now = time.monotonic()
+        if self.link.connected and self._status_waiters is None \
+                and now - self.status_time >= self.poll_interval:
+            # Keep the status warm even with no consumer polling (e.g. Klipper restarting)
+            self.request_status()
+        self.link.tick(now)
+
+    def serve_forever(self):
+        self._running = True
+        while self._running:
+            self.run_once()
+
+    def stop(self):
+        self._running = False
+
+
+class DaemonClient:
+    """Minimal blocking line-mode client used by the CLI and the selftest"""
+    def __init__(self, socket_path: str, timeout: float = 5.0):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(socket_path)
+        self._buffer = b''
+        self._id = 0
+
+    def send(self, method: str, params: Optional[Dict[str, Any]] = None) -> int:
+        self._id += 1
+        message = {'id': self._id, 'method': method}
+        if params is not None:
+            message['params'] = params
+        self.sock.sendall(json.dumps(message).encode('utf-8') + b'\n')
+        return self._id
+
+    def receive(self) -> Dict[str, Any]:
+        while b'\n' not in self._buffer:
+            data = self.sock.recv(4096)
+            if not data:
+                raise ConnectionError("Daemon closed connection")
+            self._buffer += data
+        line, self._buffer = self._buffer.split(b'\n', 1)
+        return json.loads(line)
+
+    def call(self, method: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        rid = self.send(method, params)
+        while True:
+            message = self.receive()
+            if message.get('id') == rid:
+                return message
+
+    def close(self):
+        self.sock.close()
+
+
+def build_daemon(args) -> Tuple[AceDaemon, Optional[Any]]:
+    emulator = None
+    port = args.serial
+    if args.emulate:
+        from ace_emulator import AceEmulator, PtyEmulator
+        emulator = PtyEmulator(AceEmulator(park_time=args.park_time))
+        port = emulator.device
+    elif not port:
+        port = find_ace_device() or '/dev/ttyACM0'
+    daemon = AceDaemon({'port': port, 'baud': args.baud,
+                        'response_timeout': args.response_timeout,
+                        'write_timeout': args.write_timeout},
+                       args.socket, poll_interval=args.poll_interval)
+    if emulator is not None:
+        emulator.register(daemon.sel)
+    return daemon, emulator
+
+
+def cmd_serve(args):
+    daemon, emulator = build_daemon(args)
+    daemon.open()
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+        if emulator is not None:
+            emulator.close()
+
+
+def cmd_call(args):
+    client = DaemonClient(args.socket)
+    params = json.loads(args.params) if args.params else None
+    print(json.dumps(client.call(args.method, params), indent=2))
+    client.close()
+
+
+def cmd_watch(args):
+    client = DaemonClient(args.socket, timeout=None)
+    client.call('daemon.subscribe')
+    try:
+        while True:
+            print(json.dumps(client.receive()), flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.close()
+
+
+def cmd_selftest(args):
+    """Run the daemon against the emulator and exercise the socket API"""
+    socket_path = os.path.join(tempfile.mkdtemp(prefix='ace-selftest-'), 'ace.sock')
+    args.emulate = True
+    args.socket = socket_path
+    args.poll_interval = 0.2
+    args.park_time = 0.5
+    daemon, emulator = build_daemon(args)
+    daemon.open()
+    thread = threading.Thread(target=daemon.serve_forever, daemon=True)
+    thread.start()
+    failures = []
+
+    def check(name, condition, detail=''):
+        print(f"{'OK  ' if condition else 'FAIL'} {name} {detail}".rstrip())
+        if not condition:
+            failures.append(name)
+
+    try:
+        deadline = time.monotonic() + 5.0
+        while not daemon.link.connected and time.monotonic() < deadline:
+            time.sleep(0.05)
+        check('link connects to emulator', daemon.link.connected)
+
+        client = DaemonClient(socket_path)
+        info = client.call('get_info')
+        check('get_info round trip', info.get('result', {}).get('model') == 'Anycubic Color Engine Pro')
+
+        status = client.call('get_status')
+        check('get_status round trip', status.get('result', {}).get('status') == 'ready')
+
+        feed = client.call('feed_filament', {'index': 0, 'length': 10, 'speed': 25})
+        check('feed_filament accepted', feed.get('code') == 0, json.dumps(feed))
+
+        empty = client.call('feed_filament', {'index': 3, 'length': 10, 'speed': 25})
+        check('feed on empty slot rejected', empty.get('code') != 0)
+
+        watcher = DaemonClient(socket_path)
+        watcher.call('daemon.subscribe')
+        event = watcher.receive()
+        check('subscription streams status', event.get('event') == 'status'
+              and 'slots' in event.get('result', {}))
+
+        # Frame-mode client: the transport ValgAce uses
+        raw = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        raw.settimeout(5.0)
+        raw.connect(socket_path)
+        raw.sendall(pack_frame({'id': 4242, 'method': 'get_info'}))
+        parser = FrameParser()
+        replies = []
+        while not replies:
+            replies = parser.feed(raw.recv(4096))
+        check('frame-mode client keeps its request id', replies[0].get('id') == 4242)
+        raw.close()
+
+        stats = client.call('daemon.info')['result']
+        check('daemon.info reports clients', stats.get('clients', 0) >= 2, json.dumps(stats))
+        client.close()
+        watcher.close()
+    except Exception as e:
+        check('selftest raised', False, repr(e))
+    finally:
+        daemon.stop()
+        thread.join(2.0)
+        daemon.close()
+        emulator.close()
+    print('selftest ' + ('passed' if not failures else f"failed: {', '.join(failures)}"))
+    return 1 if failures else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ValgACE daemon")
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help="Unix socket path")
+    parser.add_argument('--log-level', default='INFO')
+    sub = parser.add_subparsers(dest='command')
+
+    serve = sub.add_parser('serve', help="Own the ACE serial port and serve the socket API")
+    for p in (serve, sub.add_parser('selftest', help="Run the daemon against the emulator")):
+        p.add_argument('--serial', default=None, help="Serial port (auto-detected if omitted)")
+        p.add_argument('--baud', type=int, default=115200)
+        p.add_argument('--poll-interval', type=float, default=1.0)
+        p.add_argument('--response-timeout', type=float, default=2.0)
+        p.add_argument('--write-timeout', type=float, default=0.5)
+        p.add_argument('--emulate', action='store_true', help="Use the built-in ACE emulator")
+        p.add_argument('--park-time', type=float, default=2.0, help="Emulator park duration")
+
+    call = sub.add_parser('call', help="Send one request and print the reply")
+    call.add_argument('method')
+    call.add_argument('params', nargs='?', default=None, help="JSON params")
+    sub.add_parser('watch', help="Print the status subscription stream")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    commands = {'serve': cmd_serve, 'call': cmd_call, 'watch': cmd_watch, 'selftest': cmd_selftest}
+    if args.command not in commands:
+        parser.print_help()
+        return 2
+    return commands[args.command](args) or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
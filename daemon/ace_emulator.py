@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# File: ace_emulator.py — emulated Anycubic Color Engine Pro for local testing
+#
+# Speaks the ACE framing/RPC protocol over a pseudo-terminal, so the daemon
+# or Klipper can be pointed at it instead of real hardware:
+#
+#   python3 ace_emulator.py            # prints the pty path to use as `serial:`
+
+import argparse
+import logging
+import os
+import selectors
+import time
+import tty
+from typing import Any, Callable, Dict, List, Optional
+
+from ace_protocol import FrameParser, pack_frame
+
+DEFAULT_FILAMENTS = [
+    {'type': 'PLA', 'color': [255, 0, 0], 'sku': 'EMU-PLA-RED', 'brand': 'Emulator', 'rfid': 2},
+    {'type': 'PETG', 'color': [0, 0, 255], 'sku': 'EMU-PETG-BLUE', 'brand': 'Emulator', 'rfid': 2},
+    {'type': 'PLA', 'color': [255, 255, 255], 'sku': '', 'brand': '', 'rfid': 0},
+    None,
+]
+
+
+class AceEmulator:
+    """
+    Emulated ACE device.
+    Bytes written by the host go to feed(), replies are collected with read().
+    tick() advances feeding, unwinding, feed assist and the dryer.
+    """
+    def __init__(self, clock: Optional[Callable[[], float]] = None,
+                 filaments: Optional[List[Optional[Dict[str, Any]]]] = None,
+                 park_time: float = 2.0):
+        self._clock = clock or time.monotonic
+        self._parser = FrameParser()
+        self._output = bytearray()
+        self.park_time = park_time
+        self.requests: List[Dict[str, Any]] = []
+
+        self.temp = 25.0
+        self.fan_speed = 0
+        self.feed_assist_count = 0
+        self.dryer = {'status': 'stop', 'target_temp': 0, 'duration': 0, 'remain_time': 0}
+        self._dryer_end = 0.0
+        self._action = None  # (name, index, end_time)
+        self._assist_index = -1
+        self._assist_until = 0.0
+        self._last_tick = self._clock()
+
+        self.slots = []
+        for i, filament in enumerate(filaments if filaments is not None else DEFAULT_FILAMENTS):
+            slot = {'index': i, 'status': 'empty', 'sku': '', 'brand': '', 'type': '',
+                    'color': [0, 0, 0], 'rfid': 0}
+            if filament is not None:
+                slot.update(filament)
+                slot['status'] = 'ready'
+            self.slots.append(slot)
+
+    # Host side I/O
+
+    def feed(self, data: bytes):
+        for request in self._parser.feed(data):
+            self.requests.append(request)
+            self._output.extend(pack_frame(self._dispatch(request)))
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0 or size >= len(self._output):
+            data = bytes(self._output)
+            self._output.clear()
+        else:
+            data = bytes(self._output[:size])
+            del self._output[:size]
+        return data
+
+    def pending(self) -> int:
+        return len(self._output)
+
+    # Test hooks
+
+    def remove_spool(self, index: int):
+        self.slots[index].update({'status': 'empty', 'sku': '', 'brand': '', 'type': '',
+                                  'color': [0, 0, 0], 'rfid': 0})
+
+    def insert_spool(self, index: int, filament: Dict[str, Any]):
+        self.slots[index].update(filament)
+        self.slots[index]['status'] = 'ready'
+
+    # Simulation
+
+    def tick(self):
+        now = self._clock()
+        dt = max(0.0, now - self._last_tick)
+        self._last_tick = now
+        if self._action is not None and now >= self._action[2]:
+            self._action = None
+        if self._assist_index >= 0 and now < self._assist_until:
+            # The assist counter keeps moving until the filament reaches the toolhead
+            self.feed_assist_count += max(1, int(dt * 10))
+        if self.dryer['status'] == 'drying':
+            remain = max(0.0, self._dryer_end - now)
+            self.dryer['remain_time'] = int(remain)
+            target = self.dryer['target_temp']
+            self.temp = min(target, self.temp + dt * 0.5)
+            if remain <= 0:
+                self.dryer.update({'status': 'stop', 'target_temp': 0, 'duration': 0, 'remain_time': 0})
+                self.fan_speed = 0
+        else:
+            self.temp = max(25.0, self.temp - dt * 0.2)
+
+    def _status(self) -> Dict[str, Any]:
+        result = {
+            'status': 'busy' if self._action else 'ready',
+            'dryer_status': dict(self.dryer),
+            'temp': int(self.temp),
+            'enable_rfid': 1,
+            'fan_speed': self.fan_speed,
+            'feed_assist_count': self.feed_assist_count,
+            'cont_assist_time': 0.0,
+            'slots': [{k: v for k, v in slot.items() if k != 'brand'} for slot in self.slots],
+        }
+        if self._action:
+            result['action'] = self._action[0]
+        return result
+
+    def _dispatch(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        self.tick()
+        method = request.get('method')
+        params = request.get('params') or {}
+        response = {'id': request.get('id', 0), 'code': 0, 'msg': 'success'}
+        handler = getattr(self, '_rpc_' + str(method), None)
+        if handler is None:
+            response.update({'code': 1, 'msg': f'unknown method {method}'})
+            return response
+        try:
+            result = handler(params)
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            response.update({'code': 1, 'msg': f'bad params: {e}'})
+            return response
+        if isinstance(result, str):
+            response.update({'code': 1, 'msg': result})
+        elif result is not None:
+            response['result'] = result
+        return response
+
+    def _slot(self, params) -> Dict[str, Any]:
+        return self.slots[int(params['index'])]
+
+    def _rpc_get_info(self, params):
+        return {'id': 0, 'slots': len(self.slots), 'model': 'Anycubic Color Engine Pro',
+                'firmware': 'V1.3.82-emu', 'boot_firmware': 'V1.0.1'}
+
+    def _rpc_get_status(self, params):
+        return self._status()
+
+    def _rpc_get_filament_info(self, params):
+        slot = self._slot(params)
+        info = dict(slot)
+        if slot['rfid'] == 2:
+            info.update({'extruder_temp': {'min': 190, 'max': 230},
+                         'hotbed_temp': {'min': 50, 'max': 70},
+                         'diameter': 1.75, 'total': 330, 'current': 0})
+        return info
+
+    def _rpc_enable_rfid(self, params):
+        return None
+
+    def _rpc_disable_rfid(self, params):
+        return None
+
+    def _rpc_drying(self, params):
+        duration = int(params['duration'])
+        self.dryer = {'status': 'drying', 'target_temp': int(params['temp']),
+                      'duration': duration, 'remain_time': duration * 60}
+        self.fan_speed = int(params.get('fan_speed', 7000))
+        self._dryer_end = self._clock() + duration * 60
+        return None
+
+    def _rpc_drying_stop(self, params):
+        self.dryer = {'status': 'stop', 'target_temp': 0, 'duration': 0, 'remain_time': 0}
+        self.fan_speed = 0
+        return None
+
+    def _start_action(self, name, params):
+        slot = self._slot(params)
+        if slot['status'] != 'ready':
+            return f"slot {slot['index']} is empty"
+        if self._action is not None:
+            return 'busy'
+        duration = float(params['length']) / max(1.0, float(params['speed']))
+        self._action = (name, slot['index'], self._clock() + duration)
+        return None
+
+    def _stop_action(self, name, params):
+        if self._action is not None and self._action[0] == name \
+                and self._action[1] == int(params['index']):
+            self._action = None
+        return None
+
+    def _rpc_feed_filament(self, params):
+        return self._start_action('feeding', params)
+
+    def _rpc_unwind_filament(self, params):
+        return self._start_action('unwinding', params)
+
+    def _rpc_stop_feed_filament(self, params):
+        return self._stop_action('feeding', params)
+
+    def _rpc_stop_unwind_filament(self, params):
+        return self._stop_action('unwinding', params)
+
+    def _rpc_update_feeding_speed(self, params):
+        self._slot(params)
+        return None
+
+    def _rpc_update_unwinding_speed(self, params):
+        self._slot(params)
+        return None
+
+    def _rpc_start_feed_assist(self, params):
+        slot = self._slot(params)
+        if slot['status'] != 'ready':
+            return f"slot {slot['index']} is empty"
+        self._assist_index = slot['index']
+        self._assist_until = self._clock() + self.park_time
+        return None
+
+    def _rpc_stop_feed_assist(self, params):
+        self._slot(params)
+        self._assist_index = -1
+        return None
+
+
+class PtyEmulator:
+    """Runs an AceEmulator behind a pseudo-terminal"""
+    def __init__(self, emulator: AceEmulator):
+        self.emulator = emulator
+        self.master_fd, slave_fd = os.openpty()
+        tty.setraw(slave_fd)
+        self.device = os.ttyname(slave_fd)
+        # Keep the slave open so the pty survives host reconnects
+        self._slave_fd = slave_fd
+        os.set_blocking(self.master_fd, False)
+
+    def register(self, sel: selectors.BaseSelector):
+        sel.register(self.master_fd, selectors.EVENT_READ, self._on_readable)
+
+    def _on_readable(self, mask):
+        try:
+            data = os.read(self.master_fd, 4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        if data:
+            self.emulator.feed(data)
+            self.flush()
+
+    def flush(self):
+        self.emulator.tick()
+        data = self.emulator.read()
+        while data:
+            try:
+                written = os.write(self.master_fd, data)
+            except BlockingIOError:
+                # Host is not reading; drop the rest like the real device would
+                return
+            data = data[written:]
+
+    def close(self):
+        for fd in (self.master_fd, self._slave_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Emulated ACE Pro on a pseudo-terminal")
+    parser.add_argument('--park-time', type=float, default=2.0,
+                        help="Seconds feed assist keeps counting before the filament 'reaches' the toolhead")
+    parser.add_argument('--log-level', default='INFO')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(levelname)s %(message)s')
+
+    pty_emu = PtyEmulator(AceEmulator(park_time=args.park_time))
+    sel = selectors.DefaultSelector()
+    pty_emu.register(sel)
+    print(pty_emu.device, flush=True)
+    logging.info(f"ACE emulator listening on {pty_emu.device}")
+    try:
+        while True:
+            for key, mask in sel.select(0.1):
+                key.data(mask)
+            pty_emu.emulator.tick()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pty_emu.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+# File: ace_protocol.py — ACE frame encoding/decoding shared by the daemon and emulator
+#
+# Frame layout (see docs/Protocol.md):
+#   0xFF 0xAA | payload length (u16 LE) | JSON payload | CRC-16/MCRF4XX (u16 LE) | 0xFE
+
+import json
+import struct
+from typing import Any, Dict, List
+
+FRAME_HEAD = b'\xff\xaa'
+FRAME_TAIL = 0xfe
+# The ACE freezes on frames longer than this, so never accept or build one
+MAX_PAYLOAD = 1024
+
+
+def calc_crc(buffer: bytes) -> int:
+    """CRC-16/MCRF4XX, identical to ValgAce._calc_crc"""
+    crc = 0xffff
+    for byte in buffer:
+        data = byte ^ (crc & 0xff)
+        data ^= (data & 0x0f) << 4
+        crc = (((data << 8) | (crc >> 8)) ^ (data >> 4) ^ (data << 3)) & 0xffff
+    return crc & 0xffff
+
+
+def pack_frame(message: Dict[str, Any]) -> bytes:
+    payload = json.dumps(message).encode('utf-8')
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError(f"Payload too long ({len(payload)} bytes)")
+    return (
+        FRAME_HEAD +
+        struct.pack('<H', len(payload)) +
+        payload +
+        struct.pack('<H', calc_crc(payload)) +
+        bytes([FRAME_TAIL])
+    )
+
+
+class FrameParser:
+    """
+    Incremental frame decoder.
+    Uses the length header to find frame boundaries, so 0xFE bytes inside
+    the payload do not split a frame.
+    """
+    def __init__(self):
+        self._buffer = bytearray()
+        self.frames = 0
+        self.crc_errors = 0
+        self.decode_errors = 0
+        self.dropped_bytes = 0
+
+    def reset(self):
+        self._buffer.clear()
+
+    def feed(self, data: bytes) -> List[Dict[str, Any]]:
+        buf = self._buffer
+        buf.extend(data)
+        messages = []
+        while True:
+            start = buf.find(FRAME_HEAD)
+            if start < 0:
+                # Keep a trailing 0xFF, it may be the first half of a header
+                keep = 1 if buf[-1:] == FRAME_HEAD[:1] else 0
+                self.dropped_bytes += len(buf) - keep
+                del buf[:len(buf) - keep]
+                break
+            if start:
+                self.dropped_bytes += start
+                del buf[:start]
+            if len(buf) < 4:
+                break
+            length = struct.unpack_from('<H', buf, 2)[0]
+            if length > MAX_PAYLOAD:
+                # Corrupted header, resync on the next 0xFF 0xAA
+                self.dropped_bytes += 2
+                del buf[:2]
+                continue
+            total = 4 + length + 3
+            if len(buf) < total:
+                break
+            payload = bytes(buf[4:4 + length])
+            crc = struct.unpack_from('<H', buf, 4 + length)[0]
+            tail = buf[4 + length + 2]
+            del buf[:total]
+            if tail != FRAME_TAIL or crc != calc_crc(payload):
+                self.crc_errors += 1
+                continue
+            try:
+                message = json.loads(payload.decode('utf-8'))
+            except ValueError:
+                self.decode_errors += 1
+                continue
+            if isinstance(message, dict):
+                self.frames += 1
+                messages.append(message)
+        return messages
@@ -1,10 +1,21 @@
 # File: ace.py — ValgAce module for Klipper
 
+import heapq
 import logging
 import json
+import math
+import os
+import select
+import socket
 import struct
+import termios
+import time
+import tty
 import queue
-from typing import Optional, Dict, Any, Callable
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Optional, Dict, Any, Callable, List
 
 # Check for required libraries and raise an error if they are not available
 try:
@@ -17,6 +28,121 @@ except ImportError:
     raise ImportError("The 'pyserial' library is required for ValgAce module. Please install it using 'pip install pyserial'")
 
 
+# Кадр ACE: 0xFF 0xAA, длина данных (2 байта), JSON, CRC (2 байта), 0xFE. Ответы ACE
+# меньше 1 КБ; заголовок с большей длиной - ложное совпадение в потоке
+# ACE frame: 0xFF 0xAA, payload length (2 bytes), JSON, CRC (2 bytes), 0xFE. ACE replies
+# are below 1 KB, a header announcing more is a false match inside the stream
+FRAME_HEADER = b'\xff\xaa'
+FRAME_MAX_PAYLOAD = 1024
+# Транспорты связи с ACE / ACE link transports
+TRANSPORTS = ('serial', 'tcp', 'pty')
+
+# Учет расхода филамента: период опроса print_stats, сохранения и сглаживание скорости
+# Filament accounting: print_stats sample period, save interval and rate smoothing
+USAGE_SAMPLE_TIME = 2.0
+USAGE_SAVE_INTERVAL = 60.0
+USAGE_RATE_SMOOTHING = 0.2
+
+# Параметры, которые можно задать для отдельного слота (ACE_SET_SLOT_PARAMS / ACE_CALIBRATE)
+# Parameters that can be set per slot (ACE_SET_SLOT_PARAMS / ACE_CALIBRATE)
+SLOT_PARAMS = ('feed_speed', 'retract_speed', 'toolchange_retract_length', 'park_hit_count')
+# Калибровка: запас по времени движения, удержание парковки и запас счетчика
+# Calibration: allowed move time slack, park hold and hit count margin
+CALIBRATE_TIME_SLACK = 1.3
+# Период опроса статуса, пока команда ждет завершения подачи/отката
+# Status poll period while a command waits for a feed/unwind to finish
+ACTION_POLL_TIME = 0.5
+CALIBRATE_PARK_HOLD = 5.0
+CALIBRATE_HIT_MARGIN = 2
+
+# Операции ACE_SEQUENCE: имя -> (метод протокола, условие завершения)
+# ACE_SEQUENCE operations: name -> (protocol method, completion condition)
+#   reply  - ответ устройства, следующие такие шаги отправляются не дожидаясь ответа
+#   motion - устройство снова ready после подачи/отката
+#   park   - парковка к соплу завершена
+#   wait   - пауза
+SEQUENCE_OPS = {
+    'feed': ('feed_filament', 'motion'),
+    'retract': ('unwind_filament', 'motion'),
+    'assist': ('start_feed_assist', 'reply'),
+    'stop_assist': ('stop_feed_assist', 'reply'),
+    'stop_feed': ('stop_feed_filament', 'reply'),
+    'stop_retract': ('stop_unwind_filament', 'reply'),
+    'feed_speed': ('update_feeding_speed', 'reply'),
+    'retract_speed': ('update_unwinding_speed', 'reply'),
+    'park': (None, 'park'),
+    'wait': (None, 'wait'),
+}
+SEQUENCE_PARK_TIMEOUT = 30.0
+# Конечные состояния слота в ACE_PRELOAD
+# Final slot states of ACE_PRELOAD
+PRELOAD_DONE_STATES = ('staged', 'ready', 'loaded', 'empty', 'error')
+
+# Фазы смены инструмента в журнале намерений (ace_toolchange_intent), записываются
+# до шага и заменяются следующей фазой после него
+# Toolchange intent phases (ace_toolchange_intent), written before each step:
+#   retract - старый слот откатывается / the old slot is being retracted
+#   park    - старый слот откачен, новый паркуется / old retracted, new one parking
+#   post    - новый слот у головы, выполняется макрос / new slot parked, post macro runs
+INTENT_PHASES = ('retract', 'park', 'post')
+
+# События слотов и сушилки: имя события Klipper -> опция ace.cfg с макросом
+# Slot and dryer events: Klipper event name -> ace.cfg option naming a macro
+SLOT_EVENTS = {
+    'ace:slot_changed': 'on_slot_changed',
+    'ace:runout': 'on_runout',
+    'ace:dryer_done': 'on_dryer_done',
+}
+# ace:dryer_done - только завершение сушки: остаток в последнем статусе (с) не больше
+# этого, и остановку не запросил модуль (ACE_STOP_DRYING, пауза очереди на печать)
+# ace:dryer_done means the dryer finished: the last reported remain_time (s) is at
+# most this, and the stop was not requested (ACE_STOP_DRYING, queue paused for a print)
+DRYER_DONE_REMAIN = 60
+RECOVERY_PARK_TIMEOUT = 30.0
+
+# Границы гистограмм метрик (секунды)
+# Metrics histogram bucket bounds (seconds)
+REQUEST_RTT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+TOOLCHANGE_BUCKETS = (5.0, 10.0, 15.0, 20.0, 30.0, 45.0, 60.0, 90.0, 120.0)
+# Площадь сечения филамента 1.75 мм (мм²) для перевода объема промывки в длину
+# Cross-section of 1.75mm filament (mm²), converts purge volume to length
+FILAMENT_AREA = math.pi * 0.875 ** 2
+# Анализ G-code перед печатью: строк за шаг планировщика, пауза между шагами,
+# размер кэша планов и длина последовательности инструментов в статусе
+# Pre-print G-code analysis: lines per scheduler step, delay between steps,
+# plan cache size and tool sequence length in the status
+PLAN_CHUNK_LINES = 2000
+PLAN_CHUNK_DELAY = 0.005
+PLAN_CACHE_SIZE = 8
+PLAN_STATUS_TOOLS = 100
+# Журнал событий: типы записей (номер типа хранится в заголовке), заголовок записи
+# (длина данных, unix time, тип, CRC32 полей заголовка и данных) и период записи
+# накопленных событий на диск
+# Event journal: record types (the index is stored in the header), record header
+# (payload length, unix time, type, CRC32 of the header fields and payload) and
+# how often buffered records are written
+JOURNAL_TYPES = ('toolchange', 'park', 'runout', 'infinity_swap', 'reconnect', 'drying')
+JOURNAL_HEADER = struct.Struct('<HdBI')
+JOURNAL_FIELDS = struct.Struct('<HdB')
+JOURNAL_FLUSH_INTERVAL = 5.0
+# Профили сушки по материалу: стадии (температура °C, минуты, скорость вентилятора);
+# температура ограничивается max_dryer_temperature, drying_profile_<материал> заменяет профиль
+# Drying profiles by material: stages of (temp °C, minutes, fan speed); temperatures
+# are capped by max_dryer_temperature, drying_profile_<material> overrides a profile
+DRYING_FAN_SPEED = 7000
+DRYING_PROFILES = {
+    'PLA': ((45, 240, DRYING_FAN_SPEED),),
+    'PETG': ((55, 240, DRYING_FAN_SPEED),),
+    'ABS': ((55, 240, DRYING_FAN_SPEED),),
+    'ASA': ((55, 240, DRYING_FAN_SPEED),),
+    'TPU': ((50, 300, DRYING_FAN_SPEED),),
+    'PA': ((55, 360, DRYING_FAN_SPEED), (45, 120, DRYING_FAN_SPEED)),
+    'PC': ((55, 360, DRYING_FAN_SPEED),),
+}
+DRYING_CHECK_INTERVAL = 10.0
+DRYING_SAVE_INTERVAL = 60.0
+
+
 class ValgAce:
     """
     Модуль ValgAce для Klipper
@@ -41,6 +167,9 @@ class ValgAce:
             self.logger.warning("save_variables module not found, variables will not persist across restarts")
         self.read_buffer = bytearray()
         self.send_time = 0
+        # Время приема последних данных из порта (для меток времени событий)
+        # Receive time of the latest bytes from the port (event timestamps)
+        self._last_rx_time = 0.
         self._last_status_request = 0
 
         # Параметры таймаутов
@@ -50,9 +179,25 @@ class ValgAce:
         self._write_timeout = config.getfloat('write_timeout', 0.5)
         self._max_queue_size = config.getint('max_queue_size', 20)
 
+        # Режим демона: порт принадлежит ace_daemon.py, подключаемся к его сокету
+        # Daemon mode: ace_daemon.py owns the port, connect to its socket instead
+        self.daemon_socket = config.get('daemon_socket', None)
+        # Транспорт: serial (USB), tcp (сетевой мост последовательного порта), pty (эмулятор)
+        # Transport: serial (USB), tcp (network serial bridge), pty (emulator)
+        self.transport = config.getchoice('transport', {t: t for t in TRANSPORTS}, 'serial')
+        self.tcp_address = config.get('tcp_address', None)
+        if self.transport == 'tcp' and not self.daemon_socket:
+            if not self.tcp_address or ':' not in self.tcp_address:
+                raise config.error("transport: tcp requires tcp_address: <host>:<port>")
+        # Размер одного чтения из порта; весь накопленный ответ забирается за один вызов
+        # Size of one port read; a whole pending reply is taken in a single call
+        self.read_chunk_size = config.getint('read_chunk_size', 4096, minval=16)
+        self.serial_low_latency = config.getboolean('serial_low_latency', True)
+
         # Автопоиск устройства
         # Auto-detect device
-        default_serial = self._find_ace_device()
+        default_serial = None if self.daemon_socket or self.transport != 'serial' \
+            else self._find_ace_device()
         self.serial_name = config.get('serial', default_serial or '/dev/ttyACM0')
         self.baud = config.getint('baud', 115200)
 
@@ -63,14 +208,84 @@ class ValgAce:
         self.retract_mode = config.getint('retract_mode', 0)
         self.toolchange_retract_length = config.getint('toolchange_retract_length', 100)
         self.park_hit_count = config.getint('park_hit_count', 5)
+        self._park_hit_target = self.park_hit_count
         self.max_dryer_temperature = config.getint('max_dryer_temperature', 55)
         self.disable_assist_after_toolchange = config.getboolean('disable_assist_after_toolchange', True)
         self.infinity_spool_mode = config.getboolean ('infinity_spool_mode', False)
+        # Остаток (мм), при котором следующий слот infinity spool готовится заранее
+        # Remaining length (mm) at which the next infinity spool slot is staged
+        self.runout_warning_length = config.getfloat('runout_warning_length', 5000., minval=0.)
+        # Длина предварительной подачи следующего слота (0 = только проверка слота)
+        # Pre-feed length for the staged slot (0 = only verify the slot)
+        self.stage_feed_length = config.getint('stage_feed_length', 0, minval=0)
+        # Сколько слотов ACE_PRELOAD подает одновременно (прошивка Pro выполняет одно движение)
+        # How many slots ACE_PRELOAD feeds at once (the stock firmware runs one move at a time)
+        self.preload_parallel = config.getint('preload_parallel', 1, minval=1, maxval=4)
+        # Совмещенная смена инструмента: парковка нового слота начинается, когда старый
+        # филамент по расчету отката прошел toolchange_overlap_length (до конца отката)
+        # Overlapped toolchange: the new slot starts parking once the old filament has
+        # been retracted past toolchange_overlap_length (estimated from retract progress)
+        self.toolchange_overlap = config.getboolean('toolchange_overlap', False)
+        self.toolchange_overlap_length = config.getint('toolchange_overlap_length', 0, minval=0)
+        # Проверка плана G-code (инструменты, материал, остаток) в начале печати
+        # Check the G-code tool plan against the slots when a print starts
+        self.print_plan_check = config.getboolean('print_plan_check', True)
+        # Доводить или откатывать прерванную смену инструмента при запуске
+        # Finish or roll back an interrupted toolchange on startup
+        self.toolchange_recovery = config.getboolean('toolchange_recovery', True)
+        # Макросы, вызываемые на события слотов / Macros run on slot events
+        self._event_macros = {}
+        for event, option in SLOT_EVENTS.items():
+            macro = config.get(option, None)
+            if macro:
+                self._event_macros[event] = macro.strip()
+        # Матрица объемов промывки (мм³) по цветам и материалам слотов
+        # Purge volume matrix (mm³) from slot colors and materials
+        purge_min = config.getfloat('purge_min_volume', 70., minval=0.)
+        self._purge = AcePurgeMatrix(
+            purge_min, config.getfloat('purge_max_volume', 600., minval=purge_min),
+            config.getfloat('purge_material_factor', 1.5, minval=1.))
+
+        # Журнал событий ACE (смены, парковки, окончания катушек, сушка), рядом с klippy.log
+        # ACE event journal (toolchanges, parks, runouts, drying), next to klippy.log
+        log_file = self.printer.get_start_args().get('log_file')
+        default_journal = os.path.join(os.path.dirname(log_file), 'ace_journal.bin') \
+            if log_file else None
+        self._journal = AceJournal(config.get('journal_path', default_journal),
+                                   config.getint('journal_max_size', 1024, minval=16) * 1024,
+                                   self.logger)
+
+        # История телеметрии: "разрешение:кол-во точек" через запятую
+        # Telemetry history tiers: comma separated "resolution:points"
+        self._history = AceTelemetryHistory(
+            self._parse_history_tiers(config, config.get('history_tiers', '1:3600,60:1440')))
 
         # Состояние устройства
         # Device state
         self._info = self._get_default_info()
+        # Заглушки слотов в _info не сравниваются до первого ответа со статусом
+        # The placeholder slots in _info are not compared until the first status reply
+        self._slots_received = False
+        # Причина запрошенной остановки сушилки: 'done', 'stopped', 'paused'
+        # Reason of a requested dryer stop: 'done', 'stopped' or 'paused'
+        self._dryer_stop_reason = None
         self._callback_map = {}
+        # Время отправки запросов, ожидающих ответа (для RTT и таймаутов)
+        # Send time of requests awaiting a reply (RTT and timeouts)
+        self._request_sent = {}
+        self._last_timeout_check = 0.
+        self._metrics = AceMetrics()
+        # Профилирование таймеров и колбэков в реакторе (ACE_PROFILE)
+        # Reactor time profiling of timers and callbacks (ACE_PROFILE)
+        self._profiler = AceProfiler(self.reactor, config.getboolean('profile', False))
+        # Единый таймер реактора для всех отложенных задач ACE
+        # Single reactor timer for all delayed ACE work
+        self._scheduler = AceScheduler(self.reactor, self._profiler, self.logger)
+        # Планировщик сушки в простое принтера / Idle-time drying scheduler
+        self._drying = AceDryingScheduler(
+            self, self._parse_drying_profiles(config),
+            config.getboolean('drying_auto', False),
+            config.getfloat('drying_idle_delay', 600., minval=0.))
         self._request_id = 0
         self._connected = False
         self._connection_attempts = 0
@@ -86,6 +301,54 @@ class ValgAce:
         self._park_is_toolchange = False
         self._park_previous_tool = -1
         self._park_index = -1
+        self._park_assist_started = False
+
+        # Кэш информации о филаменте (RFID) по слотам
+        # Per-slot RFID filament info cache
+        self._filament_info = [None] * 4
+        self._filament_info_pending = {}
+
+        # Учет расхода филамента по слотам (мм), сохраняется в save_variables
+        # Per-slot filament accounting (mm), persisted through save_variables
+        self._print_stats = None
+        self._usage_call = None
+        self._last_filament_used = None
+        self._last_usage_time = 0.
+        self._last_usage_save = 0.
+        self._usage_dirty = False
+        self._slot_used = self._load_slot_list('ace_slot_used', 0.)
+        self._slot_remaining = self._load_slot_list('ace_slot_remaining', None)
+        self._slot_rate = [0.] * 4
+        self._staged_slot = -1
+        self._staged_from = -1
+        # Состояние предзагрузки слотов (ACE_PRELOAD): idle/checking/info/queued/feeding/staged/...
+        # Per-slot preload state (ACE_PRELOAD): idle/checking/info/queued/feeding/staged/...
+        self._preload_slots = [{'state': 'idle', 'error': ''} for _ in range(4)]
+        self._preload = None
+        self._purge.load_overrides(self.variables.get('ace_purge_overrides'))
+        # Планы G-code по (путь, mtime, размер) и план текущей печати
+        # G-code plans keyed by (path, mtime, size) and the plan of the current print
+        self._plans = {}
+        self._print_plan = None
+        self._print_plan_issues = []
+        self._last_print_state = None
+        # Журнал намерений смены инструмента: непустой после запуска = смена была прервана
+        # Toolchange intent log: still set on startup = the change was interrupted
+        intent = self.variables.get('ace_toolchange_intent')
+        self._intent = intent if isinstance(intent, dict) and intent.get('phase') in INTENT_PHASES \
+            else None
+        self._recover_on_status = self._intent is not None and self.toolchange_recovery
+        self._recovering = False
+
+        # Параметры по слотам (калибровка или ACE_SET_SLOT_PARAMS), None = глобальные
+        # Per-slot parameters (calibration or ACE_SET_SLOT_PARAMS), None = global values
+        self._slot_params = self._load_slot_params()
+        # Отсчеты статуса (время, счетчик, статус) во время ACE_CALIBRATE
+        # Status samples (time, count, status) while ACE_CALIBRATE runs
+        self._calibration_samples = None
+        # Команды, ожидающие завершения подачи/отката по ответам get_status (WAIT=1)
+        # Commands waiting for a feed/unwind to finish, driven by get_status replies (WAIT=1)
+        self._action_waiters = []
 
         # Очереди
         # Queues
@@ -104,7 +367,7 @@ class ValgAce:
 
         # Подключение при запуске
         # Connect on startup
-        self.reactor.register_timer(self._connect_check, self.reactor.NOW)
+        self._scheduler.call_at(self.reactor.NOW, self._connect_check, 'connect_check')
         
         # Инициализация флага для избежания дублирования dwell таймеров
         self._dwell_scheduled = False
@@ -139,12 +402,52 @@ class ValgAce:
             } for i in range(4)]
         }
 
+    def _parse_history_tiers(self, config, value: str):
+        tiers = []
+        try:
+            for item in value.split(','):
+                resolution, points = item.split(':')
+                tiers.append((float(resolution), int(points)))
+        except ValueError:
+            raise config.error(f"Invalid history_tiers '{value}', expected e.g. '1:3600,60:1440'")
+        if not tiers or any(res <= 0 or points <= 0 for res, points in tiers):
+            raise config.error(f"Invalid history_tiers '{value}'")
+        return tiers
+
+    def _parse_drying_profiles(self, config) -> Dict[str, tuple]:
+        profiles = {name: tuple((min(temp, self.max_dryer_temperature), minutes, fan)
+                                for temp, minutes, fan in stages)
+                    for name, stages in DRYING_PROFILES.items()}
+        for option in config.get_prefix_options('drying_profile_'):
+            value = config.get(option)
+            stages = []
+            try:
+                for item in value.split(','):
+                    parts = [int(v) for v in item.split(':')]
+                    if len(parts) not in (2, 3):
+                        raise ValueError(item)
+                    stages.append((parts[0], parts[1], parts[2] if len(parts) == 3 else DRYING_FAN_SPEED))
+            except ValueError:
+                raise config.error(f"Invalid {option} '{value}', expected e.g. '55:240:7000,45:120'")
+            if any(not 20 <= temp <= self.max_dryer_temperature or minutes < 1 or fan < 0
+                   for temp, minutes, fan in stages):
+                raise config.error(f"Invalid {option} '{value}': temperature must be "
+                                   f"20-{self.max_dryer_temperature}, duration at least 1 minute")
+            profiles[option[len('drying_profile_'):].upper()] = tuple(stages)
+        return profiles
+
     def _register_handlers(self):
         """
         Регистрация обработчиков событий принтера
         """
         self.printer.register_event_handler('klippy:ready', self._handle_ready)
         self.printer.register_event_handler('klippy:disconnect', self._handle_disconnect)
+        # Эндпоинт API Klipper для Moonraker (/server/ace/history)
+        # Klipper API endpoint used by Moonraker (/server/ace/history)
+        webhooks = self.printer.lookup_object('webhooks')
+        webhooks.register_endpoint('ace/history', self._handle_history_request)
+        webhooks.register_endpoint('ace/metrics', self._handle_metrics_request)
+        webhooks.register_endpoint('ace/journal', self._handle_journal_request)
 
     def _register_gcode_commands(self):
         commands = [
@@ -152,6 +455,8 @@ class ValgAce:
             ('ACE_STATUS', self.cmd_ACE_STATUS, "Get device status"),
             ('ACE_START_DRYING', self.cmd_ACE_START_DRYING, "Start drying"),
             ('ACE_STOP_DRYING', self.cmd_ACE_STOP_DRYING, "Stop drying"),
+            ('ACE_DRY', self.cmd_ACE_DRY, "Queue drying by material profile (PROFILE=, INDEX=), runs when the printer is idle"),
+            ('ACE_DRY_QUEUE', self.cmd_ACE_DRY_QUEUE, "Show drying profiles and queue (CLEAR=1 empties it)"),
             ('ACE_ENABLE_FEED_ASSIST', self.cmd_ACE_ENABLE_FEED_ASSIST, "Enable feed assist"),
             ('ACE_DISABLE_FEED_ASSIST', self.cmd_ACE_DISABLE_FEED_ASSIST, "Disable feed assist"),
             ('ACE_PARK_TO_TOOLHEAD', self.cmd_ACE_PARK_TO_TOOLHEAD, "Park filament to toolhead"),
@@ -164,7 +469,19 @@ class ValgAce:
             ('ACE_CHANGE_TOOL', self.cmd_ACE_CHANGE_TOOL, "Change tool"),
             ('ACE_INFINITY_SPOOL', self.cmd_ACE_INFINITY_SPOOL, "Change tool when current spool is empty"),
             ('ACE_SET_INFINITY_SPOOL_ORDER', self.cmd_ACE_SET_INFINITY_SPOOL_ORDER, "Set infinity spool slot order"),
-            ('ACE_FILAMENT_INFO', self.cmd_ACE_FILAMENT_INFO, "Show filament info"),
+            ('ACE_FILAMENT_INFO', self.cmd_ACE_FILAMENT_INFO, "Show filament info (INDEX=n or ALL=1)"),
+            ('ACE_SLOT_USAGE', self.cmd_ACE_SLOT_USAGE, "Show per-slot filament usage"),
+            ('ACE_SET_SLOT_REMAINING', self.cmd_ACE_SET_SLOT_REMAINING, "Set remaining filament length of a slot"),
+            ('ACE_SET_SLOT_PARAMS', self.cmd_ACE_SET_SLOT_PARAMS, "Set per-slot speeds, retract length and park hit count"),
+            ('ACE_CALIBRATE', self.cmd_ACE_CALIBRATE, "Calibrate speeds and park hit count of a slot"),
+            ('ACE_PROFILE', self.cmd_ACE_PROFILE, "Reactor time profile of ACE timers and callbacks"),
+            ('ACE_PURGE_MATRIX', self.cmd_ACE_PURGE_MATRIX, "Show the purge volume matrix"),
+            ('ACE_SET_PURGE_VOLUME', self.cmd_ACE_SET_PURGE_VOLUME, "Override the purge volume of a slot pair"),
+            ('ACE_PRELOAD', self.cmd_ACE_PRELOAD, "Verify slots and pre-feed them to the staging point (SLOTS=0,1,2,3)"),
+            ('ACE_RECOVER_TOOLCHANGE', self.cmd_ACE_RECOVER_TOOLCHANGE, "Finish or roll back an interrupted toolchange (CLEAR=1 drops it)"),
+            ('ACE_JOURNAL', self.cmd_ACE_JOURNAL, "Show ACE events from the journal (TYPE=, HOURS=, LIMIT=, SUMMARY=1)"),
+            ('ACE_PRINT_PLAN', self.cmd_ACE_PRINT_PLAN, "Analyze the tool plan of a G-code file and check it against the slots"),
+            ('ACE_SEQUENCE', self.cmd_ACE_SEQUENCE, "Run a list of ACE operations (STEPS=\"feed 0 100 | assist 0 | ...\")"),
         ]
         for name, func, desc in commands:
             self.gcode.register_command(name, func, desc=desc)
@@ -199,16 +516,11 @@ class ValgAce:
             return True
         for attempt in range(self._max_connection_attempts):
             try:
-                self._serial = serial.Serial(
-                    port=self.serial_name,
-                    baudrate=self.baud,
-                    timeout=0,
-                    write_timeout=self._write_timeout
-                )
+                self._serial = self._open_transport()
                 if self._serial.is_open:
                     self._connected = True
                     self._info['status'] = 'ready'
-                    self.logger.info(f"Connected to ACE at {self.serial_name}")
+                    self.logger.info(f"Connected to ACE at {self._transport_target()} ({self._serial.name})")
 
                     def info_callback(response):
                         res = response['result']
@@ -217,9 +529,11 @@ class ValgAce:
                         self.send_request({"method": "get_info"}, info_callback)
 
                     if self._reader_timer is None:
-                        self._reader_timer = self.reactor.register_timer(self._reader_loop, self.reactor.NOW)
+                        self._reader_timer = self.reactor.register_timer(
+                            self._profiler.timer('reader_loop', self._reader_loop), self.reactor.NOW)
                     if self._writer_timer is None:
-                        self._writer_timer = self.reactor.register_timer(self._writer_loop, self.reactor.NOW)
+                        self._writer_timer = self.reactor.register_timer(
+                            self._profiler.timer('writer_loop', self._writer_loop), self.reactor.NOW)
                         
                     self.logger.info("Connection established successfully")
                     return True
@@ -229,6 +543,21 @@ class ValgAce:
         self.logger.info("Failed to connect to ACE device")
         return False
 
+    def _open_transport(self) -> 'AceTransport':
+        if self.daemon_socket:
+            return AceDaemonPort(self.daemon_socket, self._write_timeout)
+        if self.transport == 'tcp':
+            return AceTcpTransport(self.tcp_address, self._write_timeout)
+        if self.transport == 'pty':
+            return AcePtyTransport(self.serial_name, self._write_timeout)
+        return AceSerialTransport(self.serial_name, self.baud, self._write_timeout,
+                                  self.serial_low_latency, self.logger)
+
+    def _transport_target(self) -> str:
+        if self.daemon_socket:
+            return self.daemon_socket
+        return self.tcp_address if self.transport == 'tcp' else self.serial_name
+
     def _disconnect(self):
         if not self._connected:
             return
@@ -245,21 +574,53 @@ class ValgAce:
         except Exception as e:
             self.logger.info(f"Disconnect error: {str(e)}")
 
-    def _save_variable(self, name: str, value):
-        """Safely save variable if save_variables module is available"""
+    def _save_variable(self, name: str, value, defer: bool = False):
+        """
+        Safely save variable if save_variables module is available
+        defer=True - вызов вне команды G-code (таймеры, цикл чтения): SAVE_VARIABLE
+        запускается отдельным скриптом через reactor, как макросы событий
+        defer=True: called outside a G-code command (timers, reader loop), so
+        SAVE_VARIABLE runs as its own script from a reactor callback
+        """
         self.variables[name] = value
+        if not isinstance(value, (int, float)):
+            # save_variables разбирает VALUE через literal_eval: строки и списки
+            # передаем как литерал Python в кавычках (одним параметром G-code)
+            value = '"%s"' % (repr(value),)
+        script = f'SAVE_VARIABLE VARIABLE={name} VALUE={value}'
+        if defer:
+            self.reactor.register_callback(
+                lambda eventtime: self._run_save_script(name, script))
+            return
         try:
-            self.gcode.run_script_from_command(f'SAVE_VARIABLE VARIABLE={name} VALUE={value}')
+            self.gcode.run_script_from_command(script)
         except Exception as e:
             # save_variables not available or error saving
             self.logger.debug(f"Could not save variable {name}: {e}")
 
+    def _run_save_script(self, name: str, script: str):
+        try:
+            self.gcode.run_script(script)
+        except Exception as e:
+            self.logger.debug(f"Could not save variable {name}: {e}")
+
     def _handle_ready(self):
         self.toolhead = self.printer.lookup_object('toolhead')
         if self.toolhead is None:
             raise self.printer.config_error("Toolhead not found in ValgAce module")
+        self._print_stats = self.printer.lookup_object('print_stats', None)
+        if self._print_stats is not None:
+            self._usage_call = self._scheduler.call_at(
+                self.reactor.NOW, self._usage_timer_event, 'usage_timer')
+        self._scheduler.call_later(JOURNAL_FLUSH_INTERVAL, self._journal_flush_event, 'journal_flush')
+        self._drying.start()
+        for event, macro in self._event_macros.items():
+            if self.printer.lookup_object(f'gcode_macro {macro}', None) is None:
+                raise self.printer.config_error(
+                    f"Macro '{macro}' for {SLOT_EVENTS[event]} is not defined")
 
     def _handle_disconnect(self):
+        self._journal.flush()
         self._disconnect()
 
     def get_status(self, eventtime):
@@ -297,7 +658,23 @@ class ValgAce:
             'feed_assist_slot': self._feed_assist_index,  # Индекс слота с активным feed assist (-1 = выключен)
             'dryer': dryer_normalized,
             'dryer_status': dryer_normalized,
-            'slots': self._info.get('slots', [])
+            'slots': self._info.get('slots', []),
+            'filament_info': [dict(info) if info else None for info in self._filament_info],
+            'slot_usage': [{
+                'used': round(self._slot_used[i], 1),
+                'remaining': None if self._slot_remaining[i] is None else round(self._slot_remaining[i], 1),
+                'runout_eta': self._runout_eta(i),
+            } for i in range(4)],
+            'staged_slot': self._staged_slot,
+            'drying_queue': self._drying.get_status(),
+            'preload': {'active': self._preload is not None,
+                        'slots': [dict(slot) for slot in self._preload_slots]},
+            'slot_params': [{name: self._slot_param(i, name) for name in SLOT_PARAMS} for i in range(4)],
+            'purge_matrix': self._purge.matrix,
+            'toolchange_intent': self._intent,
+            'print_plan': None if self._print_plan is None
+                else dict(self._print_plan.get_status(), issues=self._print_plan_issues),
+            'profile': self._profiler.get_status(eventtime)
         }
 
     def _calc_crc(self, buffer: bytes) -> int:
@@ -316,6 +693,7 @@ class ValgAce:
     def send_request(self, request: Dict[str, Any], callback: Callable):
         if self._queue.qsize() >= self._max_queue_size:
             self.logger.info("Request queue overflow, clearing...")
+            self._metrics.queue_overflows += 1
             while not self._queue.empty():
                 _, cb = self._queue.get_nowait()
                 if cb:
@@ -351,6 +729,7 @@ class ValgAce:
         try:
             if self._serial and self._serial.is_open:
                 self._serial.write(packet)
+                self._metrics.frames_sent += 1
                 return True
             else:
                 raise SerialException("Serial port closed")
@@ -363,54 +742,72 @@ class ValgAce:
         if not self._connected or not self._serial or not self._serial.is_open:
             return eventtime + 0.01
         try:
-            raw_bytes = self._serial.read(16)
+            raw_bytes = self._serial.read(self.read_chunk_size)
             if raw_bytes:
+                self._last_rx_time = self.reactor.monotonic()
                 self.read_buffer.extend(raw_bytes)
-                self._process_messages()
+                if self._profiler.enabled:
+                    self._profiler.call('process_messages', self._process_messages)
+                else:
+                    self._process_messages()
         except SerialException as e:
             self.logger.info(f"Read error: {str(e)}")
             self._reconnect()
         return eventtime + 0.01
 
     def _process_messages(self):
-        incomplete_message_count = 0
-        max_incomplete_messages_before_reset = 10
-        while self.read_buffer:
-            end_idx = self.read_buffer.find(b'\xfe')
-            if end_idx == -1:
+        """
+        Разбор кадров по заголовку длины (0xFE может встречаться внутри JSON и CRC)
+        Frames are cut by their length header, 0xFE may occur inside the CRC or payload;
+        a header whose terminator is not where its length says is skipped byte by byte
+        """
+        buffer = self.read_buffer
+        pos = 0
+        while True:
+            start = buffer.find(FRAME_HEADER, pos)
+            if start == -1:
+                # Последний 0xFF может быть началом следующего заголовка
+                # A trailing 0xFF may start the next header
+                pos = len(buffer) - 1 if buffer.endswith(FRAME_HEADER[:1]) else len(buffer)
                 break
-            msg = self.read_buffer[:end_idx+1]
-            self.read_buffer = self.read_buffer[end_idx+1:]
-            if len(msg) < 7 or msg[0:2] != bytes([0xFF, 0xAA]):
+            if len(buffer) - start < 4:
+                pos = start
+                break
+            payload_len = struct.unpack_from('<H', buffer, start + 2)[0]
+            end = start + 4 + payload_len + 3
+            if payload_len > FRAME_MAX_PAYLOAD:
+                pos = start + 1
                 continue
-            payload_len = struct.unpack('<H', msg[2:4])[0]
-            expected_length = 4 + payload_len + 3
-            if len(msg) < expected_length:
-                self.logger.info(f"Incomplete message received (expected {expected_length}, got {len(msg)})")
-                incomplete_message_count += 1
-                if incomplete_message_count > max_incomplete_messages_before_reset:
-                    self.logger.info("Too many incomplete messages, resetting connection")
-                    self._reset_connection()
-                    incomplete_message_count = 0
+            if len(buffer) < end:
+                # Ждем остаток кадра / Wait for the rest of the frame
+                pos = start
+                break
+            if buffer[end - 1] != 0xFE:
+                self._metrics.incomplete_frames += 1
+                pos = start + 1
                 continue
-            incomplete_message_count = 0
-            payload = msg[4:4+payload_len]
-            crc = struct.unpack('<H', msg[4+payload_len:4+payload_len+2])[0]
+            pos = end
+            payload = bytes(buffer[start + 4:start + 4 + payload_len])
+            crc = struct.unpack_from('<H', buffer, start + 4 + payload_len)[0]
             if crc != self._calc_crc(payload):
-                return
+                self._metrics.crc_errors += 1
+                continue
             try:
                 response = json.loads(payload.decode('utf-8'))
+                self._metrics.frames_received += 1
                 self._handle_response(response)
             except json.JSONDecodeError as je:
-                self.logger.info(f"JSON decode error: {str(je)} Data: {msg}")
+                self.logger.info(f"JSON decode error: {str(je)} Data: {payload}")
             except Exception as e:
-                self.logger.info(f"Message processing error: {str(e)} Data: {msg}")
+                self.logger.info(f"Message processing error: {str(e)} Data: {payload}")
+        if pos:
+            del buffer[:pos]
 
     def _writer_loop(self, eventtime):
         if not self._connected:
             return eventtime + 0.05
         now = eventtime
-        if now - self._last_status_request > (0.2 if self._park_in_progress else 1.0):
+        if now - self._last_status_request > self._status_interval():
             self._request_status()
             self._last_status_request = now
         if not self._queue.empty():
@@ -418,16 +815,42 @@ class ValgAce:
             if task:
                 request, callback = task
                 self._callback_map[request['id']] = callback
-                if not self._send_request(request):
+                if self._send_request(request):
+                    self._request_sent[request['id']] = now
+                else:
                     self.logger.info("Failed to send request, requeuing...")
                     self._queue.put(task)
+        if now - self._last_timeout_check > 1.0:
+            self._check_request_timeouts(now)
         return eventtime + 0.05
 
+    def _check_request_timeouts(self, now: float):
+        """
+        Учитывает запросы без ответа дольше response_timeout (колбэк остается на случай позднего ответа)
+        Counts requests unanswered for longer than response_timeout
+        """
+        self._last_timeout_check = now
+        expired = [request_id for request_id, sent in self._request_sent.items()
+                   if now - sent > self._response_timeout]
+        for request_id in expired:
+            del self._request_sent[request_id]
+        self._metrics.request_timeouts += len(expired)
+
+    def _status_interval(self) -> float:
+        # Частый опрос во время парковки и калибровки
+        # Poll faster while parking or calibrating
+        if self._park_in_progress:
+            return 0.2
+        if self._calibration_samples is not None or self._action_waiters:
+            return ACTION_POLL_TIME
+        return 1.0
+
     def _request_status(self):
         def status_callback(response):
-            if 'result' in response:
-                self._info.update(response['result'])
-        if self.reactor.monotonic() - self._last_status_request > (0.2 if self._park_in_progress else 1.0):
+            # Ответ применяется в _handle_response, после сравнения с прошлым статусом
+            # The reply is applied by _handle_response, after the slot event diff
+            pass
+        if self.reactor.monotonic() - self._last_status_request > self._status_interval():
             try:
                 self.send_request({
                     "id": self._get_next_request_id(),
@@ -439,10 +862,16 @@ class ValgAce:
 
     def _handle_response(self, response: dict):
         if 'id' in response:
+            sent = self._request_sent.pop(response['id'], None)
+            if sent is not None:
+                self._metrics.request_rtt.observe(self._last_rx_time - sent)
             callback = self._callback_map.pop(response['id'], None)
             if callback:
                 try:
-                    callback(response)
+                    if self._profiler.enabled:
+                        self._profiler.call(self._profiler.callback_name(callback), callback, response)
+                    else:
+                        callback(response)
                 except Exception as e:
                     self.logger.info(f"Callback error: {str(e)}")
         if 'result' in response and isinstance(response['result'], dict):
@@ -459,7 +888,22 @@ class ValgAce:
             # Нормализация данных о сушилке: если приходит dryer_status, сохраняем также как dryer
             if 'dryer_status' in result and isinstance(result['dryer_status'], dict):
                 result['dryer'] = result['dryer_status']
+            self._publish_slot_events(result)
+            if isinstance(result.get('slots'), list):
+                self._update_filament_info_cache(result['slots'])
+                self._purge.update(result['slots'])
             self._info.update(result)
+            if self._recover_on_status and isinstance(result.get('slots'), list):
+                self._recover_on_status = False
+                self._recover_intent()
+            if 'temp' in result:
+                self._publish_temperature(result['temp'])
+                self._record_history()
+            if self._action_waiters and 'status' in result:
+                self._notify_action_waiters(result)
+            if self._calibration_samples is not None and 'feed_assist_count' in result:
+                self._calibration_samples.append(
+                    (self._last_rx_time, result['feed_assist_count'], result.get('status')))
             if self._park_in_progress:
                 current_status = result.get('status', 'unknown')
                 current_assist_count = result.get('feed_assist_count', 0)
@@ -484,11 +928,12 @@ class ValgAce:
                             # 3 seconds passed and count never increased - feed assist not working
                             self.logger.error(f"Feed assist for slot {self._park_index} not working - count stayed at {current_assist_count}")
                             self._park_error = True  # Mark as error BEFORE resetting flag
+                            self._park_failed(self._park_index, 'assist not working')
                             self._park_in_progress = False
                             self._park_index = -1
                             return
                         
-                        if self._assist_hit_count >= self.park_hit_count:
+                        if self._assist_hit_count >= self._park_hit_target:
                             # Only complete if count actually increased
                             if self._park_count_increased:
                                 self._complete_parking()
@@ -496,6 +941,7 @@ class ValgAce:
                                 self.logger.warning(f"Parking check completed but count never increased (stayed at {current_assist_count})")
                                 # Mark as error and abort
                                 self._park_error = True
+                                self._park_failed(self._park_index, 'count never increased')
                                 self._park_in_progress = False
                             return
                         # Проверяем, что таймер не будет создаваться бесконечно
@@ -504,10 +950,511 @@ class ValgAce:
                             self._dwell_scheduled = True
                             self.dwell(0.7, lambda: setattr(self, '_dwell_scheduled', False))
 
+    def _publish_temperature(self, temp):
+        """
+        Публикует температуру сушилки событием ace:temperature
+        Publishes the dryer temperature as an ace:temperature event,
+        stamped with the time the reply was received
+        """
+        try:
+            temp = float(temp)
+        except (TypeError, ValueError):
+            return
+        self.printer.send_event('ace:temperature', self._last_rx_time, temp)
+
+    def _publish_slot_events(self, result: dict):
+        """
+        Сравнивает ответ со статусом с предыдущим и публикует переходы
+        Compares a status reply with the previous one and publishes the transitions
+        as Klipper events, stamped with the receive time:
+          ace:slot_changed (eventtime, index, old, new) - changed slot fields only
+          ace:runout       (eventtime, index, old, new) - slot went ready -> empty
+          ace:dryer_done   (eventtime, old, new)        - drying finished
+        """
+        eventtime = self._last_rx_time
+        old_slots, new_slots = self._info.get('slots'), result.get('slots')
+        if not isinstance(new_slots, list):
+            pass
+        elif not self._slots_received:
+            self._slots_received = True
+        elif isinstance(old_slots, list):
+            for index, (old_slot, new_slot) in enumerate(zip(old_slots, new_slots)):
+                if old_slot == new_slot or not isinstance(old_slot, dict) \
+                        or not isinstance(new_slot, dict):
+                    continue
+                fields = [k for k in new_slot if old_slot.get(k) != new_slot[k]]
+                if not fields:
+                    continue
+                old = {k: old_slot.get(k) for k in fields}
+                new = {k: new_slot[k] for k in fields}
+                self._emit_slot_event('ace:slot_changed', (eventtime, index, old, new),
+                                      INDEX=index, FIELDS=','.join(fields),
+                                      **{f'OLD_{k.upper()}': v for k, v in old.items()},
+                                      **{f'NEW_{k.upper()}': v for k, v in new.items()})
+                if old.get('status') == 'ready' and new.get('status') == 'empty':
+                    current = self.variables.get('ace_current_index', -1) == index
+                    self._emit_slot_event('ace:runout', (eventtime, index, old_slot, new_slot),
+                                          INDEX=index, CURRENT=int(current),
+                                          TYPE=old_slot.get('type', ''))
+        old_dryer, new_dryer = self._info.get('dryer'), result.get('dryer')
+        if not isinstance(old_dryer, dict) or not isinstance(new_dryer, dict):
+            return
+        if old_dryer.get('status') != 'drying' and new_dryer.get('status') == 'drying':
+            self._dryer_stop_reason = None
+        elif old_dryer.get('status') == 'drying' and new_dryer.get('status') != 'drying':
+            reason, self._dryer_stop_reason = self._dryer_stop_reason, None
+            if reason is None:
+                reason = 'done' if old_dryer.get('remain_time', 0) <= DRYER_DONE_REMAIN else 'stopped'
+            if reason == 'done':
+                self._emit_slot_event('ace:dryer_done', (eventtime, old_dryer, new_dryer),
+                                      TEMP=old_dryer.get('target_temp', 0),
+                                      REMAIN=old_dryer.get('remain_time', 0))
+
+    def _stop_dryer(self, reason: str, callback: Callable = lambda response: None):
+        """drying_stop с причиной для ace:dryer_done / drying_stop tagged for ace:dryer_done"""
+        self._dryer_stop_reason = reason
+        self.send_request({"method": "drying_stop"}, callback)
+
+    def _emit_slot_event(self, event: str, args: tuple, **params):
+        self.printer.send_event(event, *args)
+        macro = self._event_macros.get(event)
+        if macro is None:
+            return
+        params['TIME'] = round(args[0], 3)
+        line = ' '.join([macro] + [f'{k}={self._format_macro_param(v)}' for k, v in params.items()])
+        # Макрос запускается вне цикла чтения / The macro runs outside the reader loop
+        self.reactor.register_callback(lambda eventtime: self.gcode.run_script(line))
+
+    @staticmethod
+    def _format_macro_param(value) -> str:
+        if isinstance(value, (list, tuple)):
+            value = ','.join(str(v) for v in value)
+        if isinstance(value, str):
+            return '"' + value.replace('"', "'") + '"'
+        return str(value)
+
+    def _update_filament_info_cache(self, slots):
+        """
+        Заполняет кэш при идентификации RFID (rfid=2) и сбрасывает при извлечении катушки
+        Fills the cache when a slot's RFID is identified, drops it when the spool is removed
+        """
+        for slot in slots:
+            index = slot.get('index', -1)
+            if not 0 <= index < len(self._filament_info):
+                continue
+            cached = self._filament_info[index]
+            if slot.get('status') == 'empty' and (self._slot_used[index] or
+                                                  self._slot_remaining[index] is not None):
+                self._journal.append('runout', slot=index, used=round(self._slot_used[index], 1),
+                                     current=self.variables.get('ace_current_index', -1) == index)
+                self._reset_slot_usage(index)
+            if slot.get('status') == 'empty' and self._preload_slots[index]['state'] == 'staged':
+                self._preload_slots[index] = {'state': 'idle', 'error': ''}
+            if slot.get('status') == 'empty' or slot.get('rfid') != 2:
+                if cached is not None:
+                    self.logger.info(f"Filament info for slot {index} invalidated")
+                    self._filament_info[index] = None
+                continue
+            if cached is None or cached.get('sku') != slot.get('sku'):
+                self._fetch_filament_info(index)
+
+    def _fetch_filament_info(self, index: int, callback: Optional[Callable] = None):
+        now = self.reactor.monotonic()
+        if callback is None and now - self._filament_info_pending.get(index, -self._response_timeout) \
+                < self._response_timeout:
+            return
+        self._filament_info_pending[index] = now
+
+        def info_callback(response):
+            self._filament_info_pending.pop(index, None)
+            result = response.get('result')
+            if response.get('code', 0) == 0 and isinstance(result, dict) and result.get('rfid') == 2:
+                self._filament_info[index] = result
+                self._seed_slot_remaining(index, result)
+                self.logger.info(f"Filament info cached for slot {index}: "
+                                 f"{result.get('type', '')} {result.get('sku', '')}")
+            if callback:
+                callback(response)
+        self.send_request({"method": "get_filament_info", "params": {"index": index}}, info_callback)
+
+    def _format_filament_info(self, index: int, info: Optional[Dict[str, Any]]) -> str:
+        if not info:
+            return f"Slot {index}: no RFID filament info"
+        output = [f"Slot {index}: {info.get('type') or 'Unknown'}"]
+        if info.get('brand'):
+            output.append(f"  Brand: {info['brand']}")
+        if info.get('sku'):
+            output.append(f"  SKU: {info['sku']}")
+        color = info.get('color')
+        if isinstance(color, list) and len(color) >= 3:
+            output.append(f"  Color: RGB({color[0]}, {color[1]}, {color[2]})")
+        for key, title in (('extruder_temp', 'Extruder'), ('hotbed_temp', 'Bed')):
+            temps = info.get(key)
+            if isinstance(temps, dict):
+                output.append(f"  {title}: {temps.get('min', '?')}-{temps.get('max', '?')}°C")
+        if info.get('diameter'):
+            output.append(f"  Diameter: {info['diameter']} mm")
+        if 'total' in info:
+            output.append(f"  Length: {info.get('current', 0)}/{info['total']} m")
+        return "\n".join(output)
+
+    def _record_history(self):
+        """Добавляет текущие показания в историю телеметрии"""
+        info = self._info
+        dryer = info.get('dryer') or {}
+        # Буфер упорядочен по монотонному времени реактора: шаги системных часов
+        # (NTP) не ломают поиск; в unix time переводится только при запросе
+        # Rows are keyed on the monotonic reactor clock, so wall-clock steps (NTP)
+        # cannot break the time search; queries convert to unix time
+        self._history.record(self.reactor.monotonic(), (
+            info.get('temp', 0),
+            info.get('fan_speed', 0),
+            1 if dryer.get('status') == 'drying' else 0,
+            dryer.get('target_temp', 0),
+            dryer.get('remain_time', 0) / 60,
+            info.get('feed_assist_count', 0),
+        ))
+
+    def _record_toolchange(self, start_time: float):
+        self._metrics.toolchanges += 1
+        self._metrics.toolchange_duration.observe(self.reactor.monotonic() - start_time)
+
+    def _journal_toolchange(self, was: int, tool: int, marks, error: Optional[str] = None,
+                            overlapped: bool = False):
+        """
+        Запись смены инструмента в журнал с длительностью фаз
+        marks: [(phase, start monotonic time), ...], each phase lasts until the next one
+        """
+        now = self.reactor.monotonic()
+        ends = [start for _, start in marks[1:]] + [now]
+        slots = self._info.get('slots', [])
+        fields = {'from': was, 'to': tool, 'ok': error is None,
+                  'duration': round(now - marks[0][1], 2),
+                  'phases': {name: round(end - start, 2) for (name, start), end in zip(marks, ends)},
+                  'material': str(slots[tool].get('type') or '') if 0 <= tool < len(slots) else ''}
+        if overlapped:
+            fields['overlap'] = True
+        if error is not None:
+            fields['error'] = error
+        self._journal.append('toolchange', **fields)
+
+    def _write_intent(self, kind: str, was: int, tool: int, phase: str, **extra):
+        """Намерение смены записывается на диск до первого шага"""
+        self._intent = dict({'kind': kind, 'from': was, 'to': tool, 'phase': phase}, **extra)
+        self._save_variable('ace_toolchange_intent', self._intent)
+
+    def _intent_phase(self, phase: str):
+        """Предыдущий шаг выполнен: фиксируем его записью следующей фазы"""
+        if self._intent is not None:
+            self._intent = dict(self._intent, phase=phase)
+            self._save_variable('ace_toolchange_intent', self._intent)
+
+    def _commit_intent(self, tool: int, defer: bool = False):
+        """Смена закончена: сохраняем текущий слот и очищаем намерение"""
+        self.variables['ace_current_index'] = tool
+        self._save_variable('ace_current_index', tool, defer)
+        self._intent = None
+        self._save_variable('ace_toolchange_intent', None, defer)
+
+    def _recover_intent(self):
+        """
+        Доводит или откатывает прерванную смену по фазе и статусу слотов
+        retract: the old filament position is unknown -> park the old slot again
+                 (unload: retract it again); park: the old slot is out -> park the
+                 new one; post: the new slot is parked -> only commit it.
+        The purge of _ACE_POST_TOOLCHANGE is never replayed, the toolhead state
+        after a restart is unknown.
+        """
+        intent = self._intent
+        if intent is None or self._recovering:
+            return
+        kind, was, tool, phase = intent.get('kind'), intent.get('from', -1), \
+            intent.get('to', -1), intent.get('phase')
+        slots = self._info.get('slots', [])
+
+        def ready(index: int) -> bool:
+            return 0 <= index < len(slots) and slots[index].get('status') == 'ready'
+
+        self.gcode.respond_info(f"ACE: interrupted {kind} {was} -> {tool} in phase '{phase}', recovering")
+        if phase == 'post':
+            self._finish_recovery(tool, f"slot {tool} was already parked")
+        elif phase == 'park' and tool == -1:
+            self._finish_recovery(-1, f"slot {was} was already retracted")
+        elif phase == 'park':
+            if ready(tool):
+                self._recovery_park(tool, f"slot {tool} parked")
+            else:
+                self._finish_recovery(-1, f"slot {tool} is not ready, no tool loaded")
+        elif tool == -1 and ready(was):
+            # Прерванная выгрузка: откатываем старый слот еще раз
+            # Interrupted unload: retract the old slot again
+            self._recovering = True
+            length = self._slot_param(was, 'toolchange_retract_length')
+            speed = self._slot_param(was, 'retract_speed')
+            self.send_request({"method": "unwind_filament",
+                               "params": {"index": was, "length": length, "speed": speed}},
+                              lambda response: None)
+            self._scheduler.call_later(
+                length / speed + 1.0,
+                lambda eventtime: self._finish_recovery(-1, f"slot {was} retracted"),
+                'intent_recovery')
+        elif ready(was):
+            # Откат к старому слоту: парковка работает независимо от того, где филамент
+            # Roll back to the old slot: parking works wherever the filament is
+            self._recovery_park(was, f"rolled back to slot {was}")
+        else:
+            self._finish_recovery(-1, f"slot {was} is not ready, no tool loaded")
+
+    def _recovery_park(self, index: int, message: str):
+        self._recovering = True
+        self._park_to_toolhead(index)
+        deadline = self.reactor.monotonic() + RECOVERY_PARK_TIMEOUT
+
+        def check(eventtime):
+            if self._park_in_progress and eventtime < deadline:
+                return eventtime + ACTION_POLL_TIME
+            if self._park_in_progress:
+                self._park_failed(index, 'timeout')
+                self.send_request({"method": "stop_feed_assist", "params": {"index": index}},
+                                  lambda response: None)
+                self._park_in_progress = False
+                self._park_index = -1
+                self._park_error = True
+            if self._park_error:
+                self._finish_recovery(-1, f"parking slot {index} failed, no tool loaded")
+            else:
+                self._finish_recovery(index, message)
+            return None
+        self._scheduler.call_later(ACTION_POLL_TIME, check, 'intent_recovery')
+
+    def _finish_recovery(self, tool: int, message: str):
+        # Вызывается из таймера планировщика или цикла чтения, не из команды
+        # Called from a scheduler timer or the reader loop, not from a command
+        intent = self._intent or {}
+        if intent.get('kind') == 'infinity' and tool == intent.get('to') \
+                and intent.get('position') is not None:
+            self._save_variable('ace_infsp_position', intent['position'], defer=True)
+        self._recovering = False
+        self._commit_intent(tool, defer=True)
+        self._journal.append('toolchange', **{'from': intent.get('from', -1), 'to': tool,
+                                              'ok': tool == intent.get('to'), 'duration': 0.,
+                                              'phases': {}, 'recovered': intent.get('phase')})
+        self.gcode.respond_info(f"ACE: toolchange recovery done, {message}; current tool {tool}"
+                                + (", purge before printing" if tool != -1 else ""))
+
+    def cmd_ACE_RECOVER_TOOLCHANGE(self, gcmd):
+        if self._intent is None:
+            gcmd.respond_info("No interrupted toolchange")
+            return
+        if gcmd.get_int('CLEAR', 0, minval=0, maxval=1):
+            # Оставить сохраненный ace_current_index как есть
+            # Keep the persisted ace_current_index as is
+            self._recover_on_status = False
+            self._intent = None
+            self._save_variable('ace_toolchange_intent', None)
+            gcmd.respond_info("Interrupted toolchange dropped")
+            return
+        if self._recovering:
+            raise gcmd.error("ACE Error: recovery is already running")
+        self._recover_on_status = False
+        self._recover_intent()
+
+    def _park_failed(self, index: int, reason: str):
+        self._metrics.park_errors += 1
+        self._journal.append('park', slot=index, ok=False, reason=reason,
+                             elapsed=round(self.reactor.monotonic() - self._park_start_time, 2))
+
+    def _handle_metrics_request(self, web_request):
+        """Счетчики связи и смен инструмента, без обращения к устройству"""
+        snapshot = self._metrics.snapshot({
+            'connected': int(self._connected),
+            'queue_depth': self._queue.qsize(),
+            'outstanding_callbacks': len(self._callback_map),
+        })
+        snapshot['transport'] = self._serial.get_status() if self._serial is not None else None
+        web_request.send(snapshot)
+
+    def _handle_history_request(self, web_request):
+        fields = web_request.get_str('fields', None)
+        web_request.send(self._history.query(
+            start=web_request.get_float('start', None),
+            end=web_request.get_float('end', None),
+            resolution=web_request.get_float('resolution', None),
+            fields=fields.split(',') if fields else None,
+            clock_offset=time.time() - self.reactor.monotonic()))
+
+    def _journal_flush_event(self, eventtime):
+        self._journal.flush()
+        return eventtime + JOURNAL_FLUSH_INTERVAL
+
+    def _handle_journal_request(self, web_request):
+        types = web_request.get_str('types', None)
+        web_request.send({'events': self._journal.query(
+            start=web_request.get_float('start', None),
+            end=web_request.get_float('end', None),
+            types=types.split(',') if types else None,
+            limit=web_request.get_int('limit', None))})
+
+    def _load_slot_list(self, name: str, default):
+        """Список из 4 значений по слотам из save_variables"""
+        value = self.variables.get(name)
+        if not isinstance(value, (list, tuple)) or len(value) != 4:
+            return [default] * 4
+        try:
+            return [default if v is None else float(v) for v in value]
+        except (TypeError, ValueError):
+            return [default] * 4
+
+    def _load_slot_params(self):
+        value = self.variables.get('ace_slot_params')
+        if not isinstance(value, (list, tuple)) or len(value) != 4:
+            return [{} for _ in range(4)]
+        return [{k: int(v) for k, v in params.items() if k in SLOT_PARAMS}
+                if isinstance(params, dict) else {} for params in value]
+
+    def _slot_param(self, index: int, name: str) -> int:
+        """Значение параметра для слота: собственное или глобальное из ace.cfg"""
+        value = self._slot_params[index].get(name) if 0 <= index < 4 else None
+        return getattr(self, name) if value is None else value
+
+    def _usage_timer_event(self, eventtime):
+        try:
+            self._update_usage(eventtime)
+        except Exception as e:
+            self.logger.error(f"Filament usage update error: {str(e)}")
+        return eventtime + USAGE_SAMPLE_TIME
+
+    def _update_usage(self, eventtime: Optional[float] = None):
+        """
+        Начисляет выдавленную длину (filament_used из print_stats) текущему слоту
+        Attributes extruded length (print_stats filament_used) to the current slot
+        """
+        if self._print_stats is None:
+            return
+        if eventtime is None:
+            eventtime = self.reactor.monotonic()
+        status = self._print_stats.get_status(eventtime)
+        used = status.get('filament_used', 0.)
+        duration = status.get('total_duration', 0.)
+        last = self._last_filament_used
+        self._last_filament_used = (used, duration)
+        elapsed = eventtime - self._last_usage_time
+        self._last_usage_time = eventtime
+        tool = self.variables.get('ace_current_index', -1)
+        # Счетчик print_stats обнуляется в начале новой печати
+        # print_stats restarts its counters when a new print starts
+        if last is not None and duration >= last[1] and 0 <= tool < 4:
+            delta = used - last[0]
+            if delta:
+                self._slot_used[tool] = max(0., self._slot_used[tool] + delta)
+                if self._slot_remaining[tool] is not None:
+                    self._slot_remaining[tool] = max(0., self._slot_remaining[tool] - delta)
+                self._usage_dirty = True
+            if delta > 0. and elapsed > 0.:
+                rate = delta / elapsed
+                self._slot_rate[tool] = rate if not self._slot_rate[tool] \
+                    else self._slot_rate[tool] + USAGE_RATE_SMOOTHING * (rate - self._slot_rate[tool])
+            self._check_runout(tool)
+        state = status.get('state')
+        if state == 'printing' and self._last_print_state not in ('printing', 'paused'):
+            self._on_print_start()
+        self._last_print_state = state
+        printing = state == 'printing'
+        if self._usage_dirty and (not printing or
+                                  eventtime - self._last_usage_save >= USAGE_SAVE_INTERVAL):
+            self._save_slot_usage(eventtime)
+
+    def _save_slot_usage(self, eventtime: Optional[float] = None):
+        # Сохраняется и из таймера, и из цикла чтения - всегда отдельным скриптом
+        # Saved from the usage timer and the reader loop too, so always deferred
+        self._last_usage_save = self.reactor.monotonic() if eventtime is None else eventtime
+        self._usage_dirty = False
+        self._save_variable('ace_slot_used', [round(v, 1) for v in self._slot_used], defer=True)
+        self._save_variable('ace_slot_remaining',
+                            [None if v is None else round(v, 1) for v in self._slot_remaining],
+                            defer=True)
+
+    def _runout_eta(self, index: int) -> Optional[float]:
+        """Прогноз времени до окончания катушки (с) по текущей скорости расхода"""
+        remaining = self._slot_remaining[index]
+        rate = self._slot_rate[index]
+        if remaining is None or rate <= 0.:
+            return None
+        return round(remaining / rate, 1)
+
+    def _seed_slot_remaining(self, index: int, info: Dict[str, Any]):
+        """Начальный остаток из RFID (метры), если остаток слота еще не известен"""
+        if self._slot_remaining[index] is not None:
+            return
+        length = info.get('current') or info.get('total')
+        try:
+            length = float(length)
+        except (TypeError, ValueError):
+            return
+        if length > 0.:
+            self._slot_remaining[index] = length * 1000.
+            self._slot_used[index] = 0.
+            self._save_slot_usage()
+            self.logger.info(f"Slot {index} remaining length seeded from RFID: {length} m")
+
+    def _reset_slot_usage(self, index: int):
+        self.logger.info(f"Slot {index} is empty, filament usage counters reset")
+        self._slot_used[index] = 0.
+        self._slot_remaining[index] = None
+        self._slot_rate[index] = 0.
+        if self._staged_slot == index:
+            self._staged_slot = -1
+            self._staged_from = -1
+        self._save_slot_usage()
+
+    def _check_runout(self, tool: int):
+        """Готовит следующий слот infinity spool, когда катушка почти закончилась"""
+        remaining = self._slot_remaining[tool]
+        if (not self.infinity_spool_mode or self._staged_from == tool or remaining is None
+                or remaining > self.runout_warning_length or self._park_in_progress):
+            return
+        self._staged_from = tool
+        order_list = self._parse_infinity_order(self.variables.get('ace_infsp_order', ''))
+        if not order_list:
+            return
+        index, _ = self._find_next_infinity_slot(tool, order_list)
+        if index is None or index == tool:
+            self.logger.warning(f"Slot {tool} is running out, no ready slot to stage")
+            return
+        self._stage_slot(tool, index)
+
+    def _stage_slot(self, tool: int, index: int):
+        eta = self._runout_eta(tool)
+        self._staged_slot = index
+        self.gcode.respond_info(
+            f"ACE: slot {tool} is running out ({self._slot_remaining[tool] / 1000:.1f} m left"
+            + (f", ~{eta / 60:.0f} min" if eta is not None else "")
+            + f"), staging slot {index}")
+        if self._info['slots'][index].get('rfid') == 2:
+            self._fetch_filament_info(index)
+        if self.stage_feed_length <= 0:
+            return
+
+        if self._preload_slots[index]['state'] == 'staged':
+            return
+
+        def callback(response):
+            if response.get('code', 0) != 0:
+                self.logger.error(f"Staging feed for slot {index} failed: {response.get('msg', 'Unknown error')}")
+            else:
+                self._preload_slots[index] = {'state': 'staged', 'error': ''}
+        self.send_request({
+            "method": "feed_filament",
+            "params": {"index": index, "length": self.stage_feed_length,
+                       "speed": self._slot_param(index, 'feed_speed')}
+        }, callback)
+
     def _complete_parking(self):
         if not self._park_in_progress:
             return
         self.logger.info(f"Parking completed for slot {self._park_index}")
+        self._journal.append('park', slot=self._park_index, ok=True,
+                             elapsed=round(self.reactor.monotonic() - self._park_start_time, 2))
         try:
             self.send_request({
                 "method": "stop_feed_assist",
@@ -529,15 +1476,15 @@ class ValgAce:
                 self._feed_assist_index = -1
 
     def dwell(self, delay: float = 1.0, callback: Optional[Callable] = None):
-        """Асинхронная пауза через reactor"""
-        """Asynchronous pause through reactor"""
+        """Асинхронная пауза через планировщик ACE"""
+        """Asynchronous pause through the ACE scheduler"""
         if delay <= 0:
             if callback:
                 try:
                     callback()
                 except Exception as e:
                     self.logger.error(f"Error in dwell callback: {e}")
-            return
+            return None
         
         def timer_handler(event_time):
             if callback:
@@ -545,17 +1492,14 @@ class ValgAce:
                     callback()
                 except Exception as e:
                     self.logger.error(f"Error in dwell callback: {e}")
-            return self.reactor.NEVER
+            return None
         
-        self.reactor.register_timer(timer_handler, self.reactor.monotonic() + delay)
+        return self._scheduler.call_later(delay, timer_handler, 'dwell')
 
 
     def _reconnect(self):
-        self._disconnect()
-        self.dwell(1.0, lambda: None)
-        self._connect()
-
-    def _reset_connection(self):
+        self._metrics.reconnects += 1
+        self._journal.append('reconnect', port=self._transport_target())
         self._disconnect()
         self.dwell(1.0, lambda: None)
         self._connect()
@@ -708,19 +1652,590 @@ class ValgAce:
             return
 
     def cmd_ACE_FILAMENT_INFO(self, gcmd):
+        if gcmd.get_int('ALL', 0, minval=0, maxval=1):
+            # Все слоты из кэша, без запросов к устройству
+            # All slots from the cache, no device round trips
+            gcmd.respond_info("\n".join(
+                self._format_filament_info(i, info) for i, info in enumerate(self._filament_info)))
+            return
         index = gcmd.get_int('INDEX', minval=0, maxval=3)
+        cached = self._filament_info[index]
+        if cached is not None:
+            gcmd.respond_info(self._format_filament_info(index, cached))
+            return
         try:
             def callback(response):
                 if 'result' in response:
-                    slot_info = response['result']
-                    self.gcode.respond_info(str(slot_info))
+                    self.gcode.respond_info(self._format_filament_info(index, response['result']))
                 else:
                     self.gcode.respond_info('Error: No result in response')
-            self.send_request({"method": "get_filament_info", "params": {"index": index}}, callback)
+            self._fetch_filament_info(index, callback)
         except Exception as e:
             self.logger.info(f"Filament info error: {str(e)}")
             self.gcode.respond_info('Error: ' + str(e))
 
+    def cmd_ACE_SLOT_USAGE(self, gcmd):
+        self._update_usage()
+        output = []
+        for i in range(4):
+            line = f"Slot {i}: used {self._slot_used[i] / 1000:.2f} m"
+            remaining = self._slot_remaining[i]
+            line += ", remaining unknown" if remaining is None else f", remaining {remaining / 1000:.2f} m"
+            eta = self._runout_eta(i)
+            if eta is not None:
+                line += f", runout in ~{eta / 60:.0f} min"
+            if i == self._staged_slot:
+                line += " (staged)"
+            output.append(line)
+        gcmd.respond_info("\n".join(output))
+
+    def cmd_ACE_PURGE_MATRIX(self, gcmd):
+        matrix = self._purge.matrix
+        output = ["FROM\\TO " + "".join(f"{to:>7}" for to in range(len(matrix)))]
+        for index, row in enumerate(matrix):
+            cells = []
+            for to, value in enumerate(row):
+                mark = '*' if self._purge.override(index, to) is not None else ' '
+                cells.append(f"{value:>6.0f}{mark}")
+            output.append(f"{index:>8} " + "".join(cells))
+        output.append("mm³, * = override")
+        gcmd.respond_info("\n".join(output))
+
+    def cmd_ACE_SET_PURGE_VOLUME(self, gcmd):
+        size = len(self._purge.matrix)
+        reset = gcmd.get_int('RESET', 0, minval=0, maxval=1)
+        if gcmd.get('FROM', None) is None:
+            if not reset:
+                raise gcmd.error("FROM and TO are required (RESET=1 alone clears all overrides)")
+            self._purge.load_overrides(None)
+        else:
+            from_index = gcmd.get_int('FROM', minval=0, maxval=size - 1)
+            to_index = gcmd.get_int('TO', minval=0, maxval=size - 1)
+            volume = None if reset else gcmd.get_float('VOLUME', minval=0.)
+            self._purge.set_override(from_index, to_index, volume)
+        self._save_variable('ace_purge_overrides', self._purge.overrides)
+        self.cmd_ACE_PURGE_MATRIX(gcmd)
+
+    def _purge_params(self, was: int, tool: int) -> str:
+        """
+        Параметры промывки для _ACE_POST_TOOLCHANGE; строки матрицы через '|':
+        Klipper обрезает строку G-code на первом ';'
+        Purge parameters; matrix rows are joined with '|' because Klipper cuts a
+        G-code line at the first ';'
+        """
+        volume = self._purge.volume(was, tool)
+        matrix = "|".join(",".join(f"{value:.0f}" for value in row) for row in self._purge.matrix)
+        return (f' PURGE_VOLUME={volume:.1f} PURGE_LENGTH={volume / FILAMENT_AREA:.1f}'
+                f' PURGE_MATRIX="{matrix}"')
+
+    def _start_plan(self, path: str, on_done: Optional[Callable] = None) -> 'AceGcodePlan':
+        """
+        План файла из кэша (путь + mtime + размер) или потоковый анализ на планировщике
+        on_done(plan) is called once the plan is ready (immediately when cached)
+        """
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        plan = self._plans.get(key)
+        if plan is None:
+            plan = AceGcodePlan(path)
+            self._plans[key] = plan
+            while len(self._plans) > PLAN_CACHE_SIZE:
+                del self._plans[next(iter(self._plans))]
+            self._scheduler.call_at(self.reactor.NOW, lambda eventtime: self._plan_step(plan),
+                                    'print_plan')
+        if plan.state == 'analyzing':
+            if on_done is not None:
+                plan.waiters.append(on_done)
+        elif on_done is not None:
+            on_done(plan)
+        return plan
+
+    def _plan_step(self, plan: 'AceGcodePlan'):
+        if not plan.feed(PLAN_CHUNK_LINES):
+            return self.reactor.monotonic() + PLAN_CHUNK_DELAY
+        self.logger.info(f"G-code plan of {plan.path}: {plan.state}, "
+                         f"{plan.toolchanges} toolchanges")
+        waiters, plan.waiters = plan.waiters, []
+        for callback in waiters:
+            callback(plan)
+        return None
+
+    def _plan_issues(self, plan: 'AceGcodePlan') -> List[str]:
+        """Расхождения плана с состоянием слотов: статус, материал, остаток"""
+        if plan.state == 'error':
+            return [f"analysis failed: {plan.error}"]
+        slots = self._info.get('slots', [])
+        lengths = dict(plan.lengths)
+        current = self.variables.get('ace_current_index', -1)
+        if plan.untooled_length > 0. and 0 <= current < len(slots):
+            lengths[current] = lengths.get(current, 0.) + plan.untooled_length
+        issues = []
+        for tool, length in sorted(lengths.items()):
+            if not 0 <= tool < len(slots):
+                issues.append(f"T{tool}: no such ACE slot")
+                continue
+            slot = slots[tool]
+            if slot.get('status') != 'ready':
+                issues.append(f"T{tool}: slot is {slot.get('status', 'unknown')}")
+                continue
+            expected = plan.materials[tool] if tool < len(plan.materials) else ''
+            loaded = str(slot.get('type') or '').upper()
+            if expected and loaded and not self._materials_match(expected, loaded):
+                issues.append(f"T{tool}: {loaded} loaded, file expects {expected}")
+            remaining = self._slot_remaining[tool]
+            if remaining is not None and remaining < length:
+                issues.append(f"T{tool}: needs {length / 1000:.1f} m, {remaining / 1000:.1f} m left")
+        return issues
+
+    @staticmethod
+    def _materials_match(expected: str, loaded: str) -> bool:
+        """Вариант материала совпадает с базовым: PLA+ и PLA-CF подходят для PLA"""
+        return expected.startswith(loaded) or loaded.startswith(expected)
+
+    def _format_plan(self, plan: 'AceGcodePlan', issues: List[str]) -> str:
+        sequence = " -> ".join(f"T{tool}" for tool in plan.tools[:20])
+        if len(plan.tools) > 20:
+            sequence += f" ... ({len(plan.tools)} total)"
+        output = [f"G-code plan: {os.path.basename(plan.path)}",
+                  f"Tools: {sequence or 'none'}, {plan.toolchanges} toolchanges"]
+        for tool, length in sorted(plan.lengths.items()):
+            material = plan.materials[tool] if 0 <= tool < len(plan.materials) else ''
+            output.append(f"  T{tool}: {length / 1000:.2f} m" + (f" {material}" if material else ""))
+        output += [f"! {issue}" for issue in issues] or ["Slots match the plan"]
+        return "\n".join(output)
+
+    def _on_print_start(self):
+        """Проверка плана печатаемого файла; анализ идет, пока принтер греется"""
+        self._print_plan = None
+        self._print_plan_issues = []
+        if not self.print_plan_check:
+            return
+        sdcard = self.printer.lookup_object('virtual_sdcard', None)
+        path = sdcard.file_path() if sdcard is not None else None
+        if not path:
+            return
+        try:
+            self._print_plan = self._start_plan(path, self._check_print_plan)
+        except OSError as e:
+            self.logger.warning(f"Could not analyze {path}: {e}")
+
+    def _check_print_plan(self, plan: 'AceGcodePlan'):
+        # План может прийти из кэша сразу или закончиться уже после смены файла
+        # The plan may come from the cache at once or finish after the file changed
+        sdcard = self.printer.lookup_object('virtual_sdcard', None)
+        if sdcard is None or sdcard.file_path() != plan.path:
+            return
+        self._print_plan = plan
+        issues = self._plan_issues(plan)
+        self._print_plan_issues = issues
+        if not issues:
+            return
+        self.gcode.respond_info(self._format_plan(plan, issues))
+        if self.printer.lookup_object('gcode_macro _ACE_ON_PLAN_ERROR', None) is not None:
+            # Klipper обрезает строку на ';', '#' тоже убираем / Klipper cuts the line at ';', '#' is dropped too
+            message = " | ".join(issues).replace('"', "'").replace(';', ',').replace('#', '')
+            self.reactor.register_callback(
+                lambda eventtime: self.gcode.run_script(f'_ACE_ON_PLAN_ERROR MSG="{message}"'))
+
+    def cmd_ACE_PRINT_PLAN(self, gcmd):
+        sdcard = self.printer.lookup_object('virtual_sdcard', None)
+        path = gcmd.get('FILE', None)
+        if path is None:
+            path = sdcard.file_path() if sdcard is not None else None
+            if not path:
+                raise gcmd.error("No file is loaded, use FILE=<path>")
+        elif not os.path.isabs(path) and sdcard is not None:
+            path = os.path.join(sdcard.sdcard_dirname, path)
+        try:
+            plan = self._start_plan(path)
+        except OSError as e:
+            raise gcmd.error(f"ACE Error: {e}")
+        while plan.state == 'analyzing':
+            self.reactor.pause(self.reactor.monotonic() + ACTION_POLL_TIME)
+        issues = self._plan_issues(plan)
+        if sdcard is not None and path == sdcard.file_path():
+            self._print_plan = plan
+            self._print_plan_issues = issues
+        gcmd.respond_info(self._format_plan(plan, issues))
+        if issues and gcmd.get_int('CHECK', 0, minval=0, maxval=1):
+            raise gcmd.error(f"ACE Error: print plan check failed: {'; '.join(issues)}")
+
+    def cmd_ACE_JOURNAL(self, gcmd):
+        types = gcmd.get('TYPE', None)
+        types = [t.strip().lower() for t in types.split(',')] if types else None
+        for event_type in types or ():
+            if event_type not in JOURNAL_TYPES:
+                raise gcmd.error(f"Unknown TYPE '{event_type}', expected {', '.join(JOURNAL_TYPES)}")
+        hours = gcmd.get_float('HOURS', 24., above=0.)
+        events = self._journal.query(start=time.time() - hours * 3600., types=types)
+        if not gcmd.get_int('SUMMARY', 0, minval=0, maxval=1):
+            events = events[-gcmd.get_int('LIMIT', 20, minval=1):]
+            output = [f"{time.strftime('%m-%d %H:%M:%S', time.localtime(event.pop('time')))} "
+                      f"{event.pop('type')} "
+                      + " ".join(f"{key}={json.dumps(value, separators=(',', ':'))}"
+                                 for key, value in event.items())
+                      for event in events]
+            gcmd.respond_info("\n".join(output) or f"No ACE events in the last {hours:g} h")
+            return
+        gcmd.respond_info(self._format_journal_summary(events, hours))
+
+    @staticmethod
+    def _format_journal_summary(events, hours: float) -> str:
+        """Счетчики по типам, неудачные парковки по слотам, p50/p95 смены по материалам"""
+        counts = {}
+        park_failures = {}
+        durations = {}
+        for event in events:
+            counts[event['type']] = counts.get(event['type'], 0) + 1
+            if event['type'] == 'park' and not event.get('ok'):
+                park_failures[event.get('slot')] = park_failures.get(event.get('slot'), 0) + 1
+            elif event['type'] == 'toolchange' and event.get('ok') and event.get('to', -1) >= 0:
+                durations.setdefault(event.get('material') or '?', []).append(event['duration'])
+        output = [f"ACE events in the last {hours:g} h: "
+                  + (", ".join(f"{name} {count}" for name, count in counts.items()) or "none")]
+        for slot, count in sorted(park_failures.items()):
+            output.append(f"Slot {slot}: {count} park failures")
+        for material, values in sorted(durations.items()):
+            values.sort()
+            p50 = values[max(0, math.ceil(0.5 * len(values)) - 1)]
+            p95 = values[max(0, math.ceil(0.95 * len(values)) - 1)]
+            output.append(f"Toolchange to {material}: {len(values)}, p50 {p50:.1f}s, p95 {p95:.1f}s")
+        return "\n".join(output)
+
+    def cmd_ACE_SET_SLOT_REMAINING(self, gcmd):
+        index = gcmd.get_int('INDEX', minval=0, maxval=3)
+        length = gcmd.get_float('LENGTH', minval=0.)
+        self._update_usage()
+        self._slot_remaining[index] = length
+        self._slot_used[index] = 0.
+        if self._staged_from == index and length > self.runout_warning_length:
+            self._staged_slot = self._staged_from = -1
+        self._save_slot_usage()
+        gcmd.respond_info(f"Slot {index} remaining length set to {length / 1000:.2f} m")
+
+    def _format_slot_params(self, index: int) -> str:
+        params = self._slot_params[index]
+        return f"Slot {index}: " + ", ".join(
+            f"{name}={self._slot_param(index, name)}" + ("" if name in params else " (global)")
+            for name in SLOT_PARAMS)
+
+    def cmd_ACE_SET_SLOT_PARAMS(self, gcmd):
+        index = gcmd.get_int('INDEX', minval=0, maxval=3)
+        params = self._slot_params[index]
+        if gcmd.get_int('RESET', 0, minval=0, maxval=1):
+            params.clear()
+        for name in SLOT_PARAMS:
+            value = gcmd.get_int(name.upper(), None, minval=1)
+            if value is not None:
+                params[name] = value
+        self._save_variable('ace_slot_params', self._slot_params)
+        gcmd.respond_info(self._format_slot_params(index))
+
+    def _calibration_wait(self, condition, timeout: float) -> bool:
+        deadline = self.reactor.monotonic() + timeout
+        while not condition():
+            if self.reactor.monotonic() > deadline:
+                return False
+            self.toolhead.dwell(0.1)
+        return True
+
+    def _calibration_move(self, method: str, index: int, length: int, speed: int) -> Optional[float]:
+        """Подача/откат для калибровки: длительность или None при ошибке"""
+        ok, msg, duration = self._run_action(method, index, length, speed)
+        if not ok:
+            self.logger.warning(f"Calibration {method} at {speed} mm/s failed: {msg}")
+            return None
+        return duration
+
+    def _add_action_waiter(self, index: int, after: float, earliest: float,
+                           callback: Callable) -> Dict[str, Any]:
+        """
+        callback(ok, msg) вызывается один раз, когда движение слота закончилось
+        callback(ok, msg) fires once the slot's move is over (first status received after `after`)
+        """
+        waiter = {'index': index, 'after': after, 'earliest': earliest,
+                  'busy': False, 'callback': callback}
+        self._action_waiters.append(waiter)
+        return waiter
+
+    def _remove_action_waiter(self, waiter: Dict[str, Any]):
+        if waiter in self._action_waiters:
+            self._action_waiters.remove(waiter)
+
+    def _notify_action_waiters(self, result: Dict[str, Any]):
+        slots = result.get('slots') or []
+        for waiter in list(self._action_waiters):
+            if self._last_rx_time <= waiter['after']:
+                continue
+            index = waiter['index']
+            if index < len(slots) and slots[index].get('status') == 'empty':
+                outcome = (False, f"Slot {index} is empty")
+            elif result.get('status') != 'ready':
+                waiter['busy'] = True
+                continue
+            elif waiter['busy'] or self._last_rx_time >= waiter['earliest']:
+                # Готов после того, как был занят (или короткое движение успело закончиться между опросами)
+                # Ready after being busy (or a short move finished between polls)
+                outcome = (True, "")
+            else:
+                continue
+            self._action_waiters.remove(waiter)
+            waiter['callback'](*outcome)
+
+    def _run_action(self, method: str, index: int, length: int, speed: int,
+                    timeout: Optional[float] = None, **extra):
+        """
+        Отправляет feed_filament/unwind_filament и ждет, пока устройство снова станет ready
+        Blocks the calling G-code command; returns (ok, error message, duration)
+        """
+        start = self.reactor.monotonic()
+        expected = length / speed
+        if timeout is None:
+            timeout = expected * 2 + 5.0
+        reply = self.reactor.completion()
+        self.send_request({
+            "method": method,
+            "params": dict(extra, index=index, length=length, speed=speed)
+        }, lambda response: reply.complete((response, self._last_rx_time)))
+        result = reply.wait(start + self._response_timeout * 2)
+        if result is None:
+            return False, "No reply from device", self.reactor.monotonic() - start
+        response, reply_time = result
+        if response.get('code', 0) != 0:
+            return False, response.get('msg', 'Unknown error'), self.reactor.monotonic() - start
+        completion = self.reactor.completion()
+        waiter = self._add_action_waiter(index, reply_time, start + expected,
+                                         lambda ok, msg: completion.complete((ok, msg)))
+        try:
+            done = completion.wait(start + timeout)
+        finally:
+            self._remove_action_waiter(waiter)
+        if done is None:
+            return False, f"Timeout after {timeout:.1f}s", self.reactor.monotonic() - start
+        ok, msg = done
+        return ok, msg, self._last_rx_time - start
+
+    def _calibrate_park(self, index: int, timeout: float) -> Optional[int]:
+        """
+        Паркует слот без автозавершения и ищет самую длинную ложную остановку
+        счетчика feed assist до окончательной остановки у экструдера
+        Returns the smallest safe park_hit_count, None if parking failed
+        """
+        self._calibration_samples.clear()
+        self.send_request({"method": "start_feed_assist", "params": {"index": index}}, lambda r: None)
+
+        def parked():
+            samples = self._calibration_samples
+            if not samples or samples[-1][1] == samples[0][1]:
+                return False
+            first = len(samples) - 1
+            while samples[first - 1][1] == samples[-1][1]:
+                first -= 1
+            return samples[-1][0] - samples[first][0] >= CALIBRATE_PARK_HOLD
+        ok = self._calibration_wait(parked, timeout)
+        self.send_request({"method": "stop_feed_assist", "params": {"index": index}}, lambda r: None)
+        samples = [count for _, count, _ in self._calibration_samples]
+        if not ok:
+            return None
+        # Самая длинная серия одинаковых отсчетов между первым ростом счетчика и финальной остановкой
+        # Longest run of unchanged samples between the first increase and the final plateau
+        begin = next(i for i, count in enumerate(samples) if count != samples[0])
+        end = len(samples) - 1
+        while samples[end - 1] == samples[-1]:
+            end -= 1
+        longest = run = 0
+        for prev, count in zip(samples[begin:end], samples[begin + 1:end]):
+            run = run + 1 if count == prev else 0
+            longest = max(longest, run)
+        return max(2, longest + CALIBRATE_HIT_MARGIN)
+
+    def cmd_ACE_CALIBRATE(self, gcmd):
+        index = gcmd.get_int('INDEX', minval=0, maxval=3)
+        length = gcmd.get_int('LENGTH', 100, minval=10)
+        min_speed = gcmd.get_int('MIN_SPEED', 10, minval=1)
+        max_speed = gcmd.get_int('MAX_SPEED', 50, minval=min_speed)
+        step = gcmd.get_int('STEP', 5, minval=1)
+        park = gcmd.get_int('PARK', 1, minval=0, maxval=1)
+        if self._calibration_samples is not None:
+            gcmd.respond_raw("ACE Error: Calibration already running")
+            return
+        if self.toolhead is None or self._park_in_progress:
+            gcmd.respond_raw("ACE Error: Device is busy")
+            return
+        if self._info['slots'][index]['status'] != 'ready':
+            gcmd.respond_raw(f"ACE Error: Slot {index} is not ready")
+            return
+        if self.variables.get('ace_current_index', -1) != -1:
+            gcmd.respond_raw("ACE Error: Unload the current tool first (ACE_CHANGE_TOOL TOOL=-1)")
+            return
+        self._calibration_samples = []
+        try:
+            # Ступенчато повышаем скорость, пока подача/откат укладываются во время
+            # Raise the speed step by step while feed/retract finish in time
+            feed_speed = retract_speed = None
+            for speed in range(min_speed, max_speed + 1, step):
+                expected = length / speed
+                feed_time = self._calibration_move('feed_filament', index, length, speed)
+                feed_ok = feed_time is not None and feed_time <= expected * CALIBRATE_TIME_SLACK + 2 * ACTION_POLL_TIME
+                retract_time = self._calibration_move(
+                    'unwind_filament', index, length, speed if feed_ok else (retract_speed or min_speed))
+                retract_ok = feed_ok and retract_time is not None \
+                    and retract_time <= expected * CALIBRATE_TIME_SLACK + 2 * ACTION_POLL_TIME
+                gcmd.respond_info(f"Slot {index} @ {speed} mm/s: feed "
+                                  + (f"{feed_time:.1f}s" if feed_time is not None else "failed")
+                                  + ", retract "
+                                  + (f"{retract_time:.1f}s" if retract_time is not None else "failed")
+                                  + f" (expected {expected:.1f}s)")
+                if feed_ok:
+                    feed_speed = speed
+                if retract_ok:
+                    retract_speed = speed
+                if not (feed_ok and retract_ok):
+                    break
+            if feed_speed is None or retract_speed is None:
+                gcmd.respond_raw(f"ACE Error: Slot {index} failed at {min_speed} mm/s, nothing stored")
+                return
+            params = self._slot_params[index]
+            params['feed_speed'] = feed_speed
+            params['retract_speed'] = retract_speed
+            if park:
+                hit_count = self._calibrate_park(index, 60.0)
+                if hit_count is None:
+                    gcmd.respond_raw(f"ACE Error: Parking slot {index} did not settle, park_hit_count unchanged")
+                else:
+                    params['park_hit_count'] = hit_count
+                    # Возвращаем филамент из хотенда тем же откатом, что и при смене
+                    # Pull the filament back out like a toolchange would
+                    self._calibration_move('unwind_filament', index,
+                                           self._slot_param(index, 'toolchange_retract_length'),
+                                           retract_speed)
+            self._save_variable('ace_slot_params', self._slot_params)
+            gcmd.respond_info("Calibration done. " + self._format_slot_params(index))
+        finally:
+            self._calibration_samples = None
+
+    def _parse_sequence(self, gcmd, text: str):
+        """
+        "feed 0 100 25 | wait 0.5 | assist 0" -> список шагов
+        Steps are separated by '|': Klipper cuts a G-code line at the first ';'.
+        Each step: operation, positional arguments, optional timeout=<s>
+        """
+        steps = []
+        for number, item in enumerate(text.split('|'), 1):
+            tokens = item.split()
+            if not tokens:
+                continue
+            op = tokens[0].lower()
+            if op not in SEQUENCE_OPS:
+                raise gcmd.error(f"Step {number}: unknown operation '{op}' "
+                                 f"(expected {', '.join(SEQUENCE_OPS)})")
+            timeout = None
+            args = []
+            try:
+                for token in tokens[1:]:
+                    if token.lower().startswith('timeout='):
+                        timeout = float(token.split('=', 1)[1])
+                    else:
+                        args.append(float(token) if op == 'wait' else int(token))
+            except ValueError:
+                raise gcmd.error(f"Step {number}: invalid argument in '{item.strip()}'")
+            method, kind = SEQUENCE_OPS[op]
+            if op == 'wait':
+                if len(args) != 1 or args[0] < 0.:
+                    raise gcmd.error(f"Step {number}: expected 'wait <seconds>'")
+                steps.append({'op': op, 'kind': kind, 'text': item.strip(), 'delay': args[0],
+                              'timeout': timeout})
+                continue
+            if not args or not 0 <= args[0] <= 3:
+                raise gcmd.error(f"Step {number}: expected slot index 0-3 in '{item.strip()}'")
+            index = args[0]
+            params = {'index': index}
+            if kind == 'motion':
+                if len(args) < 2 or args[1] < 1:
+                    raise gcmd.error(f"Step {number}: expected '{op} <index> <length> [speed]'")
+                params['length'] = args[1]
+                params['speed'] = args[2] if len(args) > 2 else self._slot_param(
+                    index, 'feed_speed' if op == 'feed' else 'retract_speed')
+                if op == 'retract':
+                    params['mode'] = args[3] if len(args) > 3 else self.retract_mode
+            elif op in ('feed_speed', 'retract_speed'):
+                if len(args) != 2:
+                    raise gcmd.error(f"Step {number}: expected '{op} <index> <speed>'")
+                params['speed'] = args[1]
+            steps.append({'op': op, 'kind': kind, 'method': method, 'text': item.strip(),
+                          'params': params, 'timeout': timeout})
+        if not steps:
+            raise gcmd.error("ACE_SEQUENCE requires STEPS")
+        return steps
+
+    def cmd_ACE_SEQUENCE(self, gcmd):
+        steps = self._parse_sequence(gcmd, gcmd.get('STEPS'))
+        if self._park_in_progress:
+            raise gcmd.error("ACE Error: Parking in progress")
+        sequence = AceSequence(self, steps)
+        ok = sequence.run()
+        lines = []
+        for number, step in enumerate(steps, 1):
+            if 'end' not in step:
+                lines.append(f"{number}. {step['text']}: skipped")
+                continue
+            lines.append(f"{number}. {step['text']}: "
+                         f"{'ok' if step['ok'] else 'FAILED ' + step['msg']} "
+                         f"{step['end'] - step['start']:.2f}s")
+        lines.append(f"Sequence {'done' if ok else 'failed'} in {sequence.duration:.2f}s")
+        if not ok:
+            raise gcmd.error("ACE Error: " + "\n".join(lines))
+        gcmd.respond_info("\n".join(lines))
+
+    def cmd_ACE_PRELOAD(self, gcmd):
+        text = gcmd.get('SLOTS', '0,1,2,3')
+        try:
+            slots = sorted({int(item) for item in text.split(',') if item.strip()})
+        except ValueError:
+            raise gcmd.error(f"Invalid SLOTS '{text}', expected e.g. 0,1,2,3")
+        if not slots or any(not 0 <= index <= 3 for index in slots):
+            raise gcmd.error(f"Invalid SLOTS '{text}', expected slot indexes 0-3")
+        length = gcmd.get_int('LENGTH', self.stage_feed_length, minval=0)
+        force = gcmd.get_int('FORCE', 0, minval=0, maxval=1)
+        wait = gcmd.get_int('WAIT', 1, minval=0, maxval=1)
+        if self._preload is not None:
+            raise gcmd.error("ACE Error: Preload already in progress")
+        if self._park_in_progress:
+            raise gcmd.error("ACE Error: Parking in progress")
+        preload = AcePreload(self, slots, length, bool(force))
+        preload.start()
+        if not wait:
+            gcmd.respond_info(f"ACE: preloading slots {','.join(map(str, slots))}")
+            return
+        ok = preload.wait()
+        lines = [f"Slot {index}: {self._format_preload_slot(index)}" for index in slots]
+        lines.append(f"Preload {'done' if ok else 'failed'} in {preload.duration:.2f}s")
+        if not ok:
+            raise gcmd.error("ACE Error: " + "\n".join(lines))
+        gcmd.respond_info("\n".join(lines))
+
+    def _format_preload_slot(self, index: int) -> str:
+        slot = self._preload_slots[index]
+        text = slot['state']
+        if slot['error']:
+            text += f" ({slot['error']})"
+        info = self._filament_info[index]
+        if info and slot['state'] != 'empty':
+            text += f", {info.get('type') or 'Unknown'} {info.get('sku', '')}".rstrip()
+        return text
+
+    def cmd_ACE_PROFILE(self, gcmd):
+        enable = gcmd.get_int('ENABLE', None, minval=0, maxval=1)
+        if gcmd.get_int('RESET', 0, minval=0, maxval=1):
+            self._profiler.reset()
+        if enable is not None:
+            self._profiler.enabled = bool(enable)
+            self._profiler.reset()
+            gcmd.respond_info(f"ACE profiling {'enabled' if enable else 'disabled'}")
+            return
+        gcmd.respond_info("\n".join(self._profiler.report()
+                                     + [f"Scheduled tasks pending: {self._scheduler.pending()}"]))
+
     def cmd_ACE_START_DRYING(self, gcmd):
         temperature = gcmd.get_int('TEMP', minval=20, maxval=self.max_dryer_temperature)
         duration = gcmd.get_int('DURATION', 240, minval=1)
@@ -728,6 +2243,8 @@ class ValgAce:
             if response.get('code', 0) != 0:
                 gcmd.respond_raw(f"ACE Error: {response.get('msg', 'Unknown error')}")
             else:
+                self._drying.release()
+                self._journal.append('drying', action='start', temp=temperature, duration=duration)
                 gcmd.respond_info(f"Drying started at {temperature}°C for {duration} minutes")
         self.send_request({
             "method": "drying",
@@ -743,8 +2260,56 @@ class ValgAce:
             if response.get('code', 0) != 0:
                 gcmd.respond_raw(f"ACE Error: {response.get('msg', 'Unknown error')}")
             else:
-                gcmd.respond_info("Drying stopped")
-        self.send_request({"method": "drying_stop"}, callback)
+                job = self._drying.release(drop=True)
+                self._journal.append('drying', action='stop')
+                gcmd.respond_info("Drying stopped" + (f", {job['profile']} removed from the drying queue"
+                                                      if job else ""))
+        self._stop_dryer('stopped', callback)
+
+    def cmd_ACE_DRY(self, gcmd):
+        profile = gcmd.get('PROFILE', None)
+        index = gcmd.get_int('INDEX', None, minval=0, maxval=3)
+        if profile is not None:
+            profile = profile.upper()
+            if profile not in self._drying.profiles:
+                raise gcmd.error(f"Unknown drying profile {profile}, "
+                                 f"known: {', '.join(sorted(self._drying.profiles))}")
+            names = [profile]
+        else:
+            slots = self._info.get('slots', [])
+            indexes = [index] if index is not None else range(len(slots))
+            names = []
+            for i in indexes:
+                slot = slots[i] if i < len(slots) else {}
+                if slot.get('status') != 'ready':
+                    continue
+                name = self._drying.profile_for(slot.get('type', ''))
+                if name is None:
+                    gcmd.respond_info(f"Slot {i}: no drying profile for material '{slot.get('type', '')}'")
+                elif name not in names:
+                    names.append(name)
+            if not names:
+                raise gcmd.error("No slot with a known material to dry, use PROFILE=<name>")
+        for name in names:
+            if self._drying.enqueue(name):
+                gcmd.respond_info(f"Drying {name} queued: {self._drying.format_profile(name)}")
+            else:
+                gcmd.respond_info(f"Drying {name} is already queued")
+
+    def cmd_ACE_DRY_QUEUE(self, gcmd):
+        if gcmd.get_int('CLEAR', 0, minval=0, maxval=1):
+            self._drying.clear()
+            gcmd.respond_info("Drying queue cleared")
+            return
+        output = ["Drying profiles:"]
+        for name in sorted(self._drying.profiles):
+            output.append(f"  {name}: {self._drying.format_profile(name)}")
+        status = self._drying.get_status()
+        output.append(f"Scheduler: {status['state']}" + (" (auto)" if self._drying.auto else ""))
+        for job in status['jobs']:
+            output.append(f"  {job['profile']}: stage {job['stage'] + 1}/{job['stages']}, "
+                          f"{job['remain'] / 60.:.0f} min left")
+        gcmd.respond_info("\n".join(output))
 
     def cmd_ACE_ENABLE_FEED_ASSIST(self, gcmd):
         index = gcmd.get_int('INDEX', minval=0, maxval=3)
@@ -773,11 +2338,13 @@ class ValgAce:
         self._park_in_progress = True
         self._park_error = False  # Reset error flag
         self._park_index = index
+        self._park_hit_target = self._slot_param(index, 'park_hit_count')
         self._assist_hit_count = 0
         self._park_start_time = self.reactor.monotonic()
         self._park_count_increased = False  # Track if count actually increased
+        self._park_assist_started = False
         
-        self.logger.info(f"Starting parking for slot {index}")
+        self.logger.info(f"Starting parking for slot {index} (hit count {self._park_hit_target})")
         
         def callback(response):
             if response.get('code', 0) != 0:
@@ -787,9 +2354,11 @@ class ValgAce:
                     self.logger.error(f"ACE Error starting feed assist: {response.get('msg', 'Unknown error')}")
                 # Reset parking flag on error since device won't start feeding
                 self._park_in_progress = False
+                self._park_failed(index, 'start_feed_assist error')
                 self.logger.error(f"Parking aborted for slot {index} due to start_feed_assist error")
             else:
                 self._last_assist_count = response.get('result', {}).get('feed_assist_count', 0)
+                self._park_assist_started = True
                 self.logger.info(f"Feed assist started for slot {index}, count: {self._last_assist_count}")
             self.dwell(0.3, lambda: None)
         self.send_request({"method": "start_feed_assist", "params": {"index": index}}, callback)
@@ -807,7 +2376,10 @@ class ValgAce:
     def cmd_ACE_FEED(self, gcmd):
         index = gcmd.get_int('INDEX', minval=0, maxval=3)
         length = gcmd.get_int('LENGTH', minval=1)
-        speed = gcmd.get_int('SPEED', self.feed_speed, minval=1)
+        speed = gcmd.get_int('SPEED', self._slot_param(index, 'feed_speed'), minval=1)
+        if gcmd.get_int('WAIT', 0, minval=0, maxval=1):
+            self._wait_action(gcmd, 'feed_filament', index, length, speed)
+            return
         def callback(response):
             if response.get('code', 0) != 0:
                 gcmd.respond_raw(f"ACE Error: {response.get('msg', 'Unknown error')}")
@@ -817,6 +2389,15 @@ class ValgAce:
         }, callback)
         self.dwell((length / speed) + 0.1, lambda: None)
 
+    def _wait_action(self, gcmd, method: str, index: int, length: int, speed: int, **extra):
+        """WAIT=1: команда завершается вместе с движением, ошибка прерывает макрос"""
+        timeout = gcmd.get_float('TIMEOUT', length / speed * 2 + 5.0, above=0.)
+        ok, msg, duration = self._run_action(method, index, length, speed, timeout, **extra)
+        if not ok:
+            raise gcmd.error(f"ACE Error: {method} slot {index}: {msg}")
+        gcmd.respond_info(f"{'Feed' if method == 'feed_filament' else 'Retract'} "
+                          f"slot {index} {length}mm finished in {duration:.1f}s")
+
     def cmd_ACE_UPDATE_FEEDING_SPEED(self, gcmd):
         index = gcmd.get_int('INDEX', minval=0, maxval=3)
         speed = gcmd.get_int('SPEED', self.feed_speed, minval=1)
@@ -845,8 +2426,11 @@ class ValgAce:
     def cmd_ACE_RETRACT(self, gcmd):
         index = gcmd.get_int('INDEX', minval=0, maxval=3)
         length = gcmd.get_int('LENGTH', minval=1)
-        speed = gcmd.get_int('SPEED', self.retract_speed, minval=1)
+        speed = gcmd.get_int('SPEED', self._slot_param(index, 'retract_speed'), minval=1)
         mode = gcmd.get_int('MODE', self.retract_mode, minval=0, maxval=1)
+        if gcmd.get_int('WAIT', 0, minval=0, maxval=1):
+            self._wait_action(gcmd, 'unwind_filament', index, length, speed, mode=mode)
+            return
         def callback(response):
             if response.get('code', 0) != 0:
                 gcmd.respond_raw(f"ACE Error: {response.get('msg', 'Unknown error')}")
@@ -885,11 +2469,15 @@ class ValgAce:
     def cmd_ACE_CHANGE_TOOL(self, gcmd):
         tool = gcmd.get_int('TOOL', minval=-1, maxval=3)
         was = self.variables.get('ace_current_index', -1)
+        start_time = self.reactor.monotonic()
 
         if was == tool:
             gcmd.respond_info(f"Tool already set to {tool}")
             return
 
+        if self._recovering:
+            raise gcmd.error("ACE Error: interrupted toolchange recovery is in progress")
+
         if tool != -1 and self._info['slots'][tool]['status'] != 'ready':
             self.gcode.run_script_from_command(f"_ACE_ON_EMPTY_ERROR INDEX={tool}")
             return
@@ -899,73 +2487,125 @@ class ValgAce:
         self._park_previous_tool = was
         if self.toolhead:
             self.toolhead.wait_moves()
-        self.variables['ace_current_index'] = tool
-        self._save_variable('ace_current_index', tool)
+        # Фазы смены для журнала: (фаза, время начала)
+        # Toolchange phases for the journal: (phase, start time)
+        marks = [('pre', start_time), ('retract' if was != -1 else 'park', self.reactor.monotonic())]
+        # Расход до смены относится к старому слоту
+        # Usage up to the change belongs to the old slot
+        self._update_usage()
+        self._staged_slot = self._staged_from = -1
+        for index in (was, tool):
+            if index != -1:
+                self._preload_slots[index] = {'state': 'idle', 'error': ''}
+        # Новый слот до конца смены хранится только в намерении: self.variables -
+        # словарь save_variables, и SAVE_VARIABLE пишет его целиком, так что ранняя
+        # запись ace_current_index попала бы на диск вместе с намерением
+        # The target lives only in the intent until _commit_intent: self.variables
+        # is the save_variables dict and SAVE_VARIABLE writes all of it, so setting
+        # ace_current_index early would reach the disk with the intent save
+        self._write_intent('toolchange', was, tool, 'retract' if was != -1 else 'park')
+        if self._usage_dirty:
+            self._save_slot_usage()
+
+        unwind_reply = self.reactor.completion()
 
         def callback(response):
+            unwind_reply.complete(response)
             if response.get('code', 0) != 0:
                 gcmd.respond_raw(f"ACE Error: {response.get('msg', 'Unknown error')}")
 
+        overlapped = False
         if was != -1:
             # Retract current tool first
+            retract_length = self._slot_param(was, 'toolchange_retract_length')
+            retract_speed = self._slot_param(was, 'retract_speed')
             self.send_request({
                 "method": "unwind_filament",
                 "params": {
                     "index": was,
-                    "length": self.toolchange_retract_length,
-                    "speed": self.retract_speed
+                    "length": retract_length,
+                    "speed": retract_speed
                 }
             }, callback)
-            
-            # Wait for retract to physically complete
-            retract_time = (self.toolchange_retract_length / self.retract_speed) + 1.0
-            self.logger.info(f"Waiting {retract_time:.1f}s for retract to complete")
-            if self.toolhead:
-                self.toolhead.dwell(retract_time)
-            
+            retract_sent = self.reactor.monotonic()
+
+            if tool != -1 and self.toolchange_overlap:
+                overlapped = self._overlap_park(was, tool, retract_length, retract_speed, unwind_reply)
+                if not overlapped:
+                    self._metrics.toolchange_overlap_fallbacks += 1
+                    self.logger.info("Overlapped toolchange not possible, falling back to sequential")
+
+            if not overlapped:
+                # Wait for retract to physically complete
+                # (minus the time already spent in an aborted overlap attempt)
+                retract_time = max(0., (retract_length / retract_speed) + 1.0
+                                   - (self.reactor.monotonic() - retract_sent))
+                self.logger.info(f"Waiting {retract_time:.1f}s for retract to complete")
+                if self.toolhead:
+                    self.toolhead.dwell(retract_time)
+
             # Wait for slot to be ready (status changes to 'ready' after retraction)
             self.logger.info(f"Waiting for slot {was} to be ready")
             timeout = self.reactor.monotonic() + 10.0  # 10 second timeout
             while self._info['slots'][was]['status'] != 'ready':
                 if self.reactor.monotonic() > timeout:
                     gcmd.respond_raw(f"ACE Error: Timeout waiting for slot {was} to be ready")
+                    self._fail_toolchange(was, tool, marks, 'slot not ready after retract', overlapped)
                     return
                 if self.toolhead:
                     self.toolhead.dwell(1.0)
             
             self.logger.info(f"Slot {was} is ready, parking new tool {tool}")
             
+            self._intent_phase('park')
             if tool != -1:
                 # Park new tool to toolhead
-                self._park_to_toolhead(tool)
+                marks.append(('park', self.reactor.monotonic()))
+                if not overlapped:
+                    self._park_to_toolhead(tool)
                 
                 # Wait for parking to complete (check self._park_in_progress)
                 self.logger.info(f"Waiting for parking to complete (slot {tool})")
                 timeout = self.reactor.monotonic() + 30.0  # 30 second timeout for parking
-                while self._park_in_progress:
-                    if self._park_error:
-                        gcmd.respond_raw(f"ACE Error: Parking failed for slot {tool}")
-                        return
+                while self._park_in_progress and not self._park_error:
                     if self.reactor.monotonic() > timeout:
+                        self._park_failed(tool, 'timeout')
                         gcmd.respond_raw(f"ACE Error: Timeout waiting for parking to complete")
+                        self._fail_toolchange(was, tool, marks, 'park timeout', overlapped)
                         return
                     if self.toolhead:
                         self.toolhead.dwell(1.0)
+                if self._park_error:
+                    gcmd.respond_raw(f"ACE Error: Parking failed for slot {tool}")
+                    self._fail_toolchange(was, tool, marks, 'park failed', overlapped)
+                    return
                 
                 self.logger.info(f"Parking completed, executing post-toolchange")
                 if self.toolhead:
                     self.toolhead.wait_moves()
                 
                 # Execute post-toolchange macro
-                self.gcode.run_script_from_command(f'_ACE_POST_TOOLCHANGE FROM={was} TO={tool}')
+                marks.append(('post', self.reactor.monotonic()))
+                self._intent_phase('post')
+                self.gcode.run_script_from_command(
+                    f'_ACE_POST_TOOLCHANGE FROM={was} TO={tool}' + self._purge_params(was, tool))
                 if self.toolhead:
                     self.toolhead.wait_moves()
+                self._commit_intent(tool)
+                self._record_toolchange(start_time)
+                self._journal_toolchange(was, tool, marks, overlapped=overlapped)
                 gcmd.respond_info(f"Tool changed from {was} to {tool}")
             else:
                 # Unloading only, no new tool
-                self.gcode.run_script_from_command(f'_ACE_POST_TOOLCHANGE FROM={was} TO={tool}')
+                marks.append(('post', self.reactor.monotonic()))
+                self._intent_phase('post')
+                self.gcode.run_script_from_command(
+                    f'_ACE_POST_TOOLCHANGE FROM={was} TO={tool}' + self._purge_params(was, tool))
                 if self.toolhead:
                     self.toolhead.wait_moves()
+                self._commit_intent(tool)
+                self._record_toolchange(start_time)
+                self._journal_toolchange(was, tool, marks)
                 gcmd.respond_info(f"Tool changed from {was} to {tool}")
         else:
             # No previous tool, just park the new one
@@ -975,28 +2615,121 @@ class ValgAce:
             # Wait for parking to complete (check self._park_in_progress)
             self.logger.info(f"Waiting for parking to complete (slot {tool})")
             timeout = self.reactor.monotonic() + 30.0  # 30 second timeout for parking
-            while self._park_in_progress:
-                if self._park_error:
-                    gcmd.respond_raw(f"ACE Error: Parking failed for slot {tool}")
-                    return
+            while self._park_in_progress and not self._park_error:
                 if self.reactor.monotonic() > timeout:
+                    self._park_failed(tool, 'timeout')
                     gcmd.respond_raw(f"ACE Error: Timeout waiting for parking to complete")
+                    self._fail_toolchange(was, tool, marks, 'park timeout')
                     return
                 if self.toolhead:
                     self.toolhead.dwell(1.0)
+            if self._park_error:
+                gcmd.respond_raw(f"ACE Error: Parking failed for slot {tool}")
+                self._fail_toolchange(was, tool, marks, 'park failed')
+                return
             
             self.logger.info(f"Parking completed, executing post-toolchange")
             if self.toolhead:
                 self.toolhead.wait_moves()
             
             # Execute post-toolchange macro
-            self.gcode.run_script_from_command(f'_ACE_POST_TOOLCHANGE FROM={was} TO={tool}')
+            marks.append(('post', self.reactor.monotonic()))
+            self._intent_phase('post')
+            self.gcode.run_script_from_command(
+                f'_ACE_POST_TOOLCHANGE FROM={was} TO={tool}' + self._purge_params(was, tool))
             if self.toolhead:
                 self.toolhead.wait_moves()
+            self._commit_intent(tool)
+            self._record_toolchange(start_time)
+            self._journal_toolchange(was, tool, marks)
             gcmd.respond_info(f"Tool changed from {was} to {tool}")
 
-    def cmd_ACE_SET_INFINITY_SPOOL_ORDER(self, gcmd):
-        """Set the order of slots for infinity spool mode"""
+    def _fail_toolchange(self, was: int, tool: int, marks, error: str, overlapped: bool = False):
+        """
+        Смена не удалась: новый слот не у головы, старый откачен - инструмент не загружен
+        The new slot never reached the toolhead and the old one was retracted,
+        so no tool is loaded; an unfinished park is stopped
+        """
+        if self._park_in_progress:
+            self.send_request({"method": "stop_feed_assist", "params": {"index": self._park_index}},
+                              lambda response: None)
+            self._park_in_progress = False
+            self._park_index = -1
+        self._journal_toolchange(was, tool, marks, error, overlapped)
+        self._commit_intent(-1)
+
+    def _overlap_park(self, was: int, tool: int, retract_length: int, retract_speed: int,
+                      unwind_reply) -> bool:
+        """
+        Запускает парковку нового слота во время отката старого
+        Starts parking the new slot while the old one is still retracting.
+        Returns False (and leaves nothing running) whenever an interlock fails,
+        the caller then continues with the sequential toolchange.
+        """
+        if not 0 < self.toolchange_overlap_length < retract_length:
+            return False
+        # Поздний ответ только сдвигает оценку прогресса в безопасную сторону
+        # A late reply only shifts the progress estimate to the safe side
+        response = unwind_reply.wait(self.reactor.monotonic() + retract_length / retract_speed
+                                     + self._response_timeout * 2)
+        if response is None or response.get('code', 0) != 0:
+            return False
+        # Откат начался с ответом устройства; прогресс оцениваем по времени
+        # The retract starts with the device reply; progress is estimated from elapsed time
+        retract_start = self._last_rx_time
+        retract_end = retract_start + retract_length / retract_speed
+        clear_time = retract_start + self.toolchange_overlap_length / retract_speed
+
+        def interlocks_ok() -> bool:
+            slots = self._info['slots']
+            return (self._connected and slots[was]['status'] == 'ready'
+                    and slots[tool]['status'] == 'ready')
+
+        while self.reactor.monotonic() < clear_time:
+            if not interlocks_ok():
+                return False
+            self.reactor.pause(min(clear_time, self.reactor.monotonic() + ACTION_POLL_TIME))
+        if not interlocks_ok() or self._park_in_progress:
+            return False
+        self.logger.info(f"Slot {was} cleared {self.toolchange_overlap_length}mm, "
+                         f"parking slot {tool} during the retract")
+        self._park_to_toolhead(tool)
+        # Окно "feed assist не работает" отсчитывается от конца отката: во время
+        # отката устройство busy и проверки парковки не выполняются
+        # The "feed assist not working" window starts when the retract ends
+        self._park_start_time = max(self._park_start_time, retract_end)
+        timeout = self.reactor.monotonic() + self._response_timeout * 2
+        while self._park_in_progress and not self._park_assist_started:
+            if self.reactor.monotonic() > timeout:
+                break
+            self.reactor.pause(self.reactor.monotonic() + 0.05)
+        if not self._park_assist_started:
+            # Прошивка отклонила feed assist во время движения
+            # The firmware rejected feed assist while the retract is running
+            self._abort_overlap_park(tool)
+            return False
+        # Откат должен закончиться до того, как парковка продолжится сама по себе
+        # Hold here until the retract is over, so errors still fall back cleanly
+        timeout = retract_end + self._response_timeout * 2 + 5.0
+        while self.reactor.monotonic() < timeout:
+            if self._park_error or not interlocks_ok():
+                self._abort_overlap_park(tool)
+                return False
+            if self.reactor.monotonic() >= retract_end and self._info.get('status') == 'ready':
+                return True
+            self.reactor.pause(self.reactor.monotonic() + ACTION_POLL_TIME)
+        self._abort_overlap_park(tool)
+        return False
+
+    def _abort_overlap_park(self, tool: int):
+        self.send_request({"method": "stop_feed_assist", "params": {"index": tool}},
+                          lambda response: None)
+        self._park_in_progress = False
+        self._park_error = False
+        self._park_index = -1
+
+    def cmd_ACE_SET_INFINITY_SPOOL_ORDER(self, gcmd):
+        """Set the order of slots for infinity spool mode"""
         order_str = gcmd.get('ORDER', '')
         
         if not order_str:
@@ -1042,39 +2775,27 @@ class ValgAce:
             self.logger.error(f"Error setting infinity spool order: {str(e)}")
             gcmd.respond_raw(f"Error: {str(e)}")
 
-    def cmd_ACE_INFINITY_SPOOL(self, gcmd):
-        was = self.variables.get('ace_current_index', -1)
-        infsp_status = self.infinity_spool_mode
-        
-        if not infsp_status:
-            gcmd.respond_info(f"ACE_INFINITY_SPOOL disabled")
-            gcmd.respond_info(f"ACE_INFINITY_SPOOL status {infsp_status}")
-            return
-        if was == -1:
-            gcmd.respond_info(f"Tool is not set")
-            return
-        
-        # Get order from variables
-        order_str = self.variables.get('ace_infsp_order', '')
-        if not order_str:
-            gcmd.respond_raw("Error: Infinity spool order not set. Use ACE_SET_INFINITY_SPOOL_ORDER ORDER=\"...\" first")
-            gcmd.respond_info("Example: ACE_SET_INFINITY_SPOOL_ORDER ORDER=\"0,1,2,3\"")
-            return
-        
-        # Parse order
+    def _parse_infinity_order(self, order):
+        """Разбор порядка infinity spool: строка "0,1,none,3" (или кортеж из старых vars.cfg)"""
+        items = order.split(',') if isinstance(order, str) else list(order)
         try:
             order_list = []
-            for item in order_str.split(','):
-                item = item.strip().lower()
+            for item in items:
+                item = str(item).strip().lower()
                 if item == 'none':
                     order_list.append('none')
                 else:
                     order_list.append(int(item))
+            return order_list
         except Exception as e:
             self.logger.error(f"Error parsing infinity spool order: {str(e)}")
-            gcmd.respond_raw(f"Error: Invalid order format: {order_str}")
-            return
-        
+            return None
+
+    def _find_next_infinity_slot(self, was: int, order_list):
+        """
+        Следующий готовый слот после текущего в порядке infinity spool
+        Returns (slot, position in order) or (None, None)
+        """
         # Get current position in order (if set, otherwise find current slot)
         saved_position = self.variables.get('ace_infsp_position', -1)
         
@@ -1103,12 +2824,8 @@ class ValgAce:
         if current_order_index == -1:
             # Current slot not found in order, start from beginning
             self.logger.warning(f"Current slot {was} not found in order, starting from beginning")
-            current_order_index = -1
         
         # Find next valid slot (skip 'none'), cycling through order
-        tool = None
-        new_position = None
-        
         # Search through entire order (max one full cycle)
         for i in range(len(order_list)):
             next_index = (current_order_index + 1 + i) % len(order_list)
@@ -1119,9 +2836,43 @@ class ValgAce:
             
             # Check if slot is ready
             if self._info['slots'][next_slot]['status'] == 'ready':
-                tool = next_slot
-                new_position = next_index
-                break
+                return next_slot, next_index
+        return None, None
+
+    def cmd_ACE_INFINITY_SPOOL(self, gcmd):
+        was = self.variables.get('ace_current_index', -1)
+        toolchange_start = self.reactor.monotonic()
+        infsp_status = self.infinity_spool_mode
+        
+        if not infsp_status:
+            gcmd.respond_info(f"ACE_INFINITY_SPOOL disabled")
+            gcmd.respond_info(f"ACE_INFINITY_SPOOL status {infsp_status}")
+            return
+        if was == -1:
+            gcmd.respond_info(f"Tool is not set")
+            return
+        
+        # Get order from variables
+        order_str = self.variables.get('ace_infsp_order', '')
+        if not order_str:
+            gcmd.respond_raw("Error: Infinity spool order not set. Use ACE_SET_INFINITY_SPOOL_ORDER ORDER=\"...\" first")
+            gcmd.respond_info("Example: ACE_SET_INFINITY_SPOOL_ORDER ORDER=\"0,1,2,3\"")
+            return
+        
+        # Parse order
+        order_list = self._parse_infinity_order(order_str)
+        if order_list is None:
+            gcmd.respond_raw(f"Error: Invalid order format: {order_str}")
+            return
+        
+        if self._staged_from == was and self._staged_slot in order_list \
+                and self._info['slots'][self._staged_slot]['status'] == 'ready':
+            # Слот уже подготовлен заранее по прогнозу расхода
+            # Slot was already staged by the runout prediction
+            tool = self._staged_slot
+            new_position = order_list.index(tool)
+        else:
+            tool, new_position = self._find_next_infinity_slot(was, order_list)
         
         if tool is None:
             gcmd.respond_raw("Error: No more ready slots available in order")
@@ -1150,13 +2901,20 @@ class ValgAce:
             parking_success['completed'] = True
             
             self.logger.info(f"INFINITY_SPOOL: parking complete for slot {tool}, executing post-processing")
+            self._intent_phase('post')
             self.gcode.run_script_from_command(f'_ACE_POST_INFINITYSPOOL')
             if self.toolhead:
                 self.toolhead.wait_moves()
             
-            # Save variables only on success
-            self._save_variable('ace_current_index', tool)
-            self._save_variable('ace_infsp_position', new_position)
+            # Save variables only on success; runs from the park check timer
+            self._update_usage()
+            self._staged_slot = self._staged_from = -1
+            self._save_variable('ace_infsp_position', new_position, defer=True)
+            self._commit_intent(tool, defer=True)
+            self._record_toolchange(toolchange_start)
+            self._journal.append('infinity_swap', **{
+                'from': was, 'to': tool,
+                'duration': round(self.reactor.monotonic() - toolchange_start, 2)})
             gcmd.respond_info(f"Tool changed from {was} to {tool}")
         
         def on_park_error():
@@ -1167,6 +2925,7 @@ class ValgAce:
             self.logger.error(f"INFINITY_SPOOL: parking failed for slot {tool}")
             gcmd.respond_raw(f"ACE Error: Failed to park slot {tool}")
             # Don't save variables on error
+            self._commit_intent(was, defer=True)
         
         # Start parking with monitoring
         self.logger.info(f"INFINITY_SPOOL: starting parking for slot {tool} with monitoring")
@@ -1182,6 +2941,7 @@ class ValgAce:
         self._park_count_increased = False
         
         # Start parking using direct function call
+        self._write_intent('infinity', was, tool, 'park', position=new_position)
         self._park_to_toolhead(tool)
         if self.toolhead:
             self.toolhead.wait_moves()
@@ -1208,6 +2968,7 @@ class ValgAce:
                 self.logger.error(f"INFINITY_SPOOL: parking timeout after {elapsed:.1f}s")
                 self._park_in_progress = False
                 self._park_error = True
+                self._park_failed(tool, 'timeout')
                 on_park_error()
                 return self.reactor.NEVER
             
@@ -1215,7 +2976,1527 @@ class ValgAce:
             return eventtime + 0.5
         
         # Register monitoring timer
-        self.reactor.register_timer(check_parking_status, self.reactor.monotonic() + 0.5)
+        self._scheduler.call_later(0.5, check_parking_status, 'infinity_park_check')
+
+
+class _ScheduledCall:
+    __slots__ = ('name', 'callback', 'waketime', 'cancelled')
+
+    def __init__(self, name: str, callback: Callable, waketime: float):
+        self.name = name
+        self.callback = callback
+        self.waketime = waketime
+        self.cancelled = False
+
+
+class AceScheduler:
+    """
+    Отложенные задачи ACE на одном таймере реактора и куче сроков
+    Callbacks get eventtime and return the next waketime to repeat,
+    or None / reactor.NEVER to finish
+    """
+    def __init__(self, reactor, profiler: 'AceProfiler', logger):
+        self._reactor = reactor
+        self._profiler = profiler
+        self._logger = logger
+        self._heap = []
+        self._seq = 0
+        self._cancelled = 0
+        self._running = False
+        self._timer = reactor.register_timer(profiler.timer('scheduler', self._run))
+
+    def call_at(self, waketime: float, callback: Callable, name: str = 'task') -> _ScheduledCall:
+        call = _ScheduledCall(name, callback, waketime)
+        self._push(call)
+        return call
+
+    def call_later(self, delay: float, callback: Callable, name: str = 'task') -> _ScheduledCall:
+        return self.call_at(self._reactor.monotonic() + delay, callback, name)
+
+    def cancel(self, call: Optional[_ScheduledCall]):
+        if call is None or call.cancelled:
+            return
+        call.cancelled = True
+        if call.waketime is None:
+            # Задача выполняется прямо сейчас и не будет перепланирована
+            # The call is running right now and will not be rescheduled
+            return
+        self._cancelled += 1
+        # Отмененные записи удаляются лениво; перестраиваем кучу, если их больше половины
+        # Cancelled entries are dropped lazily; rebuild once they are the majority
+        if self._cancelled > len(self._heap) // 2:
+            self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
+
+    def pending(self) -> int:
+        return len(self._heap) - self._cancelled
+
+    def _push(self, call: _ScheduledCall):
+        self._seq += 1
+        heapq.heappush(self._heap, (call.waketime, self._seq, call))
+        if not self._running and self._heap[0][2] is call:
+            self._reactor.update_timer(self._timer, call.waketime)
+
+    def _run(self, eventtime):
+        heap = self._heap
+        never = self._reactor.NEVER
+        profiler = self._profiler
+        self._running = True
+        try:
+            while heap and heap[0][0] <= eventtime:
+                waketime, _, call = heapq.heappop(heap)
+                call.waketime = None
+                if call.cancelled:
+                    self._cancelled -= 1
+                    continue
+                try:
+                    if profiler.enabled:
+                        start = time.perf_counter()
+                        next_waketime = call.callback(eventtime)
+                        profiler.record(call.name, time.perf_counter() - start,
+                                        max(0., eventtime - waketime) if waketime else None)
+                    else:
+                        next_waketime = call.callback(eventtime)
+                except Exception:
+                    self._logger.exception(f"Scheduled task {call.name} failed")
+                    continue
+                if next_waketime is not None and next_waketime < never and not call.cancelled:
+                    call.waketime = next_waketime
+                    self._seq += 1
+                    heapq.heappush(heap, (next_waketime, self._seq, call))
+        finally:
+            self._running = False
+        return heap[0][0] if heap else never
+
+
+class AceDryingScheduler:
+    """
+    Очередь сушки по профилям материалов, выполняется в простое принтера
+    Drying jobs run one at a time on the single dryer once the printer has been idle
+    for idle_delay; a print stops the dryer and the job resumes afterwards. The
+    remaining time of each stage is saved in ace_drying_queue and survives restarts.
+    """
+    def __init__(self, ace: 'ValgAce', profiles: Dict[str, tuple], auto: bool, idle_delay: float):
+        self.ace = ace
+        self.profiles = profiles
+        self.auto = auto
+        self.idle_delay = idle_delay
+        self._reactor = ace.reactor
+        self._scheduler = ace._scheduler
+        saved = ace.variables.get('ace_drying_queue')
+        self.queue = [dict(job) for job in saved if isinstance(job, dict)
+                      and job.get('profile') in profiles
+                      and 0 <= job.get('stage', -1) < len(profiles[job['profile']])] \
+            if isinstance(saved, list) else []
+        # Сушилкой управляет очередь (задача queue[0] запущена) / queue[0] owns the dryer
+        self._running = False
+        # Сушка на устройстве запущена очередью (после перезапуска - считаем, что да)
+        # The dryer was started by the queue (assumed after a restart)
+        self._owned = bool(self.queue)
+        self._starting = False
+        self._last_tick = None
+        self._last_busy = None
+        self._last_save = 0.
+        if auto:
+            ace.printer.register_event_handler('ace:slot_changed', self._handle_slot_changed)
+
+    def start(self):
+        self._scheduler.call_later(DRYING_CHECK_INTERVAL, self._tick, 'drying_scheduler')
+
+    def profile_for(self, material: str) -> Optional[str]:
+        """Профиль по типу материала из RFID: точное совпадение или самый длинный префикс (PETG-CF -> PETG)"""
+        material = (material or '').upper()
+        if material in self.profiles:
+            return material
+        matches = [name for name in self.profiles if material.startswith(name)]
+        return max(matches, key=len) if matches else None
+
+    def format_profile(self, name: str) -> str:
+        return ", ".join(f"{temp}°C {minutes} min fan {fan}" for temp, minutes, fan in self.profiles[name])
+
+    def enqueue(self, name: str) -> bool:
+        if any(job['profile'] == name for job in self.queue):
+            return False
+        self.queue.append({'profile': name, 'stage': 0, 'remain': self.profiles[name][0][1] * 60.})
+        self._save()
+        return True
+
+    def clear(self):
+        if self._running:
+            self.ace._stop_dryer('stopped')
+        self._running = self._owned = False
+        self.queue = []
+        self._save()
+
+    def release(self, drop: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        Сушилку забрала ручная команда: задача остается в очереди (или удаляется при drop)
+        A manual drying command took the dryer over: keep the job queued, or drop it
+        """
+        self._owned = False
+        if not self._running:
+            return None
+        self._running = False
+        job = self.queue.pop(0) if drop else None
+        self._save()
+        return job
+
+    def get_status(self) -> Dict[str, Any]:
+        return {'state': self._state(),
+                'jobs': [dict(job, stages=len(self.profiles[job['profile']])) for job in self.queue]}
+
+    def _state(self) -> str:
+        if self._running:
+            return 'drying'
+        if not self.queue:
+            return 'idle'
+        return 'paused' if self._last_busy is not None else 'waiting'
+
+    def _save(self, eventtime: Optional[float] = None):
+        self._last_save = self._reactor.monotonic() if eventtime is None else eventtime
+        self.ace._save_variable('ace_drying_queue', [
+            dict(job, remain=round(job['remain'])) for job in self.queue], defer=True)
+
+    def _printing(self, eventtime) -> bool:
+        print_stats = self.ace._print_stats
+        if print_stats is None:
+            return False
+        return print_stats.get_status(eventtime).get('state') in ('printing', 'paused')
+
+    def _handle_slot_changed(self, eventtime, index, old, new):
+        slots = self.ace._info.get('slots', [])
+        slot = slots[index] if index < len(slots) else {}
+        if new.get('status', slot.get('status')) != 'ready' or not ('status' in new or 'type' in new):
+            return
+        name = self.profile_for(new.get('type', slot.get('type', '')))
+        if name is not None and self.enqueue(name):
+            self.ace.logger.info(f"Drying {name} queued for the spool in slot {index}")
+
+    def _tick(self, eventtime):
+        elapsed = 0. if self._last_tick is None else eventtime - self._last_tick
+        self._last_tick = eventtime
+        ace = self.ace
+        if self._printing(eventtime):
+            self._last_busy = eventtime
+            if self._running:
+                # Печать началась: останавливаем сушку, остаток стадии сохраняется
+                # A print started: stop the dryer, the stage keeps its remaining time
+                self._running = self._owned = False
+                ace._stop_dryer('paused')
+                ace._journal.append('drying', action='pause', profile=self.queue[0]['profile'])
+                self._save(eventtime)
+            return eventtime + DRYING_CHECK_INTERVAL
+        if self._running:
+            job = self.queue[0]
+            job['remain'] -= elapsed
+            if job['remain'] > 0.:
+                if eventtime - self._last_save >= DRYING_SAVE_INTERVAL:
+                    self._save(eventtime)
+                return eventtime + DRYING_CHECK_INTERVAL
+            stages = self.profiles[job['profile']]
+            self._running = False
+            if job['stage'] + 1 < len(stages):
+                job['stage'] += 1
+                job['remain'] = stages[job['stage']][1] * 60.
+            else:
+                self.queue.pop(0)
+                ace._journal.append('drying', action='done', profile=job['profile'])
+                ace.logger.info(f"Drying {job['profile']} finished")
+                if not self.queue:
+                    self._owned = False
+                    ace._stop_dryer('done')
+            self._save(eventtime)
+        if not self.queue or self._starting or not ace._connected:
+            return eventtime + DRYING_CHECK_INTERVAL
+        if self._last_busy is not None and eventtime - self._last_busy < self.idle_delay:
+            return eventtime + DRYING_CHECK_INTERVAL
+        if ace._info.get('dryer', {}).get('status') == 'drying' and not self._owned:
+            # Сушилка занята ручной командой ACE_START_DRYING / Manual drying is running
+            return eventtime + DRYING_CHECK_INTERVAL
+        self._last_busy = None
+        self._start_stage(self.queue[0])
+        return eventtime + DRYING_CHECK_INTERVAL
+
+    def _start_stage(self, job: Dict[str, Any]):
+        temp, minutes, fan = self.profiles[job['profile']][job['stage']]
+        duration = max(1, int(math.ceil(job['remain'] / 60.)))
+        self._starting = True
+
+        def callback(response):
+            self._starting = False
+            if response.get('code', 0) != 0:
+                self.ace.logger.warning(f"Drying {job['profile']} start failed: {response.get('msg', '')}")
+                return
+            if not self.queue or self.queue[0] is not job:
+                return
+            self._running = self._owned = True
+            self.ace._journal.append('drying', action='start', temp=temp, duration=duration,
+                                     profile=job['profile'], stage=job['stage'])
+            self.ace.logger.info(f"Drying {job['profile']} stage {job['stage'] + 1}: "
+                                 f"{temp}°C for {duration} min")
+        self.ace.send_request({"method": "drying", "params": {
+            "temp": temp, "fan_speed": fan, "duration": duration}}, callback)
+
+
+class AceSequence:
+    """
+    Шаги ACE_SEQUENCE, выполняемые планировщиком ACE
+    Consecutive 'reply' steps are pipelined: they are sent back to back and
+    only a motion, park or wait step waits for their replies first
+    """
+    def __init__(self, ace: 'ValgAce', steps):
+        self.ace = ace
+        self.steps = steps
+        self.duration = 0.
+        self._reactor = ace.reactor
+        self._scheduler = ace._scheduler
+        self._next = 0
+        self._outstanding = 0
+        self._failed = False
+        self._timeout_call = None
+        self._completion = self._reactor.completion()
+
+    def run(self) -> bool:
+        """Запускает шаги и ждет окончания (блокирует вызывающую G-code команду)"""
+        start = self._reactor.monotonic()
+        self._scheduler.call_at(self._reactor.NOW, self._advance, 'sequence')
+        limit = sum(self._step_timeout(step) for step in self.steps) + 5.0
+        ok = self._completion.wait(start + limit, False)
+        self._failed = self._failed or not ok
+        self.abort()
+        self.duration = self._reactor.monotonic() - start
+        return ok
+
+    def _step_timeout(self, step) -> float:
+        if step['timeout'] is not None:
+            return step['timeout']
+        if step['kind'] == 'motion':
+            return step['params']['length'] / step['params']['speed'] * 2 + 5.0
+        if step['kind'] == 'park':
+            return SEQUENCE_PARK_TIMEOUT
+        if step['kind'] == 'wait':
+            return step['delay'] + 1.0
+        return self.ace._response_timeout * 2
+
+    def _finish_step(self, step, ok: bool, msg: str = ""):
+        if 'end' in step or self._failed:
+            return
+        step['end'] = self._reactor.monotonic()
+        step['ok'] = ok
+        step['msg'] = msg
+        if step.get('timeout_call') is not None:
+            self._scheduler.cancel(step.pop('timeout_call'))
+        if not ok:
+            self._failed = True
+            self._completion.complete(False)
+            return
+        self._scheduler.call_at(self._reactor.NOW, self._advance, 'sequence')
+
+    def _advance(self, eventtime):
+        if self._failed or self._completion.test():
+            return None
+        while self._next < len(self.steps):
+            step = self.steps[self._next]
+            if step['kind'] != 'reply' and self._outstanding:
+                return None  # ждем ответы на отправленные шаги
+            if self._next > 0 and 'end' not in self.steps[self._next - 1] \
+                    and self.steps[self._next - 1]['kind'] != 'reply':
+                return None  # предыдущий шаг еще выполняется
+            self._next += 1
+            self._start_step(step, eventtime)
+            if step['kind'] != 'reply':
+                return None
+        if not self._outstanding and all('end' in step for step in self.steps):
+            self._completion.complete(True)
+        return None
+
+    def _start_step(self, step, eventtime):
+        step['start'] = eventtime
+        step['timeout_call'] = self._scheduler.call_later(
+            self._step_timeout(step),
+            lambda e: self._finish_step(step, False, "timeout"), 'sequence_timeout')
+        ace = self.ace
+        kind = step['kind']
+        if kind == 'wait':
+            self._scheduler.call_later(step['delay'], lambda e: self._finish_step(step, True),
+                                       'sequence_wait')
+            return
+        if kind == 'park':
+            self._start_park(step)
+            return
+        if kind == 'reply':
+            self._outstanding += 1
+
+        def callback(response):
+            if kind == 'reply':
+                self._outstanding -= 1
+            if response.get('code', 0) != 0:
+                self._finish_step(step, False, response.get('msg', 'Unknown error'))
+                return
+            if kind == 'reply':
+                if step['op'] == 'assist':
+                    ace._feed_assist_index = step['params']['index']
+                elif step['op'] == 'stop_assist':
+                    ace._feed_assist_index = -1
+                self._finish_step(step, True)
+                return
+            params = step['params']
+            step['waiter'] = ace._add_action_waiter(
+                params['index'], ace._last_rx_time,
+                step['start'] + params['length'] / params['speed'],
+                lambda ok, msg: self._finish_step(step, ok, msg))
+        ace.send_request({"method": step['method'], "params": dict(step['params'])}, callback)
+
+    def _start_park(self, step):
+        ace = self.ace
+        index = step['params']['index']
+        if ace._info['slots'][index]['status'] != 'ready':
+            self._finish_step(step, False, f"Slot {index} is not ready")
+            return
+        if ace._park_in_progress:
+            self._finish_step(step, False, f"Slot {ace._park_index} is already parking")
+            return
+        ace._park_to_toolhead(index)
+        step['parking'] = True
+
+        def check(eventtime):
+            if 'end' in step or self._failed:
+                return None
+            if ace._park_error:
+                self._finish_step(step, False, "parking failed")
+                return None
+            if not ace._park_in_progress:
+                self._finish_step(step, True)
+                return None
+            return eventtime + 0.1
+        self._scheduler.call_later(0.1, check, 'sequence_park_check')
+
+    def abort(self):
+        """Снимает ожидания; прерванная подача/откат/парковка останавливается"""
+        ace = self.ace
+        for step in self.steps:
+            if step.get('parking') and not step.get('ok') and ace._park_in_progress \
+                    and ace._park_index == step['params']['index']:
+                ace._abort_overlap_park(step['params']['index'])
+            if step.get('waiter') is not None:
+                self.ace._remove_action_waiter(step['waiter'])
+                if not step.get('ok'):
+                    method = 'stop_feed_filament' if step['op'] == 'feed' else 'stop_unwind_filament'
+                    self.ace.send_request({"method": method,
+                                           "params": {"index": step['params']['index']}},
+                                          lambda response: None)
+            if step.get('timeout_call') is not None:
+                self._scheduler.cancel(step['timeout_call'])
+
+
+class AcePreload:
+    """
+    Предзагрузка слотов: один автомат состояний на все выбранные слоты
+    One state machine for ACE_PRELOAD: a single get_status verifies every slot,
+    RFID info requests go out together, feeds run up to preload_parallel at once
+    checking -> (info) -> queued -> feeding -> staged, or ready/loaded/empty/error
+    """
+    def __init__(self, ace: 'ValgAce', slots, length: int, force: bool = False):
+        self.ace = ace
+        self.slots = slots
+        self.length = length
+        self.force = force
+        self.duration = 0.
+        self._reactor = ace.reactor
+        self._scheduler = ace._scheduler
+        self._states = ace._preload_slots
+        self._start = 0.
+        self._waiters = {}
+        self._timeouts = {}
+        self._retry_call = None
+        self._completion = self._reactor.completion()
+
+    def _set(self, index: int, state: str, error: str = ""):
+        self._states[index] = {'state': state, 'error': error}
+
+    def _state(self, index: int) -> str:
+        return self._states[index]['state']
+
+    def start(self):
+        ace = self.ace
+        self._start = self._reactor.monotonic()
+        ace._preload = self
+        for index in self.slots:
+            if self.force or self._state(index) != 'staged':
+                self._set(index, 'checking')
+        ace.send_request({"method": "get_status", "params": {}}, self._handle_status)
+        self._scheduler.call_later(ace._response_timeout * 2, self._check_replies,
+                                   'preload_reply_timeout')
+
+    def wait(self) -> bool:
+        """Ждет окончания предзагрузки (блокирует вызывающую G-code команду)"""
+        limit = self.ace._response_timeout * 4 + len(self.slots) * (
+            self.length / self._min_speed() * 2 + 5.0)
+        ok = self._completion.wait(self._start + limit, None)
+        if ok is None:
+            for index in self.slots:
+                if self._state(index) not in PRELOAD_DONE_STATES:
+                    self._set(index, 'error', "timeout")
+            self._finish()
+            ok = False
+        return ok
+
+    def _min_speed(self) -> int:
+        return max(1, min(self.ace._slot_param(index, 'feed_speed') for index in self.slots))
+
+    def _check_replies(self, eventtime):
+        """Нет ответа на get_status - ошибка; нет RFID информации - продолжаем без нее"""
+        if self._completion.test():
+            return None
+        pending = False
+        current = self.ace.variables.get('ace_current_index', -1)
+        for index in self.slots:
+            if self._state(index) == 'checking':
+                self._set(index, 'error', "no status reply")
+                pending = True
+            elif self._state(index) == 'info':
+                self.ace.logger.warning(f"Preload: no filament info reply for slot {index}")
+                self._set_feed_state(index, current)
+                pending = True
+        if pending:
+            self._advance()
+        return None
+
+    def _handle_status(self, response):
+        if self._completion.test():
+            return
+        ace = self.ace
+        result = response.get('result')
+        slots = result.get('slots') if isinstance(result, dict) else None
+        if response.get('code', 0) != 0 or not isinstance(slots, list):
+            for index in self.slots:
+                if self._state(index) == 'checking':
+                    self._set(index, 'error', response.get('msg', "no slot status"))
+            self._advance()
+            return
+        current = ace.variables.get('ace_current_index', -1)
+        for index in self.slots:
+            if self._state(index) != 'checking':
+                continue
+            slot = slots[index] if index < len(slots) else {}
+            if slot.get('status') != 'ready':
+                self._set(index, 'empty')
+                continue
+            if slot.get('rfid') == 2 and ace._filament_info[index] is None:
+                self._set(index, 'info')
+                ace._fetch_filament_info(index, lambda r, index=index: self._handle_info(index))
+                continue
+            self._set_feed_state(index, current)
+        if any(self._state(index) == 'info' for index in self.slots):
+            self._scheduler.call_later(ace._response_timeout * 2, self._check_replies,
+                                       'preload_reply_timeout')
+        self._advance()
+
+    def _handle_info(self, index: int):
+        if self._state(index) == 'info' and not self._completion.test():
+            self._set_feed_state(index, self.ace.variables.get('ace_current_index', -1))
+            self._advance()
+
+    def _set_feed_state(self, index: int, current: int):
+        if index == current:
+            self._set(index, 'loaded')
+        elif self.length > 0:
+            self._set(index, 'queued')
+        else:
+            self._set(index, 'ready')
+
+    def _advance(self, eventtime=None):
+        self._retry_call = None
+        if self._completion.test():
+            return None
+        feeding = sum(1 for index in self.slots if self._state(index) == 'feeding')
+        for index in self.slots:
+            if feeding >= self.ace.preload_parallel:
+                break
+            if self._state(index) == 'queued':
+                feeding += 1
+                self._start_feed(index)
+        if all(self._state(index) in PRELOAD_DONE_STATES for index in self.slots):
+            self._finish()
+        return None
+
+    def _start_feed(self, index: int):
+        ace = self.ace
+        speed = ace._slot_param(index, 'feed_speed')
+        self._set(index, 'feeding')
+        start = self._reactor.monotonic()
+        self._timeouts[index] = self._scheduler.call_later(
+            self.length / speed * 2 + 5.0,
+            lambda e: self._feed_done(index, False, "timeout"), 'preload_timeout')
+
+        def callback(response):
+            if self._state(index) != 'feeding':
+                return
+            if response.get('code', 0) != 0:
+                msg = response.get('msg', 'Unknown error')
+                if 'busy' in str(msg).lower():
+                    # Устройство занято другим движением: повторить позже
+                    # Device is busy with another move: retry later
+                    self._scheduler.cancel(self._timeouts.pop(index, None))
+                    self._set(index, 'queued')
+                    if self._retry_call is None:
+                        self._retry_call = self._scheduler.call_later(
+                            ACTION_POLL_TIME, self._advance, 'preload_retry')
+                    return
+                self._feed_done(index, False, msg)
+                return
+            self._waiters[index] = ace._add_action_waiter(
+                index, ace._last_rx_time, start + self.length / speed,
+                lambda ok, msg: self._feed_done(index, ok, msg))
+        ace.send_request({
+            "method": "feed_filament",
+            "params": {"index": index, "length": self.length, "speed": speed}
+        }, callback)
+
+    def _feed_done(self, index: int, ok: bool, msg: str = ""):
+        if self._state(index) != 'feeding':
+            return
+        self._scheduler.cancel(self._timeouts.pop(index, None))
+        waiter = self._waiters.pop(index, None)
+        if waiter is not None:
+            self.ace._remove_action_waiter(waiter)
+        if ok:
+            self._set(index, 'staged')
+        else:
+            self._set(index, 'error', msg)
+            self.ace.send_request({"method": "stop_feed_filament", "params": {"index": index}},
+                                  lambda response: None)
+        self._scheduler.call_at(self._reactor.NOW, self._advance, 'preload')
+
+    def _finish(self):
+        if self._completion.test():
+            return
+        for waiter in self._waiters.values():
+            self.ace._remove_action_waiter(waiter)
+        for call in self._timeouts.values():
+            self._scheduler.cancel(call)
+        self._scheduler.cancel(self._retry_call)
+        self._waiters.clear()
+        self._timeouts.clear()
+        self.duration = self._reactor.monotonic() - self._start
+        self.ace._preload = None
+        ok = all(self._state(index) != 'error' for index in self.slots)
+        self.ace.logger.info("Preload finished in %.2fs: %s" % (
+            self.duration, ', '.join(f"{index}={self._state(index)}" for index in self.slots)))
+        self._completion.complete(ok)
+
+
+class AceProfiler:
+    """
+    Время реактора, занятое таймерами и колбэками ACE
+    Per-handler call count, wall time and timer lag; disabled handlers pay one flag check
+    """
+    def __init__(self, reactor, enabled: bool = False):
+        self._reactor = reactor
+        self.enabled = enabled
+        # name -> [calls, total, max, lag samples, lag total, lag max]
+        self._stats = {}
+        # Таймеры - верхний уровень; process_messages и колбэки выполняются внутри них
+        # Timers are top level; process_messages and callbacks run inside them
+        self._timer_names = set()
+        self._since = reactor.monotonic()
+
+    def reset(self):
+        self._stats.clear()
+        self._since = self._reactor.monotonic()
+
+    def record(self, name: str, elapsed: float, lag: Optional[float] = None):
+        stat = self._stats.get(name)
+        if stat is None:
+            stat = self._stats[name] = [0, 0., 0., 0, 0., 0.]
+        stat[0] += 1
+        stat[1] += elapsed
+        if elapsed > stat[2]:
+            stat[2] = elapsed
+        if lag is not None:
+            stat[3] += 1
+            stat[4] += lag
+            if lag > stat[5]:
+                stat[5] = lag
+
+    def call(self, name: str, func: Callable, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    @staticmethod
+    def callback_name(callback: Callable) -> str:
+        name = getattr(callback, '__qualname__', repr(callback))
+        return 'callback:' + name.replace('ValgAce.', '').replace('.<locals>', '')
+
+    def timer(self, name: str, handler: Callable, waketime: Optional[float] = None) -> Callable:
+        """Обертка таймера реактора; задержка = факт - запланированное время"""
+        never = self._reactor.NEVER
+        expected = [waketime]
+        self._timer_names.add(name)
+
+        def wrapper(eventtime):
+            if not self.enabled:
+                expected[0] = None
+                return handler(eventtime)
+            start = time.perf_counter()
+            next_waketime = handler(eventtime)
+            lag = None if expected[0] is None else max(0., eventtime - expected[0])
+            self.record(name, time.perf_counter() - start, lag)
+            expected[0] = next_waketime if 0. < next_waketime < never else None
+            return next_waketime
+        return wrapper
+
+    def get_status(self, eventtime: float) -> Dict[str, Any]:
+        if not self.enabled:
+            return {'enabled': False}
+        return {
+            'enabled': True,
+            'duration': round(eventtime - self._since, 1),
+            'handlers': {name: {
+                'calls': calls,
+                'total_ms': round(total * 1000., 3),
+                'max_ms': round(max_time * 1000., 3),
+                'lag_avg_ms': round(lag_total / lag_calls * 1000., 3) if lag_calls else None,
+                'lag_max_ms': round(lag_max * 1000., 3) if lag_calls else None,
+            } for name, (calls, total, max_time, lag_calls, lag_total, lag_max) in self._stats.items()},
+        }
+
+    def report(self) -> List[str]:
+        if not self.enabled:
+            return ["ACE profiling is disabled (ACE_PROFILE ENABLE=1)"]
+        duration = max(1e-6, self._reactor.monotonic() - self._since)
+        lines = [f"ACE reactor profile over {duration:.1f}s:"]
+        stats = sorted(self._stats.items(), key=lambda item: item[1][1], reverse=True)
+        busy = 0.
+        for name, (calls, total, max_time, lag_calls, lag_total, lag_max) in stats:
+            if name in self._timer_names:
+                busy += total
+            line = (f"{name}: {calls} calls, total {total * 1000.:.1f}ms, "
+                    f"avg {total / calls * 1e6:.0f}us, max {max_time * 1000.:.2f}ms")
+            if lag_calls:
+                line += f", lag avg {lag_total / lag_calls * 1000.:.1f}ms max {lag_max * 1000.:.1f}ms"
+            lines.append(line)
+        lines.append(f"Timers total: {busy * 1000.:.1f}ms ({busy / duration * 100.:.2f}% of reactor time)")
+        return lines
+
+
+def _srgb_to_lab(rgb):
+    """sRGB (0-255) -> CIE L*a*b* (D65)"""
+    def linear(c):
+        c = min(max(float(c), 0.), 255.) / 255.
+        return c / 12.92 if c <= 0.04045 else ((c + 0.055) / 1.055) ** 2.4
+    r, g, b = (linear(c) for c in rgb[:3])
+    x = (0.4124 * r + 0.3576 * g + 0.1805 * b) / 0.95047
+    y = 0.2126 * r + 0.7152 * g + 0.0722 * b
+    z = (0.0193 * r + 0.1192 * g + 0.9505 * b) / 1.08883
+
+    def f(t):
+        return t ** (1. / 3.) if t > 0.008856 else 7.787 * t + 16. / 116.
+    fx, fy, fz = f(x), f(y), f(z)
+    return 116. * fy - 16., 500. * (fx - fy), 200. * (fy - fz)
+
+
+def _ciede2000(lab1, lab2) -> float:
+    """Цветовое расстояние CIEDE2000"""
+    l1, a1, b1 = lab1
+    l2, a2, b2 = lab2
+    c_mean = (math.hypot(a1, b1) + math.hypot(a2, b2)) / 2.
+    g = 0.5 * (1. - math.sqrt(c_mean ** 7 / (c_mean ** 7 + 25. ** 7)))
+    a1p, a2p = a1 * (1. + g), a2 * (1. + g)
+    c1p, c2p = math.hypot(a1p, b1), math.hypot(a2p, b2)
+    h1p = math.degrees(math.atan2(b1, a1p)) % 360.
+    h2p = math.degrees(math.atan2(b2, a2p)) % 360.
+    dl = l2 - l1
+    dc = c2p - c1p
+    dh = 0.
+    if c1p * c2p:
+        dh = h2p - h1p
+        if dh > 180.:
+            dh -= 360.
+        elif dh < -180.:
+            dh += 360.
+    dhp = 2. * math.sqrt(c1p * c2p) * math.sin(math.radians(dh) / 2.)
+    l_mean = (l1 + l2) / 2.
+    cp_mean = (c1p + c2p) / 2.
+    h_mean = h1p + h2p
+    if c1p * c2p:
+        if abs(h1p - h2p) <= 180.:
+            h_mean /= 2.
+        elif h1p + h2p < 360.:
+            h_mean = (h_mean + 360.) / 2.
+        else:
+            h_mean = (h_mean - 360.) / 2.
+    t = (1. - 0.17 * math.cos(math.radians(h_mean - 30.)) + 0.24 * math.cos(math.radians(2. * h_mean))
+         + 0.32 * math.cos(math.radians(3. * h_mean + 6.)) - 0.20 * math.cos(math.radians(4. * h_mean - 63.)))
+    sl = 1. + 0.015 * (l_mean - 50.) ** 2 / math.sqrt(20. + (l_mean - 50.) ** 2)
+    sc = 1. + 0.045 * cp_mean
+    sh = 1. + 0.015 * cp_mean * t
+    rt = (-2. * math.sqrt(cp_mean ** 7 / (cp_mean ** 7 + 25. ** 7))
+          * math.sin(math.radians(60. * math.exp(-((h_mean - 275.) / 25.) ** 2))))
+    return math.sqrt((dl / sl) ** 2 + (dc / sc) ** 2 + (dhp / sh) ** 2
+                     + rt * (dc / sc) * (dhp / sh))
+
+
+class AcePurgeMatrix:
+    """
+    Объем промывки (мм³) для каждой пары слотов FROM -> TO
+    N x N matrix (N = slots reported by the device). Only the row and column of a
+    slot whose color or material changed are recomputed; per-pair overrides win.
+    volume = min + (max - min) * clamp(dE2000 / 100 * (1 + (L_to - L_from) / 100)),
+    times purge_material_factor when the material types differ. Unknown slots get max.
+    """
+    def __init__(self, min_volume: float, max_volume: float, material_factor: float, size: int = 4):
+        self.min_volume = min_volume
+        self.max_volume = max_volume
+        self.material_factor = material_factor
+        self.overrides = [[None] * size for _ in range(size)]
+        self._keys = [None] * size
+        self._labs = [None] * size
+        self._types = [''] * size
+        self._computed = [[0. if i == j else max_volume for j in range(size)] for i in range(size)]
+        self.matrix = [row[:] for row in self._computed]
+
+    def _resize(self, size: int):
+        old = len(self._keys)
+        if size == old:
+            return
+        self._keys = (self._keys + [None] * size)[:size]
+        self._labs = (self._labs + [None] * size)[:size]
+        self._types = (self._types + [''] * size)[:size]
+        self.overrides = [(row + [None] * size)[:size] for row in self.overrides[:size]] \
+            + [[None] * size for _ in range(size - old)]
+        self._computed = [[0. if i == j else self.max_volume for j in range(size)] for i in range(size)]
+        for i in range(size):
+            self._recompute(i)
+
+    def update(self, slots) -> bool:
+        """Пересчет строк/столбцов слотов, у которых изменился цвет или материал"""
+        self._resize(len(slots))
+        changed = False
+        for i, slot in enumerate(slots):
+            color = slot.get('color')
+            if slot.get('status') != 'ready' or not isinstance(color, (list, tuple)) or len(color) < 3:
+                key = None
+            else:
+                key = (tuple(color[:3]), str(slot.get('type') or '').upper())
+            if key == self._keys[i]:
+                continue
+            self._keys[i] = key
+            self._labs[i] = None if key is None else _srgb_to_lab(key[0])
+            self._types[i] = '' if key is None else key[1]
+            self._recompute(i)
+            changed = True
+        return changed
+
+    def _pair_volume(self, i: int, j: int) -> float:
+        if i == j:
+            return 0.
+        if self._labs[i] is None or self._labs[j] is None:
+            return self.max_volume
+        scale = _ciede2000(self._labs[i], self._labs[j]) / 100. \
+            * (1. + (self._labs[j][0] - self._labs[i][0]) / 100.)
+        volume = self.min_volume + (self.max_volume - self.min_volume) * min(max(scale, 0.), 1.)
+        if self._types[i] and self._types[j] and self._types[i] != self._types[j]:
+            volume *= self.material_factor
+        return round(volume, 1)
+
+    def _recompute(self, index: int):
+        for other in range(len(self._keys)):
+            self._computed[index][other] = self._pair_volume(index, other)
+            self._computed[other][index] = self._pair_volume(other, index)
+        self._apply()
+
+    def _apply(self):
+        self.matrix = [[self._computed[i][j] if self.overrides[i][j] is None else self.overrides[i][j]
+                        for j in range(len(self._keys))] for i in range(len(self._keys))]
+
+    def volume(self, from_index: int, to_index: int) -> float:
+        if to_index < 0 or from_index == to_index:
+            return 0.
+        if from_index < 0 or from_index >= len(self.matrix) or to_index >= len(self.matrix):
+            return self.max_volume
+        return self.matrix[from_index][to_index]
+
+    def override(self, from_index: int, to_index: int) -> Optional[float]:
+        return self.overrides[from_index][to_index]
+
+    def set_override(self, from_index: int, to_index: int, volume: Optional[float]):
+        self.overrides[from_index][to_index] = volume
+        self._apply()
+
+    def load_overrides(self, value):
+        size = len(self._keys)
+        self.overrides = [[None] * size for _ in range(size)]
+        if isinstance(value, (list, tuple)):
+            for i, row in enumerate(value[:size]):
+                if not isinstance(row, (list, tuple)):
+                    continue
+                for j, volume in enumerate(row[:size]):
+                    if isinstance(volume, (int, float)):
+                        self.overrides[i][j] = float(volume)
+        self._apply()
+
+
+class AceGcodePlan:
+    """
+    План инструментов G-code файла, читается построчно без загрузки в память
+    Ordered tool sequence, toolchange count and extruded length per tool (mm);
+    materials come from the slicer "; filament_type = PLA;PETG" comment
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.state = 'analyzing'
+        self.error = ''
+        self.tools = []
+        self.toolchanges = 0
+        self.lengths = {}
+        self.materials = []
+        self.waiters = []
+        self._file = None
+        self._tool = None
+        self._absolute = True
+        self._last_e = 0.
+        # Экструзия до первого выбора инструмента идет на уже заправленный
+        # Extrusion before the first tool select goes to the loaded tool
+        self.untooled_length = 0.
+
+    def feed(self, max_lines: int) -> bool:
+        """Разбирает до max_lines строк; True, когда анализ закончен"""
+        try:
+            if self._file is None:
+                self._file = open(self.path, 'rb')
+            for _ in range(max_lines):
+                line = self._file.readline()
+                if not line:
+                    break
+                try:
+                    self._parse_line(line)
+                except ValueError:
+                    # Поврежденная строка не прерывает анализ
+                    # A malformed line does not abort the analysis
+                    pass
+            else:
+                return False
+        except OSError as e:
+            self.state = 'error'
+            self.error = str(e)
+        else:
+            self.state = 'done'
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        return True
+
+    def _parse_line(self, line: bytes):
+        if line[:1] == b';':
+            if line.startswith(b'; filament_type ='):
+                self.materials = [item.strip().upper() for item in
+                                  line.split(b'=', 1)[1].decode('utf-8', 'replace').split(';')]
+            return
+        if b';' in line:
+            line = line.split(b';', 1)[0]
+        words = line.upper().split()
+        if not words:
+            return
+        cmd = words[0]
+        if cmd[:1] == b'T' and cmd[1:].isdigit():
+            self._select(int(cmd[1:]))
+        elif cmd in (b'G1', b'G0', b'G2', b'G3'):
+            for word in words[1:]:
+                if word[:1] == b'E':
+                    self._extrude(float(word[1:]))
+                    break
+        elif cmd == b'G92':
+            for word in words[1:]:
+                if word[:1] == b'E':
+                    self._last_e = float(word[1:])
+        elif cmd == b'M82':
+            self._absolute = True
+        elif cmd == b'M83':
+            self._absolute = False
+        elif cmd == b'ACE_CHANGE_TOOL':
+            for word in words[1:]:
+                if word.startswith(b'TOOL='):
+                    self._select(int(word[5:]))
+
+    def _select(self, tool: int):
+        if tool == self._tool or tool < 0:
+            return
+        if self._tool is not None:
+            self.toolchanges += 1
+        self._tool = tool
+        self.tools.append(tool)
+        self.lengths.setdefault(tool, 0.)
+
+    def _extrude(self, value: float):
+        delta = value - self._last_e if self._absolute else value
+        if self._absolute:
+            self._last_e = value
+        # Учитывается чистая экструзия: откат и возврат взаимно гасятся
+        # Net extrusion: a retract and its unretract cancel out
+        if self._tool is None:
+            self.untooled_length += delta
+        else:
+            self.lengths[self._tool] += delta
+
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            'file': os.path.basename(self.path),
+            'state': self.state,
+            'tools': self.tools[:PLAN_STATUS_TOOLS],
+            'toolchanges': self.toolchanges,
+            'untooled_length': round(self.untooled_length, 1),
+            'lengths': {str(tool): round(length, 1) for tool, length in sorted(self.lengths.items())},
+            'materials': self.materials,
+        }
+
+
+class AceHistogram:
+    """Гистограмма с фиксированными границами (le), как в Prometheus"""
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def snapshot(self) -> Dict[str, Any]:
+        cumulative = []
+        total = 0
+        for count in self.counts:
+            total += count
+            cumulative.append(total)
+        return {'buckets': list(self.buckets), 'counts': cumulative, 'sum': self.sum, 'count': total}
+
+
+class AceMetrics:
+    """
+    Счетчики связи с ACE и смен инструмента
+    Counters are plain attributes so hot paths only pay for an increment
+    """
+    COUNTERS = ('frames_sent', 'frames_received', 'crc_errors', 'incomplete_frames',
+                'queue_overflows', 'reconnects', 'request_timeouts', 'toolchanges', 'park_errors',
+                'toolchange_overlap_fallbacks')
+
+    def __init__(self):
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+        self.request_rtt = AceHistogram(REQUEST_RTT_BUCKETS)
+        self.toolchange_duration = AceHistogram(TOOLCHANGE_BUCKETS)
+
+    def snapshot(self, gauges: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            'counters': {name: getattr(self, name) for name in self.COUNTERS},
+            'gauges': dict(gauges),
+            'histograms': {
+                'request_rtt_seconds': self.request_rtt.snapshot(),
+                'toolchange_duration_seconds': self.toolchange_duration.snapshot(),
+            },
+        }
+
+
+class _HistoryTier:
+    """Ring buffer of fixed-size array() columns at one resolution"""
+    def __init__(self, resolution: float, capacity: int, fields):
+        self.resolution = resolution
+        self.capacity = capacity
+        self._fields = fields
+        self.time = array('d', [0.0]) * capacity
+        self.columns = [array(typecode, [0]) * capacity for _, typecode, _ in fields]
+        self._head = 0
+        self._count = 0
+        self._bucket = None
+        self._acc = [0.0] * len(fields)
+        self._samples = 0
+
+    def add(self, t: float, values):
+        bucket = t - (t % self.resolution)
+        if bucket != self._bucket:
+            if self._bucket is not None and self._samples:
+                self._flush()
+            self._bucket = bucket
+            self._samples = 0
+        for i, (_, _, agg) in enumerate(self._fields):
+            value = values[i]
+            if not self._samples or agg == 'last':
+                self._acc[i] = value
+            elif agg == 'mean':
+                self._acc[i] += value
+            elif value > self._acc[i]:
+                self._acc[i] = value
+        self._samples += 1
+
+    def _row(self):
+        row = []
+        for i, (_, typecode, agg) in enumerate(self._fields):
+            value = self._acc[i] / self._samples if agg == 'mean' else self._acc[i]
+            row.append(float(value) if typecode in 'fd' else int(value))
+        return row
+
+    def _flush(self):
+        idx = self._head
+        self.time[idx] = self._bucket
+        for column, value in zip(self.columns, self._row()):
+            column[idx] = value
+        self._head = (idx + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    def oldest(self) -> Optional[float]:
+        if self._count:
+            return self.time[(self._head - self._count) % self.capacity]
+        return self._bucket
+
+    def rows(self, start: Optional[float], end: Optional[float], names):
+        """Columns for rows with start <= time <= end, oldest first"""
+        first = (self._head - self._count) % self.capacity
+        times = (self.time[first:] + self.time[:first]) if first + self._count > self.capacity \
+            else self.time[first:first + self._count]
+        lo = bisect_left(times, start) if start is not None else 0
+        hi = bisect_right(times, end) if end is not None else len(times)
+        wanted = [i for i, (name, _, _) in enumerate(self._fields) if name in names]
+        result = {'time': list(times[lo:hi])}
+        for i in wanted:
+            column = self.columns[i]
+            ordered = (column[first:] + column[:first]) if first + self._count > self.capacity \
+                else column[first:first + self._count]
+            if column.typecode == 'f':
+                # float32 хранение, округляем для вывода
+                result[self._fields[i][0]] = [round(v, 2) for v in ordered[lo:hi]]
+            else:
+                result[self._fields[i][0]] = list(ordered[lo:hi])
+        # Текущий, еще не завершенный интервал
+        # Current, not yet complete bucket
+        if self._samples and (start is None or self._bucket >= start) \
+                and (end is None or self._bucket <= end):
+            row = self._row()
+            result['time'].append(self._bucket)
+            for i in wanted:
+                value = row[i]
+                result[self._fields[i][0]].append(round(value, 2) if isinstance(value, float) else value)
+        return result
+
+
+class AceTelemetryHistory:
+    """
+    История телеметрии ACE с несколькими разрешениями
+    Telemetry history at several resolutions (e.g. 1 s for an hour, 1 min
+    for a day). Memory is allocated once, old rows are overwritten.
+    """
+    # (name, array typecode, aggregation within a bucket)
+    FIELDS = (
+        ('temp', 'f', 'mean'),
+        ('fan_speed', 'f', 'mean'),
+        ('dryer_active', 'b', 'max'),
+        ('dryer_target_temp', 'f', 'last'),
+        ('dryer_remain_time', 'f', 'last'),
+        ('feed_assist_count', 'l', 'last'),
+    )
+
+    def __init__(self, tiers):
+        self.tiers = [_HistoryTier(res, points, self.FIELDS) for res, points in sorted(tiers)]
+
+    def record(self, t: float, values):
+        for tier in self.tiers:
+            tier.add(t, values)
+
+    def query(self, start: Optional[float] = None, end: Optional[float] = None,
+              resolution: Optional[float] = None, fields=None,
+              clock_offset: float = 0.) -> Dict[str, Any]:
+        """
+        start/end и время в ответе - unix time; строки хранятся по монотонным часам,
+        clock_offset = unix time - монотонное время в момент запроса
+        start/end and the returned times are unix time; rows are stored on the
+        monotonic clock and clock_offset (unix - monotonic, now) converts them
+        """
+        if start is not None:
+            start -= clock_offset
+        if end is not None:
+            end -= clock_offset
+        names = [name for name, _, _ in self.FIELDS]
+        if fields:
+            names = [name for name in names if name in fields]
+        if resolution is not None:
+            # Самый грубый уровень, не превышающий запрошенное разрешение
+            candidates = [t for t in self.tiers if t.resolution <= resolution] or self.tiers[:1]
+            tier = candidates[-1]
+        else:
+            # Самый точный уровень, покрывающий начало диапазона
+            tier = self.tiers[-1]
+            for candidate in self.tiers:
+                oldest = candidate.oldest()
+                if start is None or (oldest is not None and oldest <= start):
+                    tier = candidate
+                    break
+        result = tier.rows(start, end, names)
+        result['time'] = [round(t + clock_offset, 3) for t in result['time']]
+        result['resolution'] = tier.resolution
+        result['tiers'] = [{'resolution': t.resolution, 'points': t.capacity} for t in self.tiers]
+        return result
+
+
+class AceJournal:
+    """
+    Журнал событий ACE: записи только дописываются, файл ротируется по размеру
+    Record = JOURNAL_HEADER (payload length, unix time, type index, CRC32) +
+    compact JSON. Records are buffered in memory and written by a periodic
+    flush; once the file would exceed max_size it becomes <path>.1 (the previous
+    .1 is dropped), so the journal never takes more than about 2 x max_size on
+    disk. Headers of both files are kept in memory, so a query only reads the
+    payloads of the records it returns.
+    """
+    def __init__(self, path: Optional[str], max_size: int, logger):
+        self.path = os.path.expanduser(path) if path else None
+        self.max_size = max_size
+        self._logger = logger
+        # (unix time, type index, payload) еще не записанных событий
+        # (unix time, type index, payload) of records not written yet
+        self._pending = []
+        # (unix time, type index, payload offset, payload length) по файлам
+        # (unix time, type index, payload offset, payload length) per file
+        self._index = []
+        self._old_index = []
+        self._size = 0
+        if self.path:
+            self._old_index = self._load(self.path + '.1', truncate=False)
+            self._index = self._load(self.path, truncate=True)
+            self._size = self._index[-1][2] + self._index[-1][3] if self._index else 0
+
+    def _load(self, path: str, truncate: bool) -> list:
+        """
+        Индекс заголовков файла; запись, оборванная при сбое питания (или
+        заполненная нулями), и все после нее отбрасываются
+        """
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return []
+        index = []
+        valid = 0
+        try:
+            with open(path, 'rb') as f:
+                for stamp, code, offset, length in self._scan(f, size):
+                    index.append((stamp, code, offset, length))
+                    valid = offset + length
+            if valid < size and truncate:
+                self._logger.warning(f"ACE journal: dropping {size - valid} bytes of a torn record")
+                with open(path, 'r+b') as f:
+                    f.truncate(valid)
+        except OSError as e:
+            self._logger.warning(f"ACE journal {path} is not usable: {e}")
+        return index
+
+    @staticmethod
+    def _scan(f, size: int):
+        """(unix time, type index, payload offset, payload length) проверенных записей"""
+        f.seek(0)
+        data = f.read(size)
+        offset = 0
+        while offset + JOURNAL_HEADER.size <= size:
+            length, stamp, code, crc = JOURNAL_HEADER.unpack_from(data, offset)
+            start = offset + JOURNAL_HEADER.size
+            end = start + length
+            if end > size or zlib.crc32(data[start:end], zlib.crc32(
+                    data[offset:offset + JOURNAL_FIELDS.size])) != crc:
+                return
+            yield stamp, code, start, length
+            offset = end
+
+    @staticmethod
+    def _pack(stamp: float, code: int, payload: bytes) -> bytes:
+        fields = JOURNAL_FIELDS.pack(len(payload), stamp, code)
+        return JOURNAL_HEADER.pack(len(payload), stamp, code,
+                                   zlib.crc32(payload, zlib.crc32(fields))) + payload
+
+    def append(self, event_type: str, **fields):
+        payload = json.dumps(fields, separators=(',', ':')).encode('utf-8')
+        self._pending.append((time.time(), JOURNAL_TYPES.index(event_type), payload))
+
+    def flush(self):
+        if not self._pending or not self.path:
+            self._pending = []
+            return
+        records = [self._pack(*record) for record in self._pending]
+        data = b''.join(records)
+        try:
+            if self._size and self._size + len(data) > self.max_size:
+                os.replace(self.path, self.path + '.1')
+                self._old_index, self._index = self._index, []
+                self._size = 0
+            with open(self.path, 'ab') as f:
+                f.write(data)
+        except OSError as e:
+            self._logger.warning(f"ACE journal write failed: {e}")
+            self._pending = []
+            return
+        for (stamp, code, payload), record in zip(self._pending, records):
+            self._index.append((stamp, code, self._size + JOURNAL_HEADER.size, len(payload)))
+            self._size += len(record)
+        self._pending = []
+
+    def query(self, start: Optional[float] = None, end: Optional[float] = None,
+              types=None, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """События за интервал (unix time) нужных типов, старые первыми"""
+        codes = None if not types else {JOURNAL_TYPES.index(t) for t in types if t in JOURNAL_TYPES}
+
+        def wanted(stamp, code):
+            return not ((start is not None and stamp < start) or (end is not None and stamp > end)
+                        or (codes is not None and code not in codes) or code >= len(JOURNAL_TYPES))
+        # Фильтр по индексу в памяти, с диска читаются только выбранные записи
+        # Filter on the in-memory index, only the selected payloads are read
+        selected = []
+        if self.path:
+            for path, index in ((self.path + '.1', self._old_index), (self.path, self._index)):
+                selected.extend((path, stamp, code, offset, length)
+                                for stamp, code, offset, length in index if wanted(stamp, code))
+        selected.extend((None, stamp, code, payload, None)
+                        for stamp, code, payload in self._pending if wanted(stamp, code))
+        if limit is not None and limit >= 0:
+            selected = selected[-limit:] if limit else []
+        events = []
+        files = {}
+        try:
+            for path, stamp, code, offset, length in selected:
+                if path is None:
+                    payload = offset
+                else:
+                    if path not in files:
+                        files[path] = open(path, 'rb')
+                    files[path].seek(offset)
+                    payload = files[path].read(length)
+                try:
+                    fields = json.loads(payload)
+                except ValueError:
+                    continue
+                events.append(dict(fields, time=round(stamp, 3), type=JOURNAL_TYPES[code]))
+        except OSError as e:
+            self._logger.warning(f"ACE journal read failed: {e}")
+        finally:
+            for f in files.values():
+                f.close()
+        return events
+
+
+class AceTransport:
+    """
+    Канал связи с ACE: последовательный порт, TCP, pty или сокет демона
+    Serial-like byte stream to the ACE. Framing, queueing and callbacks stay in
+    ValgAce; this base only holds the counters, each transport implements
+    read(size) and write(data) and reports them through _count_read/_count_write.
+    Errors are raised as SerialException for every transport.
+    """
+    name = 'transport'
+    COUNTERS = ('bytes_read', 'bytes_written', 'read_calls', 'empty_reads', 'write_calls')
+
+    def __init__(self):
+        self.is_open = False
+        for counter in self.COUNTERS:
+            setattr(self, counter, 0)
+
+    def _count_read(self, data: bytes) -> bytes:
+        self.read_calls += 1
+        if data:
+            self.bytes_read += len(data)
+        else:
+            self.empty_reads += 1
+        return data
+
+    def _count_write(self, written: int) -> int:
+        self.bytes_written += written
+        return written
+
+    def get_status(self) -> Dict[str, Any]:
+        status = {counter: getattr(self, counter) for counter in self.COUNTERS}
+        status['name'] = self.name
+        return status
+
+    def close(self):
+        self.is_open = False
+
+
+class AceSerialTransport(AceTransport):
+    """
+    USB последовательный порт через pyserial, неблокирующее чтение
+    Non-blocking pyserial port; low_latency asks the tty driver to hand over
+    received bytes at once instead of batching them (FTDI-style latency timer)
+    """
+    name = 'serial'
+
+    def __init__(self, port: str, baud: int, write_timeout: float, low_latency: bool, logger):
+        AceTransport.__init__(self)
+        self._serial = serial.Serial(port=port, baudrate=baud, timeout=0,
+                                     write_timeout=write_timeout)
+        if low_latency:
+            try:
+                self._serial.set_low_latency_mode(True)
+            except (AttributeError, ValueError, OSError) as e:
+                # CDC ACM (ttyACM) не поддерживает флаг - данные и так отдаются сразу
+                # CDC ACM (ttyACM) has no such flag, it already delivers data at once
+                logger.info(f"Low latency mode not available on {port}: {e}")
+        self.is_open = self._serial.is_open
+
+    def read(self, size: int = 1) -> bytes:
+        return self._count_read(self._serial.read(size))
+
+    def write(self, data: bytes) -> int:
+        self.write_calls += 1
+        return self._count_write(self._serial.write(data) or 0)
+
+    def close(self):
+        self.is_open = False
+        self._serial.close()
+
+
+class AceSocketTransport(AceTransport):
+    """Неблокирующий потоковый сокет / Non-blocking stream socket"""
+    name = 'socket'
+
+    def __init__(self, sock: socket.socket, write_timeout: float):
+        AceTransport.__init__(self)
+        self._sock = sock
+        self._write_timeout = write_timeout
+        self._sock.setblocking(False)
+        self.is_open = True
+
+    def read(self, size: int = 1) -> bytes:
+        try:
+            data = self._sock.recv(size)
+        except (BlockingIOError, InterruptedError):
+            return self._count_read(b'')
+        except OSError as e:
+            self.close()
+            raise SerialException(f"ACE {self.name} read error: {e}")
+        if not data:
+            self.close()
+            raise SerialException(f"ACE {self.name} connection closed")
+        return self._count_read(data)
+
+    def write(self, data: bytes) -> int:
+        view = memoryview(data)
+        deadline = time.monotonic() + self._write_timeout
+        while view:
+            self.write_calls += 1
+            try:
+                view = view[self._sock.send(view):]
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError as e:
+                self.close()
+                raise SerialException(f"ACE {self.name} write error: {e}")
+            if view:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not select.select([], [self._sock], [], remaining)[1]:
+                    raise SerialException(f"ACE {self.name} write timeout")
+        return self._count_write(len(data))
+
+    def close(self):
+        self.is_open = False
+        try:
+            self._sock.close()
+        except OSError:
+            pass
+
+
+class AceDaemonPort(AceSocketTransport):
+    """
+    Serial-like wrapper around the ace_daemon.py Unix socket.
+    The daemon accepts ACE frames unchanged, so framing, queueing and
+    callbacks in ValgAce work the same as with a direct serial port.
+    """
+    name = 'daemon'
+
+    def __init__(self, path: str, write_timeout: float):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(write_timeout)
+        try:
+            sock.connect(path)
+        except OSError as e:
+            sock.close()
+            raise SerialException(f"Cannot connect to ACE daemon at {path}: {e}")
+        AceSocketTransport.__init__(self, sock, write_timeout)
+
+
+class AceTcpTransport(AceSocketTransport):
+    """
+    Сетевой мост последовательного порта (ser2net, socat, ESP-Link) в режиме raw TCP
+    Raw TCP serial bridge (ser2net, socat, ESP-Link); Nagle is disabled so short
+    requests are not held back waiting for more data
+    """
+    name = 'tcp'
+
+    def __init__(self, address: str, write_timeout: float):
+        host, _, port = address.rpartition(':')
+        try:
+            sock = socket.create_connection((host.strip('[]'), int(port)),
+                                            timeout=max(write_timeout, 1.0))
+        except (OSError, ValueError) as e:
+            raise SerialException(f"Cannot connect to ACE at tcp {address}: {e}")
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        AceSocketTransport.__init__(self, sock, write_timeout)
+
+
+class AcePtyTransport(AceTransport):
+    """
+    Псевдотерминал (daemon/ace_emulator.py или socat), без pyserial
+    Pseudo-terminal such as the one daemon/ace_emulator.py prints, opened
+    non-blocking in raw mode; there is no baud rate or line control on a pty
+    """
+    name = 'pty'
+
+    def __init__(self, path: str, write_timeout: float):
+        AceTransport.__init__(self)
+        self._write_timeout = write_timeout
+        try:
+            self._fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        except OSError as e:
+            raise SerialException(f"Cannot open ACE pty {path}: {e}")
+        try:
+            tty.setraw(self._fd, termios.TCSANOW)
+        except termios.error as e:
+            os.close(self._fd)
+            raise SerialException(f"{path} is not a terminal: {e}")
+        self.is_open = True
+
+    def read(self, size: int = 1) -> bytes:
+        try:
+            return self._count_read(os.read(self._fd, size))
+        except (BlockingIOError, InterruptedError):
+            return self._count_read(b'')
+        except OSError as e:
+            # EIO - другая сторона pty закрыта / EIO - the other side closed the pty
+            self.close()
+            raise SerialException(f"ACE pty read error: {e}")
+
+    def write(self, data: bytes) -> int:
+        view = memoryview(data)
+        deadline = time.monotonic() + self._write_timeout
+        while view:
+            self.write_calls += 1
+            try:
+                view = view[os.write(self._fd, view):]
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError as e:
+                self.close()
+                raise SerialException(f"ACE pty write error: {e}")
+            if view:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not select.select([], [self._fd], [], remaining)[1]:
+                    raise SerialException("ACE pty write timeout")
+        return self._count_write(len(data))
+
+    def close(self):
+        if self.is_open:
+            self.is_open = False
+            try:
+                os.close(self._fd)
+            except OSError:
+                pass
 
 
 def load_config(config):
@@ -10,6 +10,8 @@
 import logging
 
 ACE_REPORT_TIME = 1.0  # Report temperature every second
+# Fall back to polling ACE state if no ace:temperature event arrived for this long
+ACE_STALE_TIME = 2.5 * ACE_REPORT_TIME
 
 class TemperatureACE:
     """
@@ -24,6 +26,10 @@ class TemperatureACE:
         
         # ACE module reference (will be set in handle_ready)
         self.ace = None
+        # MCU reference for print time conversion (cached in handle_connect)
+        self.mcu = None
+        # Receive time of the last reported sample (duplicate suppression)
+        self._last_sample_time = 0.
         
         # Temperature state
         self.temp = 0.0
@@ -34,6 +40,7 @@ class TemperatureACE:
         
         # Callback for temperature updates
         self._callback = None
+        self._sample_logged = False
         
         # Register object
         self.printer.add_object("temperature_ace " + self.name, self)
@@ -42,7 +49,11 @@ class TemperatureACE:
         if self.printer.get_start_args().get('debugoutput') is not None:
             return
         
-        # Register timer for periodic temperature reading
+        # Temperature is pushed by the ACE module when a status reply arrives
+        self.printer.register_event_handler("ace:temperature",
+                                            self._handle_ace_temperature)
+        
+        # Fallback timer for when no pushes arrive (ACE missing or disconnected)
         self.sample_timer = self.reactor.register_timer(
             self._sample_ace_temperature)
         
@@ -70,6 +81,7 @@ class TemperatureACE:
     
     def handle_connect(self):
         """Start temperature sampling when Klipper connects"""
+        self.mcu = self.printer.lookup_object('mcu')
         if hasattr(self, 'sample_timer'):
             self.reactor.update_timer(self.sample_timer, self.reactor.NOW)
     
@@ -86,57 +98,64 @@ class TemperatureACE:
         """Return time interval between temperature reports (required by heaters system)"""
         return ACE_REPORT_TIME
     
+    def _handle_ace_temperature(self, eventtime, temp):
+        """Temperature pushed by the ACE module; eventtime is when the reply arrived"""
+        if eventtime <= self._last_sample_time:
+            # Same status reply reported twice
+            return
+        self._last_sample_time = eventtime
+        if not self._sample_logged and temp > 0:
+            logging.info(f"ACE temperature sensor: Started sampling, current temp={temp}°C")
+            self._sample_logged = True
+        self._report_temperature(eventtime, temp)
+    
     def _sample_ace_temperature(self, eventtime):
-        """Periodic temperature sampling from ACE device"""
-        # Log first successful sample
-        if not hasattr(self, '_sample_logged'):
-            self._sample_logged = False
+        """Fallback sampling when the ACE module stops pushing temperature"""
+        now = self.reactor.monotonic()
+        if now - self._last_sample_time < ACE_STALE_TIME:
+            return eventtime + ACE_REPORT_TIME
         
         try:
             if self.ace and hasattr(self.ace, '_info'):
-                # Get temperature from ACE device info
-                ace_temp = self.ace._info.get('temp', 0.0)
-                
-                # Log first successful temperature reading
-                if not self._sample_logged and ace_temp > 0:
-                    logging.info(f"ACE temperature sensor: Started sampling, current temp={ace_temp}°C")
-                    self._sample_logged = True
-                
-                self.temp = float(ace_temp)
-                
-                # Track min/max
-                if self.temp > 0:  # Only track valid temperatures
-                    self.measured_min = min(self.measured_min, self.temp)
-                    self.measured_max = max(self.measured_max, self.temp)
-                
-                # Check temperature limits
-                if self.temp < self.min_temp and self.temp > 0:
-                    self.printer.invoke_shutdown(
-                        "ACE temperature %.1f below minimum temperature of %.1f"
-                        % (self.temp, self.min_temp))
-                if self.temp > self.max_temp:
-                    self.printer.invoke_shutdown(
-                        "ACE temperature %.1f above maximum temperature of %.1f"
-                        % (self.temp, self.max_temp))
+                # Last known temperature from ACE device info
+                ace_temp = float(self.ace._info.get('temp', 0.0))
             else:
                 # ACE not available, report 0
                 if not hasattr(self, '_warning_shown'):
                     logging.warning(f"temperature_ace: ACE module not available or _info not set (ace={self.ace}, has_info={hasattr(self.ace, '_info') if self.ace else False})")
                     self._warning_shown = True
-                self.temp = 0.0
+                ace_temp = 0.0
         except Exception:
             logging.exception("temperature_ace: Error reading temperature from ACE")
-            self.temp = 0.0
-        
-        # Call temperature callback if set
-        if self._callback:
-            mcu = self.printer.lookup_object('mcu')
-            measured_time = self.reactor.monotonic()
-            self._callback(mcu.estimated_print_time(measured_time), self.temp)
+            ace_temp = 0.0
+        self._report_temperature(now, ace_temp)
         
         # Schedule next sample
         return eventtime + ACE_REPORT_TIME
     
+    def _report_temperature(self, measured_time, temp):
+        """Track min/max, check limits and pass the sample to the heaters system"""
+        self.temp = temp
+        
+        # Track min/max
+        if self.temp > 0:  # Only track valid temperatures
+            self.measured_min = min(self.measured_min, self.temp)
+            self.measured_max = max(self.measured_max, self.temp)
+        
+        # Check temperature limits
+        if self.temp < self.min_temp and self.temp > 0:
+            self.printer.invoke_shutdown(
+                "ACE temperature %.1f below minimum temperature of %.1f"
+                % (self.temp, self.min_temp))
+        if self.temp > self.max_temp:
+            self.printer.invoke_shutdown(
+                "ACE temperature %.1f above maximum temperature of %.1f"
+                % (self.temp, self.max_temp))
+        
+        # Call temperature callback if set
+        if self._callback and self.mcu is not None:
+            self._callback(self.mcu.estimated_print_time(measured_time), self.temp)
+    
     def get_temp(self, eventtime):
         """Get current temperature (required for temperature_sensor compatibility)"""
         return self.temp, 0.0
@@ -7,11 +7,22 @@ Moonraker API Extension для ValgACE
 1. Скопируйте в ~/moonraker/moonraker/components/ace_status.py
 2. Добавьте в moonraker.conf:
    [ace_status]
+   # Опционально: сокет ace_daemon.py, статус остается доступным при перезапуске Klipper
+   # Optional: ace_daemon.py socket, keeps status available while Klipper restarts
+   # daemon_socket: /tmp/ace.sock
+   # Максимум одновременно активных асинхронных заданий
+   # Max active async command jobs
+   # max_jobs: 16
 """
 
 from __future__ import annotations
+import asyncio
+import json
 import logging
-from typing import TYPE_CHECKING, Optional, Dict, Any
+import os
+import re
+import time
+from typing import TYPE_CHECKING, Optional, Dict, Any, List
 if TYPE_CHECKING:
     from confighelper import ConfigHelper
     from websockets import WebRequest
@@ -19,6 +30,133 @@ if TYPE_CHECKING:
     APIComp = klippy_apis.KlippyAPI
 
 
+# Описания метрик для /server/ace/metrics
+# Metric descriptions for /server/ace/metrics
+METRIC_HELP = {
+    "frames_sent": "Frames written to the ACE",
+    "frames_received": "Valid frames received from the ACE",
+    "crc_errors": "Frames dropped because of a CRC mismatch",
+    "incomplete_frames": "Frame headers whose terminator was not at the announced length",
+    "queue_overflows": "Request queue overflows (queued requests dropped)",
+    "reconnects": "Serial reconnects",
+    "request_timeouts": "Requests without a reply within response_timeout",
+    "toolchanges": "Completed toolchanges",
+    "park_errors": "Failed or timed out parking attempts",
+    "toolchange_overlap_fallbacks": "Overlapped toolchanges that fell back to sequential",
+    "connected": "1 if Klipper is connected to the ACE",
+    "queue_depth": "Requests waiting in the send queue",
+    "outstanding_callbacks": "Requests waiting for a reply callback",
+    "request_rtt_seconds": "Request round-trip time",
+    "toolchange_duration_seconds": "Toolchange duration",
+    "transport_bytes_read": "Bytes read from the ACE link",
+    "transport_bytes_written": "Bytes written to the ACE link",
+    "transport_read_calls": "Read calls on the ACE link",
+    "transport_empty_reads": "Read calls that returned no data",
+    "transport_write_calls": "Write calls on the ACE link",
+}
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+# Максимальное ожидание ?wait_for_change= (с)
+# Longest ?wait_for_change= long poll (s)
+LONG_POLL_MAX_TIMEOUT = 120.
+
+# Классы команд для асинхронных заданий и сколько заданий класса может быть активно
+# Command classes of async jobs and how many jobs of a class may be active at once
+JOB_CLASSES = {
+    "motion": ("ACE_CHANGE_TOOL", "ACE_PARK_TO_TOOLHEAD", "ACE_FEED", "ACE_RETRACT",
+               "ACE_SEQUENCE", "ACE_PRELOAD", "ACE_CALIBRATE", "ACE_INFINITY_SPOOL",
+               "T0", "T1", "T2", "T3", "TR", "FEED_ACE", "RETRACT_ACE",
+               "PARK_TO_TOOLHEAD", "INFINITY_SPOOL"),
+    "dryer": ("ACE_START_DRYING", "ACE_STOP_DRYING", "START_DRYING", "STOP_DRYING"),
+}
+JOB_CLASS_LIMITS = {"motion": 1, "dryer": 1, "other": 4}
+# Сколько завершенных заданий хранить для /server/ace/jobs и строк вывода на задание
+# Finished jobs kept for /server/ace/jobs and output lines kept per job
+JOB_HISTORY = 50
+JOB_OUTPUT_LINES = 50
+# Метки начала и конца задания в консоли (через [respond]): вывод между ними - вывод задания
+# Job start/end markers in the console (via [respond]): output between them is the job's
+JOB_MARKER = "ace_job"
+
+# Макросы ace.cfg, которые /server/ace/commands принимает наряду с командами ACE_*
+# ace.cfg macros accepted by /server/ace/commands next to the ACE_* commands
+ACE_MACROS = ("STATUS_ACE", "FEED_ACE", "RETRACT_ACE", "ENABLE_FEED_ASSIST",
+              "DISABLE_FEED_ASSIST", "PARK_TO_TOOLHEAD", "START_DRYING", "STOP_DRYING",
+              "TR", "T0", "T1", "T2", "T3", "INFINITY_SPOOL")
+# Сколько команд можно передать в одном пакете
+# Max commands in one batch
+BATCH_MAX_COMMANDS = 32
+BATCH_PARAM_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+# Символы, которые нельзя передать значением параметра G-code: перевод строки,
+# комментарии Klipper (; #) и кавычка (значения с пробелами берутся в кавычки)
+# Characters a G-code value cannot carry: newlines, Klipper comments (; #) and the
+# quote used around values with spaces
+BATCH_VALUE_FORBIDDEN = '\r\n;#"'
+# Метка выполненной команды пакета в выводе G-code: "// ace_batch <batch> <index>"
+# Marker of a finished batch command in the G-code output
+BATCH_MARKER = "ace_batch"
+
+
+def _diff_status(old: Any, new: Any, path: str, changes: List[Dict[str, Any]]) -> None:
+    """
+    Изменившиеся пути между двумя статусами: "temp", "dryer.status", "slots[2].status"
+    Lists of different length are replaced as a whole
+    """
+    if old is new:
+        return
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key, value in new.items():
+            sub = f"{path}.{key}" if path else str(key)
+            if key in old:
+                _diff_status(old[key], value, sub, changes)
+            else:
+                changes.append({"path": sub, "value": value})
+        for key in old:
+            if key not in new:
+                changes.append({"path": f"{path}.{key}" if path else str(key), "delete": True})
+    elif isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        for index, (old_item, new_item) in enumerate(zip(old, new)):
+            _diff_status(old_item, new_item, f"{path}[{index}]", changes)
+    elif old != new:
+        changes.append({"path": path, "value": new})
+
+
+def _format_openmetrics(metrics: Optional[Dict[str, Any]]) -> str:
+    """Снимок метрик модуля ace в текстовом формате OpenMetrics"""
+    lines = [
+        "# TYPE ace_up gauge",
+        "# HELP ace_up 1 if the ace module in Klipper answered the scrape",
+        f"ace_up {0 if metrics is None else 1}",
+    ]
+    if metrics is not None:
+        for name, value in metrics.get("counters", {}).items():
+            lines += [f"# TYPE ace_{name} counter",
+                      f"# HELP ace_{name} {METRIC_HELP.get(name, name)}",
+                      f"ace_{name}_total {value}"]
+        for name, value in metrics.get("gauges", {}).items():
+            lines += [f"# TYPE ace_{name} gauge",
+                      f"# HELP ace_{name} {METRIC_HELP.get(name, name)}",
+                      f"ace_{name} {value}"]
+        for name, hist in metrics.get("histograms", {}).items():
+            lines += [f"# TYPE ace_{name} histogram",
+                      f"# HELP ace_{name} {METRIC_HELP.get(name, name)}"]
+            for bound, count in zip(hist["buckets"], hist["counts"]):
+                lines.append(f'ace_{name}_bucket{{le="{bound}"}} {count}')
+            lines += [f'ace_{name}_bucket{{le="+Inf"}} {hist["count"]}',
+                      f"ace_{name}_sum {hist['sum']}",
+                      f"ace_{name}_count {hist['count']}"]
+        # Счетчики текущего транспорта, сбрасываются при переподключении
+        # Counters of the current transport, they restart on reconnect
+        transport = metrics.get("transport") or {}
+        for name, value in transport.items():
+            if name == "name":
+                continue
+            lines += [f"# TYPE ace_transport_{name} counter",
+                      f"# HELP ace_transport_{name} {METRIC_HELP.get('transport_' + name, name)}",
+                      f'ace_transport_{name}_total{{transport="{transport.get("name", "")}"}} {value}']
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
 class AceStatus:
     def __init__(self, config: ConfigHelper):
         self.confighelper = config
@@ -44,40 +182,227 @@ class AceStatus:
             ['POST'],
             self.handle_command_request
         )
+        self.server.register_endpoint(
+            "/server/ace/commands",
+            ['POST'],
+            self.handle_commands_request
+        )
+        self.server.register_endpoint(
+            "/server/ace/jobs",
+            ['GET'],
+            self.handle_jobs_request
+        )
+        self.server.register_endpoint(
+            "/server/ace/history",
+            ['GET'],
+            self.handle_history_request
+        )
+        self.server.register_endpoint(
+            "/server/ace/journal",
+            ['GET'],
+            self.handle_journal_request
+        )
+        self.server.register_endpoint(
+            "/server/ace/metrics",
+            ['GET'],
+            self.handle_metrics_request,
+            wrap_result=False,
+            content_type=OPENMETRICS_CONTENT_TYPE
+        )
         
         # Подписка на обновления статуса принтера
         self.server.register_event_handler(
             "server:status_update",
             self._handle_status_update
         )
+        self.server.register_event_handler(
+            "server:klippy_ready",
+            self._handle_klippy_ready
+        )
+        self.server.register_event_handler(
+            "server:klippy_disconnect",
+            self._handle_klippy_disconnect
+        )
+        self.server.register_event_handler(
+            "server:klippy_shutdown",
+            self._handle_klippy_disconnect
+        )
+        # Websocket: notify_ace_status_patch {"seq": n, "changes": [{"path", "value"|"delete"}]}
+        self.server.register_notification("ace_status:ace_status_patch")
+        # Websocket: notify_ace_job - состояние и вывод асинхронного задания
+        # Websocket: notify_ace_job - state and output of an async job
+        self.server.register_notification("ace_status:ace_job")
+        self.server.register_event_handler(
+            "server:gcode_response",
+            self._handle_gcode_response
+        )
+
+        # Асинхронные задания (POST /server/ace/command с async=true)
+        # Async command jobs (POST /server/ace/command with async=true)
+        self.max_jobs: int = config.getint('max_jobs', 16, minval=1)
+        self._jobs: Dict[int, Dict[str, Any]] = {}
+        self._marked_job: Optional[int] = None
+        self._job_counter: int = 0
+
+        # Пакеты команд: зарегистрированные в Klipper команды (gcode/help) и
+        # номер последней выполненной команды каждого выполняемого пакета
+        # Command batches: G-code commands registered in Klipper (gcode/help) and
+        # the last finished command of each running batch
+        self._gcode_commands: Optional[set] = None
+        self._batch_counter: int = 0
+        self._batch_progress: Dict[int, int] = {}
         
-        # Кэш последнего статуса
+        # Кэш последнего статуса: полный объект ace, обновляется дельтами подписки
+        # Last status cache: the full ace object, merged from subscription deltas
         self._last_status: Optional[Dict[str, Any]] = None
+        self._last_status_time: float = 0.
+        self._subscribed: bool = False
+        # Номер последнего патча; снимок /status содержит seq, с которого продолжать
+        # Sequence of the last patch; the /status snapshot carries the seq to continue from
+        self._seq: int = 0
+        # ETag = id запуска + seq: seq начинается заново после перезапуска Moonraker
+        # ETag = process id + seq, so a restarted Moonraker never matches an old tag
+        self._etag_prefix: str = os.urandom(4).hex()
+        self._status_changed = asyncio.Event()
+
+        # Подписка на поток статуса ace_daemon.py (если настроен)
+        # Status stream from ace_daemon.py (if configured)
+        self.daemon_socket: Optional[str] = config.get('daemon_socket', None)
+        self._daemon_status: Optional[Dict[str, Any]] = None
+        self._daemon_status_time: float = 0.
+        self._daemon_task: Optional[asyncio.Task] = None
+        if self.daemon_socket:
+            self._daemon_task = self.server.get_event_loop().create_task(
+                self._daemon_subscription())
         
         self.logger.info("ACE Status API extension loaded")
     
+    def _loop_time(self) -> float:
+        return self.server.get_event_loop().get_loop_time()
+
+    def _store_status(self, ace_data: Dict[str, Any], partial: bool = False) -> None:
+        """
+        Обновляет кэш и рассылает только изменившиеся пути с номером последовательности
+        partial=True: ace_data holds only changed top-level fields (subscription delta)
+        """
+        old = self._last_status or {}
+        new = dict(old, **ace_data) if partial else dict(ace_data)
+        changes: List[Dict[str, Any]] = []
+        _diff_status(old, new, "", changes)
+        self._last_status = new
+        self._last_status_time = self._loop_time()
+        if changes:
+            self._seq += 1
+            self.server.send_event("ace_status:ace_status_patch",
+                                   {"seq": self._seq, "changes": changes})
+            # Будим long poll запросы
+            # Wake up long-poll requests
+            self._status_changed.set()
+            self._status_changed = asyncio.Event()
+
+    def _etag(self) -> str:
+        return f"{self._etag_prefix}-{self._seq}"
+
+    def _not_modified(self) -> Dict[str, Any]:
+        return {"not_modified": True, "seq": self._seq, "etag": self._etag()}
+
+    async def _wait_for_change(self, version: int, timeout: float) -> bool:
+        """Ждет, пока seq станет больше version; False - таймаут"""
+        deadline = self._loop_time() + timeout
+        while self._seq <= version and self._subscribed:
+            remaining = deadline - self._loop_time()
+            if remaining <= 0.:
+                return False
+            try:
+                await asyncio.wait_for(self._status_changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    async def _handle_klippy_ready(self) -> None:
+        """Одна подписка на объект ace вместо query_objects на каждый запрос"""
+        try:
+            result = await self.klippy_apis.subscribe_objects({'ace': None})
+        except Exception as e:
+            self.logger.info(f"Could not subscribe to ACE status: {e}")
+            return
+        ace_data = result.get('ace') if isinstance(result, dict) else None
+        if isinstance(ace_data, dict):
+            self._store_status(ace_data)
+            self._subscribed = True
+            self.logger.info("Subscribed to ACE status")
+
+    async def _handle_klippy_disconnect(self) -> None:
+        self._subscribed = False
+        self._gcode_commands = None
+
+    def _with_cache_info(self, status: Dict[str, Any], source: str,
+                         fields: Optional[List[str]]) -> Dict[str, Any]:
+        """Проекция ?fields= и возраст кэша"""
+        if fields:
+            status = {key: status[key] for key in fields if key in status}
+        else:
+            status = dict(status)
+        status['source'] = source
+        status['seq'] = self._seq
+        status['etag'] = self._etag()
+        status['cache_age'] = round(self._loop_time() - self._last_status_time, 3)
+        return status
+
+    @staticmethod
+    def _get_fields(webrequest: WebRequest) -> Optional[List[str]]:
+        fields = webrequest.get_str("fields", None)
+        if not fields:
+            return None
+        return [field.strip() for field in fields.split(',') if field.strip()]
+
     async def handle_status_request(self, webrequest: WebRequest) -> Dict[str, Any]:
         """Обработка запроса статуса ACE"""
         try:
-            # Получаем данные напрямую из модуля ace через query_objects
+            fields = self._get_fields(webrequest)
+            # Условный запрос: ?if_none_match=<etag> (Moonraker не передает компонентам
+            # заголовки HTTP), long poll: ?wait_for_change=<seq>&timeout=<s>
+            etag = (webrequest.get_str("if_none_match", None) or "").strip('"') or None
+            wait_version = webrequest.get_int("wait_for_change", None)
+            if wait_version is not None and self._subscribed:
+                timeout = min(max(webrequest.get_float("timeout", 30.), 0.), LONG_POLL_MAX_TIMEOUT)
+                if not await self._wait_for_change(wait_version, timeout):
+                    return self._not_modified()
+            # Статус из подписки: без обращения к Klippy
+            # Subscription cache: no Klippy round trip
+            if self._subscribed and self._last_status:
+                if etag == self._etag():
+                    return self._not_modified()
+                return self._with_cache_info(self._last_status, 'subscription', fields)
+
+            # Подписки нет: запрашиваем модуль ace через query_objects
             # Модуль ace экспортирует данные через register_status_handler
             try:
                 result = await self.klippy_apis.query_objects({'ace': None})
                 ace_data = result.get('ace')
                 
                 if ace_data and isinstance(ace_data, dict):
-                    self._last_status = ace_data
-                    return ace_data
+                    self._store_status(ace_data)
+                    if etag == self._etag():
+                        return self._not_modified()
+                    return self._with_cache_info(ace_data, 'query', fields)
                 else:
                     self.logger.debug("ACE data not found in query_objects response")
             
             except Exception as e:
                 self.logger.debug(f"Could not get ACE data from query_objects: {e}")
             
+            # Fallback: статус от ace_daemon.py, пока Klipper недоступен
+            if self._daemon_status:
+                self.logger.debug("Using ACE status from daemon")
+                status = self._with_cache_info(self._daemon_status, 'daemon', fields)
+                status['cache_age'] = round(self._loop_time() - self._daemon_status_time, 3)
+                return status
+
             # Fallback: используем кэшированный статус если есть
             if self._last_status:
                 self.logger.debug("Using cached ACE status")
-                return self._last_status
+                return self._with_cache_info(self._last_status, 'cache', fields)
             
             # Если данных нет, возвращаем структуру по умолчанию
             self.logger.warning("No ACE data available, returning default structure")
@@ -97,7 +422,10 @@ class AceStatus:
                 "slots": [
                     {"index": i, "status": "unknown", "type": "", "color": [0, 0, 0], "sku": "", "rfid": 0}
                     for i in range(4)
-                ]
+                ],
+                "source": "default",
+                "seq": self._seq,
+                "cache_age": None
             }
             
         except Exception as e:
@@ -107,51 +435,98 @@ class AceStatus:
             return {"error": str(e)}
     
     async def handle_slots_request(self, webrequest: WebRequest) -> Dict[str, Any]:
-        """Обработка запроса информации о слотах"""
+        """Обработка запроса информации о слотах (из того же кэша, что и /status)"""
         try:
             status = await self.handle_status_request(webrequest)
             
-            if "error" in status:
+            if "error" in status or status.get("not_modified"):
                 return status
             
             slots = status.get("slots", [])
             return {
-                "slots": slots
+                "slots": slots,
+                "filament_info": status.get("filament_info", []),
+                "source": status.get("source", "default"),
+                "seq": status.get("seq"),
+                "etag": status.get("etag"),
+                "cache_age": status.get("cache_age")
             }
         except Exception as e:
             self.logger.error(f"Error getting slots: {e}")
             return {"error": str(e)}
     
+    async def handle_history_request(self, webrequest: WebRequest) -> Dict[str, Any]:
+        """История телеметрии ACE за интервал времени (unix time)"""
+        params: Dict[str, Any] = {}
+        for key in ("start", "end", "resolution"):
+            value = webrequest.get_float(key, None)
+            if value is not None:
+                params[key] = value
+        fields = webrequest.get_str("fields", None)
+        if fields:
+            params["fields"] = fields
+        try:
+            # Эндпоинт ace/history регистрируется модулем ace в Klipper
+            return await self.klippy_apis._send_klippy_request("ace/history", params)
+        except Exception as e:
+            self.logger.debug(f"Error getting ACE history: {e}")
+            return {"error": str(e)}
+
+    async def handle_journal_request(self, webrequest: WebRequest) -> Dict[str, Any]:
+        """События журнала ACE за интервал (unix time) с фильтром по типам"""
+        params: Dict[str, Any] = {}
+        for key in ("start", "end"):
+            value = webrequest.get_float(key, None)
+            if value is not None:
+                params[key] = value
+        limit = webrequest.get_int("limit", None)
+        if limit is not None:
+            params["limit"] = limit
+        types = webrequest.get_str("types", None)
+        if types:
+            params["types"] = types
+        try:
+            # Эндпоинт ace/journal регистрируется модулем ace в Klipper
+            return await self.klippy_apis._send_klippy_request("ace/journal", params)
+        except Exception as e:
+            self.logger.debug(f"Error getting ACE journal: {e}")
+            return {"error": str(e)}
+
+    async def handle_metrics_request(self, webrequest: WebRequest) -> str:
+        """Метрики для Prometheus: только счетчики из памяти Klipper, без обмена с ACE"""
+        try:
+            # Эндпоинт ace/metrics регистрируется модулем ace в Klipper
+            metrics = await self.klippy_apis._send_klippy_request("ace/metrics", {})
+        except Exception as e:
+            self.logger.debug(f"Error getting ACE metrics: {e}")
+            metrics = None
+        return _format_openmetrics(metrics)
+
     async def handle_command_request(self, webrequest: WebRequest) -> Dict[str, Any]:
         """Обработка выполнения команды ACE"""
         try:
+            # JSON body разбирается один раз
+            # The JSON body is parsed once
+            json_body = await self._get_json_body(webrequest)
+
             # Получаем параметры из запроса
-            command = webrequest.get_str("command", None)
-            
-            # Если команда не в query параметрах, пытаемся получить из JSON body
-            if not command:
-                try:
-                    json_body = await webrequest.get_json()
-                    if isinstance(json_body, dict):
-                        command = json_body.get("command")
-                except Exception:
-                    pass
+            command = webrequest.get_str("command", None) or json_body.get("command")
             
             if not command:
                 return {"error": "Command parameter is required"}
+
+            # async=true: вернуть номер задания сразу, G-code выполняется в фоне
+            # async=true: return a job id at once, the G-code runs in the background
+            run_async = bool(json_body.get("async", False))
+            if not run_async:
+                run_async = str(webrequest.get_str("async", "false")).lower() in ("true", "1")
             
             # Получаем параметры команды
             params: Dict[str, Any] = {}
 
-            # 1) Пытаемся получить params из JSON body
-            try:
-                json_body = await webrequest.get_json()
-                if isinstance(json_body, dict) and "params" in json_body:
-                    jb_params = json_body["params"]
-                    if isinstance(jb_params, dict):
-                        params.update(jb_params)
-            except Exception:
-                pass
+            # 1) params из JSON body
+            if isinstance(json_body.get("params"), dict):
+                params.update(json_body["params"])
 
             # 2) Обрабатываем query параметры
             try:
@@ -182,21 +557,16 @@ class AceStatus:
 
                 # Также поддерживаем прямой формат ?INDEX=0&SPEED=25 и т.п.
                 for k, v in args.items():
-                    if k in ("command", "params"):
+                    if k in ("command", "params", "async"):
                         continue
                     params[str(k)] = v
             
             # Формируем G-code команду
-            gcode_cmd = command
-            if params:
-                # Преобразуем значения к строке без лишних кавычек
-                def _fmt_val(val):
-                    if isinstance(val, bool):
-                        return '1' if val else '0'
-                    return str(val)
-                param_str = " ".join([f"{k}={_fmt_val(v)}" for k, v in params.items()])
-                gcode_cmd = f"{command} {param_str}"
+            gcode_cmd = self._format_gcode(command, params)
             
+            if run_async:
+                return self._submit_job(gcode_cmd)
+
             # Выполняем команду через klippy_apis
             try:
                 await self.klippy_apis.run_gcode(gcode_cmd)
@@ -218,6 +588,257 @@ class AceStatus:
             self.logger.error(f"Error handling ACE command request: {e}")
             return {"error": str(e)}
     
+    @staticmethod
+    async def _get_json_body(webrequest: WebRequest) -> Dict[str, Any]:
+        try:
+            json_body = await webrequest.get_json()
+        except Exception:
+            return {}
+        return json_body if isinstance(json_body, dict) else {}
+
+    @staticmethod
+    def _format_gcode(command: str, params: Dict[str, Any]) -> str:
+        """COMMAND PARAM1=value1 PARAM2=value2"""
+        if not params:
+            return command
+        # Преобразуем значения к строке без лишних кавычек
+        def _fmt_val(val):
+            if isinstance(val, bool):
+                return '1' if val else '0'
+            val = str(val)
+            if not val or any(c.isspace() for c in val):
+                return f'"{val}"'
+            return val
+        param_str = " ".join([f"{k}={_fmt_val(v)}" for k, v in params.items()])
+        return f"{command} {param_str}"
+
+    async def _get_gcode_commands(self) -> set:
+        """Команды G-code, зарегистрированные в Klipper; кэш до отключения Klippy"""
+        if self._gcode_commands is None:
+            result = await self.klippy_apis._send_klippy_request("gcode/help", {})
+            self._gcode_commands = {name.upper() for name in result}
+        return self._gcode_commands
+
+    def _validate_batch_command(self, entry: Any, registered: set) -> Dict[str, Any]:
+        """
+        Одна команда пакета -> {"command": gcode} или {"error": ...}
+        Values must stay on one line: the batch is sent as one multi-line script
+        """
+        if isinstance(entry, str):
+            entry = {"command": entry}
+        if not isinstance(entry, dict) or not isinstance(entry.get("command"), str):
+            return {"error": "Expected {\"command\": ..., \"params\": {...}}"}
+        name = entry["command"].strip().upper()
+        params = entry.get("params") or {}
+        if not isinstance(params, dict):
+            return {"command": name, "error": "params must be an object"}
+        if not (name.startswith("ACE_") or name in ACE_MACROS):
+            return {"command": name, "error": f"{name} is not an ACE command"}
+        if name not in registered:
+            return {"command": name, "error": f"{name} is not registered in Klipper"}
+        for key, value in params.items():
+            if not BATCH_PARAM_RE.match(str(key)):
+                return {"command": name, "error": f"Invalid parameter name {key!r}"}
+            if isinstance(value, (dict, list)) or any(c in BATCH_VALUE_FORBIDDEN for c in str(value)):
+                return {"command": name, "error": f"Invalid value of {key}: newlines, "
+                                                  f"';', '#' and quotes are not allowed"}
+        return {"command": self._format_gcode(name, params)}
+
+    async def handle_commands_request(self, webrequest: WebRequest) -> Dict[str, Any]:
+        """
+        Пакет команд ACE: {"commands": [{"command": ..., "params": {...}}, ...]}
+        All commands are validated first, then run as one multi-line script in a
+        single Klippy request; the first error skips the rest
+        """
+        json_body = await self._get_json_body(webrequest)
+        commands = json_body.get("commands")
+        if not isinstance(commands, list) or not commands:
+            return {"success": False, "error": "commands must be a non-empty list"}
+        if len(commands) > BATCH_MAX_COMMANDS:
+            return {"success": False,
+                    "error": f"Too many commands ({len(commands)} > {BATCH_MAX_COMMANDS})"}
+        try:
+            registered = await self._get_gcode_commands()
+        except Exception as e:
+            return {"success": False, "error": f"Could not get Klipper commands: {e}"}
+
+        results = [self._validate_batch_command(entry, registered) for entry in commands]
+        if any("error" in result for result in results):
+            # Ничего не выполняется, если хоть одна команда не прошла проверку
+            # Nothing runs unless every command is valid
+            for result in results:
+                result["success"] = False
+                if "error" not in result:
+                    result["skipped"] = True
+            return {"success": False, "error": "Validation failed", "results": results}
+
+        # Метки выполненных команд (через [respond]) показывают, на какой команде
+        # остановился скрипт при ошибке
+        # Markers tell which command the script stopped at on error
+        self._batch_counter += 1
+        batch_id = self._batch_counter
+        use_markers = "RESPOND" in registered
+        lines = []
+        for index, result in enumerate(results):
+            lines.append(result["command"])
+            if use_markers:
+                lines.append(f'RESPOND TYPE=command MSG="{BATCH_MARKER} {batch_id} {index}"')
+        script = "\n".join(lines)
+
+        self._batch_progress[batch_id] = -1
+        error: Optional[str] = None
+        try:
+            await self.klippy_apis.run_gcode(script)
+        except Exception as e:
+            self.logger.error(f"Error executing ACE command batch: {e}")
+            error = str(e)
+        finished = self._batch_progress.pop(batch_id)
+
+        for index, result in enumerate(results):
+            if error is None or index <= finished:
+                result["success"] = True
+            elif not use_markers:
+                # Без [respond] неизвестно, на какой команде остановился скрипт
+                # Without [respond] the failing command cannot be told apart
+                result["success"] = None
+                result["unknown"] = True
+            elif index == finished + 1:
+                result["success"] = False
+                result["error"] = error
+            else:
+                result["success"] = False
+                result["skipped"] = True
+        response: Dict[str, Any] = {"success": error is None, "results": results}
+        if error is not None:
+            response["error"] = error
+        return response
+
+    @staticmethod
+    def _job_class(gcode_cmd: str) -> str:
+        name = gcode_cmd.split(None, 1)[0].upper()
+        for job_class, names in JOB_CLASSES.items():
+            if name in names:
+                return job_class
+        return "other"
+
+    def _submit_job(self, gcode_cmd: str) -> Dict[str, Any]:
+        """Ставит команду в очередь заданий с учетом лимитов по классам"""
+        active = [job for job in self._jobs.values()
+                  if job["state"] in ("queued", "submitted", "running")]
+        if len(active) >= self.max_jobs:
+            return {"success": False, "error": "Job queue is full", "command": gcode_cmd}
+        job_class = self._job_class(gcode_cmd)
+        same_class = [job for job in active if job["class"] == job_class]
+        if len(same_class) >= JOB_CLASS_LIMITS[job_class]:
+            # Не копим конфликтующие движения: новое задание отклоняется
+            # Conflicting motion is not stacked: the new job is rejected
+            return {"success": False, "command": gcode_cmd, "job": same_class[0]["id"],
+                    "error": f"{job_class} job {same_class[0]['id']} "
+                             f"({same_class[0]['command']}) is still {same_class[0]['state']}"}
+        self._job_counter += 1
+        job = {"id": self._job_counter, "command": gcode_cmd, "class": job_class,
+               "state": "queued", "created": time.time(), "started": None,
+               "finished": None, "output": [], "error": None}
+        self._jobs[job["id"]] = job
+        self._trim_jobs()
+        self._notify_job(job)
+        self.server.get_event_loop().create_task(self._run_job(job))
+        return {"success": True, "job": job["id"], "state": job["state"], "command": gcode_cmd}
+
+    async def _run_job(self, job: Dict[str, Any]) -> None:
+        """
+        submitted - скрипт отправлен в Klippy, но может ждать за другими скриптами;
+        running - получена метка начала (только с [respond])
+        submitted: the script was sent to Klippy and may still wait behind other
+        scripts; running: its start marker was printed (needs [respond])
+        """
+        try:
+            use_markers = "RESPOND" in await self._get_gcode_commands()
+        except Exception:
+            use_markers = False
+        script = job["command"]
+        if use_markers:
+            script = "\n".join([
+                f'RESPOND TYPE=command MSG="{JOB_MARKER} {job["id"]} start"', script,
+                f'RESPOND TYPE=command MSG="{JOB_MARKER} {job["id"]} end"'])
+        job["state"] = "submitted"
+        self._notify_job(job)
+        try:
+            await self.klippy_apis.run_gcode(script)
+            job["state"] = "done"
+        except Exception as e:
+            self.logger.error(f"Error executing ACE job {job['id']} {job['command']}: {e}")
+            job["state"] = "error"
+            job["error"] = str(e)
+        job["finished"] = time.time()
+        if self._marked_job == job["id"]:
+            self._marked_job = None
+        self._notify_job(job)
+
+    def _trim_jobs(self) -> None:
+        finished = [job_id for job_id, job in self._jobs.items()
+                    if job["state"] in ("done", "error")]
+        for job_id in finished[:max(0, len(finished) - JOB_HISTORY)]:
+            del self._jobs[job_id]
+
+    def _notify_job(self, job: Dict[str, Any], line: Optional[str] = None) -> None:
+        event = {key: value for key, value in job.items() if key != "output"}
+        if line is not None:
+            event["line"] = line
+        self.server.send_event("ace_status:ace_job", event)
+
+    async def _handle_gcode_response(self, response: str) -> None:
+        """
+        Вывод G-code между метками задания - его прогресс
+        Output belongs to a job only between its start and end markers, or,
+        without [respond], while it is the only job in flight; console output of
+        other clients and of the print is never attributed otherwise
+        """
+        if response.startswith(f"// {BATCH_MARKER} "):
+            try:
+                batch_id, index = (int(part) for part in response.split()[2:4])
+            except ValueError:
+                return
+            if batch_id in self._batch_progress:
+                self._batch_progress[batch_id] = index
+            return
+        if response.startswith(f"// {JOB_MARKER} "):
+            parts = response.split()
+            try:
+                job = self._jobs.get(int(parts[2]))
+            except (ValueError, IndexError):
+                return
+            if job is None:
+                return
+            if parts[3:4] == ["start"]:
+                self._marked_job = job["id"]
+                job["state"] = "running"
+                job["started"] = time.time()
+                self._notify_job(job)
+            elif self._marked_job == job["id"]:
+                self._marked_job = None
+            return
+        job = None
+        if self._marked_job is not None:
+            job = self._jobs.get(self._marked_job)
+        elif "RESPOND" not in (self._gcode_commands or ()):
+            in_flight = [job for job in self._jobs.values() if job["state"] == "submitted"]
+            job = in_flight[0] if len(in_flight) == 1 else None
+        if job is not None:
+            job["output"] = (job["output"] + [response])[-JOB_OUTPUT_LINES:]
+            self._notify_job(job, response)
+
+    async def handle_jobs_request(self, webrequest: WebRequest) -> Dict[str, Any]:
+        """Состояние задания ?id=<n> или список последних заданий"""
+        job_id = webrequest.get_int("id", None)
+        if job_id is None:
+            return {"jobs": [{key: value for key, value in job.items() if key != "output"}
+                             for job in self._jobs.values()]}
+        job = self._jobs.get(job_id)
+        if job is None:
+            return {"error": f"Unknown job {job_id}"}
+        return dict(job)
+
     async def _handle_status_update(self, status: Dict[str, Any]) -> None:
         """Обработка обновления статуса принтера"""
         try:
@@ -225,13 +846,59 @@ class AceStatus:
             ace_data = status.get('ace')
             
             if ace_data:
-                self._last_status = ace_data
-                # Отправляем обновление через WebSocket
-                self.server.send_event("ace:status_update", ace_data)
+                # Klipper присылает только изменившиеся поля объекта
+                # Klipper only sends the fields that changed
+                self._store_status(ace_data, partial=self._last_status is not None)
         except Exception as e:
             self.logger.debug(f"Error handling status update: {e}")
 
 
+    async def _daemon_subscription(self) -> None:
+        """Подписка на поток статуса ace_daemon.py с переподключением"""
+        while True:
+            writer = None
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.daemon_socket)
+                request = {"id": 1, "method": "daemon.subscribe"}
+                writer.write(json.dumps(request).encode('utf-8') + b"\n")
+                await writer.drain()
+                self.logger.info(f"Subscribed to ACE daemon at {self.daemon_socket}")
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    message = json.loads(line)
+                    if message.get("event") == "status" and isinstance(message.get("result"), dict):
+                        self._daemon_status = self._normalize_device_status(message["result"])
+                        self._daemon_status_time = self._loop_time()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.debug(f"ACE daemon subscription error: {e}")
+            finally:
+                if writer is not None:
+                    writer.close()
+            self._daemon_status = None
+            await asyncio.sleep(2.)
+
+    def _normalize_device_status(self, result: Dict[str, Any]) -> Dict[str, Any]:
+        """Приводит сырой get_status устройства к формату ValgAce.get_status"""
+        status = dict(result)
+        dryer = dict(result.get('dryer') or result.get('dryer_status') or {})
+        # remain_time приходит в секундах, get_status отдает минуты
+        if dryer.get('remain_time', 0) > 0:
+            dryer['remain_time'] = dryer['remain_time'] / 60
+        status['dryer'] = dryer
+        status['dryer_status'] = dryer
+        status.setdefault('feed_assist_slot', -1)
+        return status
+
+    async def close(self) -> None:
+        if self._daemon_task is not None:
+            self._daemon_task.cancel()
+            self._daemon_task = None
+
+
 def load_component(config: ConfigHelper) -> AceStatus:
     return AceStatus(config)
 
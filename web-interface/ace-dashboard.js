@@ -2,6 +2,10 @@
 
 const { createApp } = Vue;
 
+// Долгие команды выполняются как асинхронные задания (notify_ace_job)
+// Long-running commands run as async jobs (notify_ace_job)
+const ASYNC_COMMANDS = ['ACE_CHANGE_TOOL', 'ACE_PARK_TO_TOOLHEAD', 'ACE_FEED', 'ACE_RETRACT'];
+
 createApp({
     data() {
         return {
@@ -251,6 +255,12 @@ createApp({
             // Connection
             wsConnected: false,
             ws: null,
+            // Номер последнего примененного патча статуса (null = нет снимка)
+            statusSeq: null,
+            resyncing: false,
+            pendingPatches: [],
+            // Асинхронные задания, ждущие завершения: id -> команда
+            pendingJobs: {},
             apiBase: ACE_DASHBOARD_CONFIG?.apiBase || window.location.origin,
             
             // Device Status
@@ -297,18 +307,15 @@ createApp({
         };
     },
     
+    created() {
+        // Полный статус, к которому применяются патчи (вне реактивности Vue)
+        this.aceState = {};
+    },
+
     mounted() {
+        // Статус загружается при подключении WebSocket, дальше приходят только патчи
         this.connectWebSocket();
-        this.loadStatus();
         this.updateDocumentTitle();
-        
-            // Auto-refresh
-        const refreshInterval = ACE_DASHBOARD_CONFIG?.autoRefreshInterval || 5000;
-        setInterval(() => {
-            if (this.wsConnected) {
-                this.loadStatus();
-            }
-        }, refreshInterval);
     },
     
     methods: {
@@ -348,7 +355,9 @@ createApp({
             this.ws.onopen = () => {
                 this.wsConnected = true;
                 this.showNotification(this.t('notifications.websocketConnected'), 'success');
-                this.subscribeToStatus();
+                // Патчи, пропущенные пока сокет был закрыт, заменяет новый снимок
+                this.statusSeq = null;
+                this.resyncStatus();
             };
             
             this.ws.onmessage = (event) => {
@@ -374,28 +383,99 @@ createApp({
             };
         },
         
-        subscribeToStatus() {
-            if (!this.ws || this.ws.readyState !== WebSocket.OPEN) return;
-            
-            this.ws.send(JSON.stringify({
-                jsonrpc: "2.0",
-                method: "printer.objects.subscribe",
-                params: {
-                    objects: {
-                        "ace": null
-                    }
-                },
-                id: 5434
-            }));
-        },
-        
         handleWebSocketMessage(data) {
-            if (data.method === "notify_status_update") {
-                const aceData = data.params[0]?.ace;
-                if (aceData) {
-                    this.updateStatus(aceData);
+            if (data.method === "notify_ace_status_patch") {
+                const patch = data.params?.[0];
+                if (patch && Array.isArray(patch.changes)) {
+                    this.applyPatch(patch);
+                }
+            } else if (data.method === "notify_ace_job") {
+                const job = data.params?.[0];
+                if (job) {
+                    this.handleJobEvent(job);
+                }
+            }
+        },
+
+        handleJobEvent(job) {
+            const command = this.pendingJobs[job.id];
+            if (command === undefined || (job.state !== 'done' && job.state !== 'error')) {
+                return;
+            }
+            delete this.pendingJobs[job.id];
+            if (job.state === 'done') {
+                this.showNotification(this.t('notifications.commandSuccess', { command }), 'success');
+            } else {
+                const errorMsg = job.error || this.t('notifications.commandErrorGeneric');
+                this.showNotification(this.t('notifications.commandError', { error: errorMsg }), 'error');
+            }
+        },
+
+        applyPatch(patch) {
+            if (this.statusSeq === null || this.resyncing) {
+                this.pendingPatches.push(patch);
+                if (!this.resyncing) {
+                    this.resyncStatus();
+                }
+                return;
+            }
+            if (patch.seq <= this.statusSeq) {
+                return;
+            }
+            if (patch.seq !== this.statusSeq + 1) {
+                // Пропущен патч - нужен новый снимок
+                this.pendingPatches.push(patch);
+                this.resyncStatus();
+                return;
+            }
+            const touched = {};
+            for (const change of patch.changes) {
+                const keys = change.path.match(/[^.[\]]+/g) || [];
+                if (!keys.length) continue;
+                let target = this.aceState;
+                for (const key of keys.slice(0, -1)) {
+                    if (target[key] === null || typeof target[key] !== 'object') {
+                        target[key] = {};
+                    }
+                    target = target[key];
+                }
+                const last = keys[keys.length - 1];
+                if (change.delete) {
+                    delete target[last];
+                } else {
+                    target[last] = change.value;
+                }
+                touched[keys[0]] = true;
+            }
+            this.statusSeq = patch.seq;
+            // В updateStatus передаются только затронутые поля верхнего уровня
+            const partial = {};
+            for (const key of Object.keys(touched)) {
+                if (this.aceState[key] !== undefined) {
+                    partial[key] = this.aceState[key];
                 }
             }
+            this.updateStatus(partial);
+        },
+
+        async resyncStatus() {
+            if (this.resyncing) return;
+            this.resyncing = true;
+            try {
+                await this.loadStatus();
+            } finally {
+                this.resyncing = false;
+            }
+            if (this.statusSeq === null) {
+                // Снимок не получен: следующий патч повторит попытку
+                this.pendingPatches = this.pendingPatches.slice(-100);
+                return;
+            }
+            const pending = this.pendingPatches.sort((a, b) => a.seq - b.seq);
+            this.pendingPatches = [];
+            for (const patch of pending) {
+                this.applyPatch(patch);
+            }
         },
         
         // API Calls
@@ -426,6 +506,9 @@ createApp({
                 // Проверяем, что это действительно данные статуса (есть хотя бы одно из полей)
                 if (statusData && typeof statusData === 'object' && 
                     (statusData.status !== undefined || statusData.slots !== undefined || statusData.dryer !== undefined)) {
+                    // Снимок: дальше применяются патчи с номерами после seq
+                    this.aceState = JSON.parse(JSON.stringify(statusData));
+                    this.statusSeq = typeof statusData.seq === 'number' ? statusData.seq : null;
                     this.updateStatus(statusData);
                 } else {
                     console.warn('Invalid status data in response:', result);
@@ -534,8 +617,9 @@ createApp({
                         this.feedAssistSlot = this.currentTool;
                     }
                 }
-            } else {
+            } else if (data.feed_assist_count !== undefined) {
                 // Если feed_assist_count = 0, значит assist выключен
+                // (в патче без этих полей состояние не меняется)
                 this.feedAssistSlot = -1;
             }
             
@@ -550,6 +634,7 @@ createApp({
         },
         
         async executeCommand(command, params = {}) {
+            const runAsync = this.wsConnected && ASYNC_COMMANDS.includes(command);
             try {
                 const response = await fetch(`${this.apiBase}/server/ace/command`, {
                     method: 'POST',
@@ -558,7 +643,8 @@ createApp({
                     },
                     body: JSON.stringify({
                         command: command,
-                        params: params
+                        params: params,
+                        async: runAsync
                     })
                 });
                 
@@ -575,6 +661,12 @@ createApp({
                 
                 if (result.result) {
                     if (result.result.success !== false && !result.result.error) {
+                        if (runAsync && result.result.job !== undefined) {
+                            // Результат придет через notify_ace_job, статус - патчами
+                            this.pendingJobs[result.result.job] = command;
+                            this.showNotification(this.t('notifications.commandSent', { command }), 'success');
+                            return true;
+                        }
                         this.showNotification(this.t('notifications.commandSuccess', { command }), 'success');
                         // Reload status after command
                         setTimeout(() => this.loadStatus(), 1000);
@@ -597,6 +689,40 @@ createApp({
             }
         },
         
+        // Несколько команд одним запросом /server/ace/commands (один скрипт G-code)
+        // Several commands in one /server/ace/commands request (one G-code script)
+        async executeCommands(commands) {
+            try {
+                const response = await fetch(`${this.apiBase}/server/ace/commands`, {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json'
+                    },
+                    body: JSON.stringify({ commands })
+                });
+
+                const result = await response.json();
+
+                if (ACE_DASHBOARD_CONFIG?.debug) {
+                    console.log('Batch response:', result);
+                }
+
+                if (result.error) {
+                    this.showNotification(this.t('notifications.apiError', { error: result.error }), 'error');
+                    return null;
+                }
+                if (result.result && result.result.success === false) {
+                    const errorMsg = result.result.error || this.t('notifications.commandErrorGeneric');
+                    this.showNotification(this.t('notifications.commandError', { error: errorMsg }), 'error');
+                }
+                return result.result?.results || null;
+            } catch (error) {
+                console.error('Error executing commands:', error);
+                this.showNotification(this.t('notifications.executeError', { error: error.message }), 'error');
+                return null;
+            }
+        },
+
         // Device Actions
         async changeTool(tool) {
             const success = await this.executeCommand('ACE_CHANGE_TOOL', { TOOL: tool });
@@ -610,13 +736,12 @@ createApp({
         },
 
         async stopAssist() {
-            let anySuccess = false;
-            for (let index = 0; index < 4; index++) {
-                const success = await this.executeCommand('ACE_DISABLE_FEED_ASSIST', { INDEX: index });
-                if (success) {
-                    anySuccess = true;
-                }
-            }
+            const commands = [0, 1, 2, 3].map(index => ({
+                command: 'ACE_DISABLE_FEED_ASSIST',
+                params: { INDEX: index }
+            }));
+            const results = await this.executeCommands(commands);
+            const anySuccess = (results || []).some(result => result.success);
             if (anySuccess) {
                 this.feedAssistSlot = -1;
                 this.showNotification(this.t('notifications.feedAssistAllOff'), 'success');